@@ -0,0 +1,85 @@
+"""
+Benchmarks annotation parsing against the previous line by line parser.
+
+Usage:
+    python benchmarks/annotation_parsing.py /path/to/folder/of/ann/files [repeats]
+
+Reports the time per file for the previous parser, a cold parse and a cached read,
+and checks that both parsers return the same values.
+"""
+
+import sys
+import time
+from glob import glob
+from os.path import join
+import pandas as pd
+import pytz
+
+from uavsar_pytools.convert.tiff_conversion import get_encapsulated
+from uavsar_pytools.convert.annotation import read_annotation, _read_cached, TIME_KEYS
+
+def legacy_read_annotation(ann_file):
+    """
+    Previous implementation of read_annotation, kept as a baseline.
+    """
+    with open(ann_file) as fp:
+        lines = fp.readlines()
+    data = {}
+    for line in lines:
+        info = line.strip().split(';')
+        comment = info[-1].strip().lower()
+        info = info[0]
+        if info and "=" in info:
+            d = info.split('=')
+            name, value = d[0], d[1]
+            key = name.split('(')[0].strip().lower()
+            units = get_encapsulated(name, '()')
+            if not units:
+                units = None
+            else:
+                units = units[0]
+            value = value.strip()
+            if value.strip('-').replace('.', '').isnumeric():
+                if '.' in value:
+                    value = float(value)
+                else:
+                    value = int(value)
+            data[key] = {'value': value, 'units': units, 'comment': comment}
+
+    for key in TIME_KEYS & data.keys():
+        dt = pd.to_datetime(data[key]['value'])
+        data[key]['value'] = dt.astimezone(pytz.timezone('US/Mountain'))
+    return data
+
+def timeit(func, fps, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for fp in fps:
+            func(fp)
+    return (time.perf_counter() - start) / (repeats * len(fps))
+
+def main(ann_dir, repeats = 5):
+    fps = sorted(glob(join(ann_dir, '**', '*.ann'), recursive = True))
+    if not fps:
+        raise ValueError(f'No .ann files found in {ann_dir}')
+
+    for fp in fps:
+        assert read_annotation(fp).to_dict() == legacy_read_annotation(fp), f'Mismatch for {fp}'
+
+    legacy = timeit(legacy_read_annotation, fps, repeats)
+
+    def cold(fp):
+        _read_cached.cache_clear()
+        return read_annotation(fp)
+    parse = timeit(cold, fps, repeats)
+    for fp in fps:
+        read_annotation(fp)
+    cached = timeit(read_annotation, fps, repeats)
+
+    print(f'{len(fps)} annotation files, {repeats} repeats')
+    print(f'legacy parser: {legacy * 1e3:8.3f} ms/file')
+    print(f'regex parser:  {parse * 1e3:8.3f} ms/file ({legacy / parse:.1f}x)')
+    print(f'cached read:   {cached * 1e3:8.3f} ms/file ({legacy / cached:.1f}x)')
+
+if __name__ == '__main__':
+    main(sys.argv[1], *[int(a) for a in sys.argv[2:3]])
@@ -0,0 +1,75 @@
+"""
+Benchmarks calc_inc_angle against the previous np.vectorize implementation.
+
+Usage:
+    python benchmarks/incidence_angle.py [size] [legacy_size]
+
+Times the array based calc_inc_angle on a size x size synthetic DEM (default 10000)
+and the previous implementation on a legacy_size x legacy_size DEM (default 1000).
+The legacy time is scaled by the number of pixels since it runs one Python call per pixel.
+"""
+
+import sys
+import time
+import numpy as np
+
+from uavsar_pytools.incidence_angle import calc_inc_angle
+
+def legacy_arccos_theta(v):
+    if v < 1 and v > -1:
+        return np.arccos(v)
+    elif v > 1 and v < 3:
+        return np.arccos(2-v)
+    elif v < -1 and v > -3:
+        return np.arccos(-1 + 0.000001) - np.arccos(2+v)
+    else:
+        return np.nan
+
+legacy_arccos_theta = np.vectorize(legacy_arccos_theta)
+
+def legacy_calc_inc_angle(dem, lkv_x, lkv_y, lkv_z, pixel_size=5.556):
+    """
+    Previous implementation of calc_inc_angle for arrays, kept as a baseline.
+    """
+    dx, dy = np.gradient(dem, pixel_size)
+    lkv = {'x': lkv_x, 'y': lkv_y, 'z': lkv_z}
+    lkv_mag = np.zeros_like(lkv['x'])
+    for direction, arr in lkv.items():
+        lkv_mag = lkv_mag + arr**2
+    lkv_mag = lkv_mag**0.5
+    lkv_mag[lkv_mag == 0] = np.nan
+    unit_lkv = {}
+    for direction, arr in lkv.items():
+        unit_lkv[direction] = -arr/lkv_mag
+    inc_cos = unit_lkv['x']*dx + unit_lkv['y']*dy + unit_lkv['z']
+    return np.rad2deg(legacy_arccos_theta(inc_cos))
+
+def synthetic(size, seed = 0):
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 1, size, dtype = np.float32)[:, None]
+    cols = np.linspace(0, 1, size, dtype = np.float32)[None, :]
+    dem = (3000 + 500*np.sin(6*rows)*np.cos(4*cols) + rng.normal(0, 2, (size, size))).astype(np.float32)
+    lkv_x = np.broadcast_to(np.float32(-4000) + 8000*cols, (size, size)).astype(np.float32)
+    lkv_y = np.full((size, size), 500, dtype = np.float32)
+    lkv_z = np.full((size, size), -9000, dtype = np.float32)
+    return dem, lkv_x, lkv_y, lkv_z
+
+def main(size = 10000, legacy_size = 1000):
+    arrays = synthetic(legacy_size)
+    start = time.perf_counter()
+    legacy = legacy_calc_inc_angle(*arrays)
+    legacy_time = (time.perf_counter() - start) * (size / legacy_size)**2
+    np.testing.assert_allclose(calc_inc_angle(*arrays), legacy, atol = 1e-2, equal_nan = True)
+
+    arrays = synthetic(size)
+    out = np.empty((size, size), dtype = np.float32)
+    start = time.perf_counter()
+    calc_inc_angle(*arrays, out = out)
+    new_time = time.perf_counter() - start
+
+    print(f'{size} x {size} DEM')
+    print(f'np.vectorize (scaled from {legacy_size} x {legacy_size}): {legacy_time:8.2f} s')
+    print(f'array based:                              {new_time:8.2f} s ({legacy_time / new_time:.0f}x)')
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,93 @@
+"""
+Benchmarks the fused depth_from_phase kernel against the previous implementation.
+
+Usage:
+    python benchmarks/snow_depth_inversion.py [rows] [cols] [dates]
+
+Inverts a rows x cols synthetic swath (default 6000 x 3300, about the size of a
+UAVSAR ground range scene) with incidence angle and density rasters and reports the
+time, throughput and peak memory of each implementation. Peak memory is the largest
+traced allocation above the inputs. The stack timings invert the given number of
+dates (default 4), reusing a precomputed geometry term in the fused version.
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from uavsar_pytools.snow_depth_inversion import depth_from_phase, geometry_term
+
+def legacy_depth_from_phase(delta_phase, inc_angle, permittivity = None, density = None,
+                            method = 'guneriussen2001', wavelength = 0.238403545):
+    """
+    Previous implementation of depth_from_phase, kept as a baseline.
+    """
+    for i in [inc_angle, permittivity, density]:
+        if type(i) == np.ndarray:
+            if i.shape != delta_phase.shape:
+                raise ValueError('All raster datasets must be the same shape.')
+    if type(permittivity) == np.ndarray:
+        if 1 in permittivity or 1.0 in permittivity:
+            raise ValueError('Permittivity array cannot contain values equal to 1.')
+    if np.nanmean(inc_angle) > 2*np.pi:
+        raise ValueError('Incidence angle must be in radians.')
+    if density is not None:
+        if np.nanmean(density) < 1:
+            raise ValueError('Densities must be in kg/m3.')
+    if permittivity is None:
+        if method == 'guneriussen2001':
+            perm = 1 + 1.6 * (density/1000) + 1.8 * (density/1000)**3
+        elif method == 'webb2021':
+            perm = 1 + 0.0014 * density + 2e-7 * density**2
+    else:
+        perm = permittivity
+    return (-delta_phase * wavelength) / (4 * np.pi * (np.cos(inc_angle) - np.sqrt(perm - np.sin(inc_angle)**2)))
+
+def synthetic(rows, cols, seed = 0):
+    rng = np.random.default_rng(seed)
+    inc = np.broadcast_to(np.linspace(0.35, 1.15, cols, dtype = np.float32), (rows, cols)).copy()
+    density = rng.uniform(150, 400, (rows, cols)).astype(np.float32)
+    phase = rng.uniform(-np.pi, np.pi, (rows, cols)).astype(np.float32)
+    return phase, inc, density
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main(rows = 6000, cols = 3300, dates = 4):
+    phase, inc, density = synthetic(rows, cols)
+    mpix = rows * cols / 1e6
+
+    legacy, legacy_time, legacy_peak = measure(lambda: legacy_depth_from_phase(phase, inc, density = density))
+    fused, fused_time, fused_peak = measure(lambda: depth_from_phase(phase, inc, density = density))
+    np.testing.assert_allclose(fused, legacy, rtol = 1e-4)
+    del legacy, fused
+
+    def legacy_stack():
+        for i in range(dates):
+            legacy_depth_from_phase(phase, inc, density = density)
+
+    def fused_stack():
+        geometry = geometry_term(inc, density = density)
+        out = np.empty(phase.shape, dtype = np.float32)
+        for i in range(dates):
+            depth_from_phase(phase, None, geometry = geometry, validate = False, out = out)
+
+    _, legacy_stack_time, _ = measure(legacy_stack)
+    _, fused_stack_time, _ = measure(fused_stack)
+
+    print(f'{rows} x {cols} swath ({mpix:.1f} Mpix), {phase.nbytes / 2**20:.0f} MiB per float32 raster')
+    print(f'single date  previous: {legacy_time:6.2f} s {mpix / legacy_time:7.1f} Mpix/s peak {legacy_peak / 2**20:6.0f} MiB')
+    print(f'             fused:    {fused_time:6.2f} s {mpix / fused_time:7.1f} Mpix/s peak {fused_peak / 2**20:6.0f} MiB '
+          f'({legacy_time / fused_time:.1f}x faster, {legacy_peak / fused_peak:.1f}x less memory)')
+    print(f'{dates} date stack previous: {legacy_stack_time:6.2f} s')
+    print(f'             fused:    {fused_stack_time:6.2f} s ({legacy_stack_time / fused_stack_time:.1f}x faster)')
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:4]])
@@ -39,7 +39,9 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
-    'nb_conda_kernels', 'ipykernel', 'ipywidgets', 'jupyter', 'GDAL'
+    'notebooks': ['nb_conda_kernels', 'ipykernel', 'ipywidgets', 'jupyter'],
+    'gdal': ['GDAL'],
+    'zarr': ['zarr'],
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -123,7 +125,7 @@ setup(
     #     'console_scripts': ['mycli=mymodule:cli'],
     # },
     install_requires=REQUIRED,
-    # extras_require=EXTRAS,
+    extras_require=EXTRAS,
     test_suite='nose.collector',
     tests_require=['nose'],
     include_package_data=True,
@@ -0,0 +1,55 @@
+import unittest
+import tempfile
+import os
+from os.path import join
+
+from uavsar_pytools import UavsarScene, UavsarCatalog
+from tests.test_tiff_conversion import write_insar_dir, BASE
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = join(self.tmp.name, 'bin_imgs')
+        os.makedirs(self.bin_dir)
+        write_insar_dir(self.bin_dir)
+        self.db = join(self.tmp.name, 'catalog.db')
+        url = f'https://unzip.asf.alaska.edu/INTERFEROMETRY_GRD/UA/{BASE}_int_grd.zip'
+        self.scene = UavsarScene(url, self.tmp.name, clean = False, catalog = self.db)
+        self.scene.binary_to_tiffs(binary_dir = self.bin_dir)
+        self.scene.catalog.add_scene(self.scene)
+        self.catalog = UavsarCatalog(self.db)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scene(self):
+        scenes = self.catalog.scenes()
+        self.assertEqual(list(scenes.pair_name), [self.scene.pair_name])
+        row = scenes.iloc[0]
+        self.assertEqual(row.flight_line, '27416')
+        self.assertEqual(row.start_time, '2021-02-11T18:01:55')
+        self.assertEqual(row.stop_time, '2021-02-11T18:07:12')
+        self.assertAlmostEqual(row.min_lon, -108.2)
+        self.assertTrue(row.footprint.startswith('POLYGON (('))
+        self.assertEqual(self.catalog.annotation(self.scene.pair_name)['grd.set_rows']['value'], '9')
+
+    def test_query(self):
+        self.assertEqual(sorted(self.catalog.query()['product']), ['cor', 'int'])
+        self.assertEqual(list(self.catalog.query(product = 'cor', pol = 'HH')['product']), ['cor'])
+        self.assertEqual(len(self.catalog.query(bbox = (-108.3, 39.0, -108.1, 39.2))), 2)
+        self.assertEqual(len(self.catalog.query(bbox = (-100, 39.0, -99, 39.2))), 0)
+        self.assertEqual(len(self.catalog.query(start = '2021-02-11', end = '2021-02-12')), 2)
+        self.assertEqual(len(self.catalog.query(start = '2021-02-12')), 0)
+        self.assertEqual(len(self.catalog.query(flight_line = 27416)), 2)
+        self.assertEqual(len(self.catalog.query(flight_line = '08208')), 0)
+
+    def test_reindex_and_remove(self):
+        self.catalog.add_scene(self.scene)
+        self.assertEqual(len(self.catalog.query()), 2)
+        self.catalog.remove(self.scene.pair_name)
+        self.assertEqual(len(self.catalog.query()), 0)
+        self.assertEqual(self.catalog.annotation(self.scene.pair_name), {})
+
+if __name__ == '__main__':
+    unittest.main()
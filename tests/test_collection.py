@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+import tempfile
+import time
+from functools import partial
+from threading import Lock
+from os.path import join
+
+from uavsar_pytools import UavsarCollection
+from uavsar_pytools.convert.file_control import read_manifest
+from uavsar_pytools.download.search import cached_search, SearchResult
+
+class FakeResult():
+    def __init__(self, name):
+        self.properties = {'url': f'https://datapool.asf.alaska.edu/INTERFEROMETRY_GRD/UA/{name}.zip'}
+
+class FakeScene():
+    def __init__(self, url, state, **kwargs):
+        self.pair_name = url.split('/')[-1].split('.')[0]
+        self.images = {}
+        self.state = state
+    def download(self):
+        with self.state['lock']:
+            self.state['waiting'] += 1
+            self.state['max_waiting'] = max(self.state['max_waiting'], self.state['waiting'])
+    def zip_to_tiffs(self):
+        time.sleep(0.01)
+        with self.state['lock']:
+            self.state['waiting'] -= 1
+        if self.pair_name == 'bad_pair':
+            raise ValueError('Corrupt zip')
+        self.state['converted'].append(self.pair_name)
+
+class TestCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {'converted': [], 'waiting': 0, 'max_waiting': 0, 'lock': Lock()}
+        patcher = mock.patch('uavsar_pytools.uavsar_collection.UavsarScene', partial(FakeScene, state = self.state))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resume_from_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            names = [f'pair_{i}' for i in range(5)] + ['bad_pair']
+            col = UavsarCollection('Grand Mesa, CO', work_dir = tmp, img_type = 'AMPLITUDE_GRD',
+                                   download_workers = 3, convert_workers = 2)
+            col.results = [FakeResult(n) for n in names]
+            col.results_to_tiffs()
+            self.assertEqual(sorted(self.state['converted']), names[:5])
+            self.assertEqual(read_manifest(join(tmp, 'uavsar_manifest.txt')), set(names[:5]))
+            # Second run only retries the failed pair
+            self.state['converted'].clear()
+            col.results_to_tiffs()
+            self.assertEqual(self.state['converted'], [])
+
+    def test_download_backpressure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            col = UavsarCollection('Grand Mesa, CO', work_dir = tmp, img_type = 'AMPLITUDE_GRD',
+                                   download_workers = 3, convert_workers = 1, manifest = False)
+            col.results = [FakeResult(f'pair_{i}') for i in range(20)]
+            col.results_to_tiffs()
+            self.assertEqual(len(self.state['converted']), 20)
+            # Downloads wait for conversions instead of running through the collection
+            self.assertLessEqual(self.state['max_waiting'], 4)
+
+
+class FakeProduct():
+    def __init__(self, name, path, start, stop):
+        self.properties = {'url': f'https://datapool.asf.alaska.edu/{name}.zip', 'pathNumber': path,
+                           'startTime': start, 'stopTime': stop}
+        self.geometry = {'type': 'Point', 'coordinates': [-108, 39]}
+
+def fake_search(processingLevel, **kwargs):
+    if processingLevel == ['INC']:
+        return [FakeProduct('inc_a', 1, '2020-02-01T10:00:00Z', '2020-02-01T10:30:00Z'),
+                FakeProduct('inc_b', 2, '2020-02-01T10:00:00Z', '2020-02-01T10:30:00Z')]
+    return [FakeProduct('pair_a', 1, '2020-01-01T10:05:00Z', '2020-02-01T10:10:00Z'),
+            FakeProduct('pair_b', 2, '2020-03-01T10:05:00Z', '2020-03-01T10:10:00Z')]
+
+class TestSearchCache(unittest.TestCase):
+
+    def test_cached_collection_search(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch('uavsar_pytools.download.search.asf.search', side_effect = fake_search) as search:
+            col = UavsarCollection('Grand Mesa, CO', work_dir = tmp, dates = ('2020-01-01', '2020-04-01'), inc = True)
+            col.find_urls()
+            col.find_inc_urls()
+            self.assertEqual(search.call_count, 2)
+            # Live products are returned when ASF is searched
+            self.assertIsInstance(col.results[0], FakeProduct)
+            self.assertEqual(col.inc_results[col.results[0].properties['url']].properties['url'],
+                             'https://datapool.asf.alaska.edu/inc_a.zip')
+            # pair_b does not overlap any INC acquisition on its flight path
+            self.assertIsNone(col.inc_results[col.results[1].properties['url']])
+
+            # New collections reuse the cache, including offline
+            col = UavsarCollection('Grand Mesa, CO', work_dir = tmp, dates = ('2020-01-01', '2020-04-01'), offline = True)
+            col.find_urls()
+            col.find_inc_urls()
+            self.assertEqual(search.call_count, 2)
+            self.assertEqual([r.properties['url'] for r in col.results],
+                             [p.properties['url'] for p in fake_search(['INTERFEROMETRY_GRD'])])
+            self.assertIsInstance(col.results[0], SearchResult)
+
+            # Expired entries are searched again and offline misses raise
+            cached_search(tmp, ttl = 0, platform = 'UAVSAR', processingLevel = ['INC'])
+            self.assertEqual(search.call_count, 3)
+            with self.assertRaises(FileNotFoundError):
+                cached_search(tmp, offline = True, platform = 'UAVSAR', processingLevel = ['PROJECTED'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,296 @@
+import unittest
+import tempfile
+import hashlib
+import os
+import re
+import threading
+import io
+import zipfile
+from os.path import join, exists
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from uavsar_pytools.download.download import stream_download, configure_session, get_session, url_exists, \
+    download_zip, download_image
+from uavsar_pytools.download.remote_zip import download_zip_members, list_zip_members
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the ASF/JPL servers. Serves files from the server's
+    files dict with optional Range support and simulated dropped connections.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', self.path))
+        data = self.server.files.get(self.path)
+        self.send_response(404 if data is None else 200)
+        if data is not None:
+            self.send_header('Content-Length', str(len(data)))
+            if self.server.ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.server.fail_next > 0:
+            self.server.fail_next -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        start, end = 0, len(data) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        body = data[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if self.server.drop_after is not None:
+            # Simulate a dropped connection part way through the body
+            self.wfile.write(body[:self.server.drop_after])
+            self.server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+def start_server(files):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.files = files
+    server.ranges = True
+    server.drop_after = None
+    server.fail_next = 0
+    server.requests = []
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+class TestStreamDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = os.urandom(300_000)
+        cls.server, cls.base = start_server({'/scene.zip': cls.data})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = join(self.tmp.name, 'scene.zip')
+        self.server.ranges = True
+        self.server.drop_after = None
+        self.server.fail_next = 0
+        self.server.requests = []
+        configure_session(backoff_factor = 0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_download_with_md5(self):
+        md5 = hashlib.md5(self.data).hexdigest()
+        self.assertEqual(stream_download(self.base + '/scene.zip', self.out, chunk_size = 4096, md5 = md5), self.out)
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(exists(self.out + '.part'))
+
+    def test_bad_md5(self):
+        self.assertIsNone(stream_download(self.base + '/scene.zip', self.out, md5 = '0'*32))
+        self.assertFalse(exists(self.out))
+        self.assertFalse(exists(self.out + '.part'))
+
+    def test_download_zip_bad_md5(self):
+        # Failed downloads raise instead of returning a path that was never written
+        with self.assertRaises(ValueError):
+            download_zip(self.base + '/scene.zip', self.tmp.name, md5 = '0'*32)
+        self.assertFalse(exists(self.out))
+        with self.assertRaises(ValueError):
+            download_image(self.base + '/scene.zip', self.tmp.name, md5 = '0'*32)
+        md5 = hashlib.md5(self.data).hexdigest()
+        self.assertEqual(download_zip(self.base + '/scene.zip', self.tmp.name, md5 = md5), self.out)
+
+    def test_resume_after_drop(self):
+        self.server.drop_after = 100_000
+        self.assertIsNone(stream_download(self.base + '/scene.zip', self.out, chunk_size = 4096))
+        self.assertFalse(exists(self.out))
+        partial = os.path.getsize(self.out + '.part')
+        self.assertGreater(partial, 0)
+        self.assertEqual(stream_download(self.base + '/scene.zip', self.out, chunk_size = 4096), self.out)
+        self.assertEqual(self.server.requests[-1][1], f'bytes={partial}-')
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_restart_without_ranges(self):
+        self.server.ranges = False
+        with open(self.out + '.part', 'wb') as f:
+            f.write(b'stale')
+        self.assertEqual(stream_download(self.base + '/scene.zip', self.out), self.out)
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_complete_partial(self):
+        with open(self.out + '.part', 'wb') as f:
+            f.write(self.data)
+        self.assertEqual(stream_download(self.base + '/scene.zip', self.out), self.out)
+        self.assertTrue(exists(self.out))
+
+    def test_missing(self):
+        self.assertIsNone(stream_download(self.base + '/missing.zip', self.out))
+        self.assertFalse(exists(self.out))
+
+class TestSegmentedDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = os.urandom(250_001)
+        cls.server, cls.base = start_server({'/scene.zip': cls.data})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = join(self.tmp.name, 'scene.zip')
+        self.server.ranges = True
+        self.server.drop_after = None
+        self.server.fail_next = 0
+        self.server.requests = []
+        configure_session(retries = 0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        configure_session()
+
+    def download(self):
+        return stream_download(self.base + '/scene.zip', self.out, chunk_size = 4096, segments = 4,
+                               min_segment_size = 0, md5 = hashlib.md5(self.data).hexdigest())
+
+    def test_segments(self):
+        self.assertEqual(self.download(), self.out)
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        ranges = sorted(r[1] for r in self.server.requests if r[0] == '/scene.zip')
+        self.assertEqual(len(ranges), 4)
+        self.assertFalse(exists(self.out + '.part.segments'))
+
+    def test_fallback_without_ranges(self):
+        self.server.ranges = False
+        self.assertEqual(self.download(), self.out)
+        self.assertEqual([r for r in self.server.requests if r[0] == '/scene.zip'], [('/scene.zip', None)])
+
+    def test_resume_failed_segment(self):
+        self.server.fail_next = 1
+        self.assertIsNone(self.download())
+        self.assertTrue(exists(self.out + '.part.segments'))
+        self.server.requests = []
+        self.assertEqual(self.download(), self.out)
+        self.assertEqual(len([r for r in self.server.requests if r[0] == '/scene.zip']), 1)
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+class TestSession(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.base = start_server({'/scene.ann': b'ann'*1000})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        configure_session()
+
+    def setUp(self):
+        self.server.requests = []
+        configure_session(retries = 3, backoff_factor = 0)
+
+    def test_shared_session(self):
+        self.assertIs(get_session(), get_session())
+
+    def test_retry_on_503(self):
+        self.server.fail_next = 2
+        with tempfile.TemporaryDirectory() as tmp:
+            out = join(tmp, 'scene.ann')
+            self.assertEqual(stream_download(self.base + '/scene.ann', out), out)
+        self.assertEqual(self.server.fail_next, 0)
+
+    def test_head_probe(self):
+        self.assertTrue(url_exists(self.base + '/scene.ann'))
+        self.assertFalse(url_exists(self.base + '/missing.ann'))
+        self.assertEqual([r[0] for r in self.server.requests], ['HEAD', 'HEAD'])
+
+class TestRemoteZip(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.members = {'scene/scene.ann': b'ann' * 100}
+        for pol in ['HH', 'VV']:
+            for product in ['unw.grd', 'cor.grd', 'int.grd']:
+                cls.members[f'scene/scene_{pol}_01.{product}'] = os.urandom(2_000_000)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            for name, data in cls.members.items():
+                zip_file.writestr(name, data)
+        cls.zip_size = len(buffer.getvalue())
+        cls.server, cls.base = start_server({'/scene.zip': buffer.getvalue()})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server.ranges = True
+        self.server.requests = []
+        configure_session(backoff_factor = 0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_list(self):
+        self.assertEqual(sorted(list_zip_members(self.base + '/scene.zip')), sorted(self.members))
+
+    def test_selected_members(self):
+        fps = download_zip_members(self.base + '/scene.zip', self.tmp.name, pols = ['VV'], products = ['unw'])
+        names = sorted(os.path.relpath(fp, self.tmp.name) for fp in fps)
+        self.assertEqual(names, ['scene/scene.ann', 'scene/scene_VV_01.unw.grd'])
+        for name in names:
+            with open(join(self.tmp.name, name), 'rb') as f:
+                self.assertEqual(f.read(), self.members[name])
+        # Only the central directory and the two selected members should be transferred
+        transferred = 0
+        for path, byte_range in self.server.requests:
+            if path == '/scene.zip':
+                start, end = byte_range.split('=')[1].split('-')
+                transferred += min(int(end), self.zip_size - 1) - int(start) + 1
+        self.assertLess(transferred, self.zip_size / 2)
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        with self.assertRaises(ValueError):
+            download_zip_members(self.base + '/scene.zip', self.tmp.name, products = ['unw'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+import tempfile
+import os
+from os.path import join, basename
+from unittest import mock
+import numpy as np
+import rasterio as rio
+
+from uavsar_pytools.geocode import build_lookup, cached_lookup, GEOCODE_NODATA
+from uavsar_pytools.georeference import geolocate_uavsar, combo_llhs
+
+ANN = """llh_1_2x8.set_rows  (pixels) = {rows} ; rows
+llh_1_2x8.set_cols  (pixels) = {cols} ; cols
+lkv_1_2x8 rows      (pixels) = {rows} ; rows
+lkv_1_2x8 columns   (pixels) = {cols} ; cols
+slc_1_1x1 rows      (pixels) = {slc_rows} ; rows
+slc_1_1x1 columns   (pixels) = {slc_cols} ; cols
+"""
+
+def swath(rows = 120, cols = 50, r = None, c = None):
+    """
+    Latitude and longitude of a swath rotated 25 degrees from north. Fractional rows
+    and columns of the grid can be given instead of its size.
+    """
+    if r is None:
+        r, c = np.mgrid[0:rows, 0:cols].astype(np.float64)
+    theta = np.deg2rad(25)
+    lat = 39 - 5e-5 * (r * np.cos(theta) - 1.3 * c * np.sin(theta))
+    lon = -108 + 5e-5 * (r * np.sin(theta) + 1.3 * c * np.cos(theta))
+    return lat.astype(np.float32), lon.astype(np.float32)
+
+def field(lat, lon):
+    return np.sin((lat - 39) * 3000) + np.cos((lon + 108) * 2000)
+
+class TestGeocode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lat, self.lon = swath()
+        self.arr = field(self.lat.astype(np.float64), self.lon.astype(np.float64)).astype(np.float32)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, lookup, out, atol):
+        t = lookup.transform
+        rows, cols = np.divmod(lookup.out_index, lookup.shape[1])
+        expected = field(t.f + t.e * (rows + 0.5), t.c + t.a * (cols + 0.5))
+        self.assertLess(np.abs(out.reshape(-1)[lookup.out_index] - expected).mean(), atol)
+
+    def test_lookup(self):
+        for method, atol in [('nearest', 0.05), ('bilinear', 0.005)]:
+            lookup = build_lookup(self.lat, self.lon, method = method)
+            out = lookup.resample(self.arr)
+            self.check(lookup, out, atol)
+            # Output covers about the swath area and is nodata elsewhere
+            self.assertGreater(len(lookup.out_index), 0.9 * self.arr.size)
+            self.assertTrue((out == GEOCODE_NODATA).any())
+        # Complex images are resampled with the same lookup
+        out = lookup.resample(self.arr * (1 + 1j))
+        self.assertEqual(out.dtype, np.complex64)
+        with self.assertRaises(ValueError):
+            lookup.resample(self.arr[1:])
+
+    def test_cached_lookup(self):
+        llh_fp = join(self.tmp.name, 'scene.llh')
+        np.stack([self.lat, self.lon, np.zeros_like(self.lat)], axis = -1).astype('<f').tofile(llh_fp)
+        cache_dir = join(self.tmp.name, 'cache')
+        lookup = cached_lookup(llh_fp, *self.lat.shape, cache_dir = cache_dir, method = 'bilinear')
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        # Later calls load the saved table without any geometry work
+        with mock.patch('uavsar_pytools.geocode.build_lookup') as build:
+            cached = cached_lookup(llh_fp, *self.lat.shape, cache_dir = cache_dir, method = 'bilinear')
+            build.assert_not_called()
+        self.assertEqual(cached.transform, lookup.transform)
+        np.testing.assert_array_equal(cached.src_coords, lookup.src_coords)
+        np.testing.assert_array_equal(cached.resample(self.arr), lookup.resample(self.arr))
+        # A different grid or method is a different table
+        cached_lookup(llh_fp, *self.lat.shape, cache_dir = cache_dir, spacing = 0.0001)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_geolocate(self):
+        rows, cols = self.arr.shape
+        ann_fp = join(self.tmp.name, 'scene.ann')
+        with open(ann_fp, 'w') as f:
+            f.write(ANN.format(rows = rows, cols = cols, slc_rows = rows * 8, slc_cols = cols * 2))
+        llh_fp = join(self.tmp.name, 'scene_2x8.llh')
+        np.stack([self.lat, self.lon, np.full_like(self.lat, 3000)], axis = -1).astype('<f').tofile(llh_fp)
+        lkv_fp = join(self.tmp.name, 'scene_2x8.lkv')
+        np.stack([self.arr, 2 * self.arr, 3 * self.arr], axis = -1).astype('<f').tofile(lkv_fp)
+
+        out_fps = geolocate_uavsar(lkv_fp, ann_fp, join(self.tmp.name, 'out'), llh_fp)
+        self.assertEqual([basename(fp) for fp in out_fps], [f'scene_2x8.lkv.{n}.tif' for n in ['y', 'x', 'z']])
+        lookup = build_lookup(self.lat, self.lon)
+        for fp, scale in zip(out_fps, [1, 2, 3]):
+            with rio.open(fp) as src:
+                self.assertEqual(src.nodata, GEOCODE_NODATA)
+                self.assertEqual(src.crs.to_epsg(), 4326)
+                self.assertEqual(src.transform, lookup.transform)
+                out = src.read(1)
+            self.check(lookup, out / scale, 0.05)
+
+    def test_geolocate_slc(self):
+        # SLCs have 8 times the rows and 2 times the columns of the 2x8 llh
+        rows, cols = self.arr.shape
+        ann_fp = join(self.tmp.name, 'scene.ann')
+        with open(ann_fp, 'w') as f:
+            f.write(ANN.format(rows = rows, cols = cols, slc_rows = rows * 8, slc_cols = cols * 2))
+        llh_fp = join(self.tmp.name, 'scene_2x8.llh')
+        np.stack([self.lat, self.lon, np.zeros_like(self.lat)], axis = -1).astype('<f').tofile(llh_fp)
+        # Centers of SLC pixels in llh pixel coordinates
+        r, c = np.mgrid[0:rows * 8, 0:cols * 2].astype(np.float64)
+        lat, lon = swath(r = (r + 0.5) / 8 - 0.5, c = (c + 0.5) / 2 - 0.5)
+        slc = field(lat.astype(np.float64), lon.astype(np.float64)) * (1 - 2j)
+        slc_fp = join(self.tmp.name, 'scene_1x1.slc')
+        slc.astype(np.complex64).tofile(slc_fp)
+
+        for method, atol in [('nearest', 0.02), ('bilinear', 0.005)]:
+            out_fps = geolocate_uavsar(slc_fp, ann_fp, join(self.tmp.name, method), llh_fp, method = method)
+            self.assertEqual([basename(fp) for fp in out_fps], ['scene_1x1.slc.real.tif', 'scene_1x1.slc.imag.tif'])
+            lookup = build_lookup(self.lat, self.lon, method = method)
+            for fp, scale in zip(out_fps, [1, -2]):
+                with rio.open(fp) as src:
+                    self.assertEqual(src.transform, lookup.transform)
+                    self.check(lookup, src.read(1) / scale, atol)
+        # The memory mapped SLC is read in blocks of rows with the same result
+        mm = np.memmap(slc_fp, dtype = np.complex64, mode = 'r', shape = (rows * 8, cols * 2))
+        np.testing.assert_array_equal(lookup.resample(mm.real, block_rows = 7),
+                                      lookup.resample(np.ascontiguousarray(mm.real)))
+        # Shapes that are not a whole number of looks are rejected
+        with self.assertRaises(ValueError):
+            lookup.resample(np.zeros((rows * 8 + 1, cols * 2)))
+
+    def test_combo_llhs(self):
+        ann = ''
+        segments = []
+        for segment, rows in [(1, 5), (2, 3), (10, 4)]:
+            llh = np.random.default_rng(segment).random((rows, 7, 3)).astype('<f')
+            llh.tofile(join(self.tmp.name, f'line_s{segment}_2x8.llh'))
+            ann += f'llh_{segment}_2x8.set_rows (pixels) = {rows} ; rows\nllh_{segment}_2x8.set_cols (pixels) = 7 ; cols\n'
+            segments.append(llh)
+        ann_fp = join(self.tmp.name, 'line.ann')
+        with open(ann_fp, 'w') as f:
+            f.write(ann)
+        expected = np.concatenate(segments)
+
+        full = combo_llhs(self.tmp.name, ann_fp = ann_fp)
+        self.assertEqual(full.dtype, np.dtype('>f'))
+        np.testing.assert_array_equal(full, expected.reshape(-1))
+        # The combined llh is not mistaken for a segment
+        self.assertEqual(len(combo_llhs(self.tmp.name)), expected.size)
+
+        vrt_fp = combo_llhs(self.tmp.name, ann_fp = ann_fp, vrt = True)
+        with rio.open(vrt_fp) as src:
+            self.assertEqual(src.descriptions, ('lat', 'lon', 'height'))
+            np.testing.assert_array_equal(np.moveaxis(src.read(), 0, -1), expected)
+
+if __name__ == '__main__':
+    unittest.main()
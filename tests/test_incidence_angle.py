@@ -0,0 +1,88 @@
+import unittest
+import tempfile
+from os.path import join
+import numpy as np
+import rasterio as rio
+from rasterio.transform import Affine
+
+from uavsar_pytools.incidence_angle import arccos_theta, calc_inc_angle, calc_inc_angle_tiff
+
+def scalar_arccos_theta(v):
+    """
+    Previous per pixel implementation.
+    """
+    if v < 1 and v > -1:
+        return np.arccos(v)
+    elif v > 1 and v < 3:
+        return np.arccos(2-v)
+    elif v < -1 and v > -3:
+        return np.arccos(-1 + 0.000001) - np.arccos(2+v)
+    else:
+        return np.nan
+
+class TestIncidenceAngle(unittest.TestCase):
+
+    def test_arccos_theta(self):
+        v = np.concatenate([np.linspace(-3.5, 3.5, 1001), [-3, -1, 1, 3, np.nan, np.inf]])
+        expected = np.vectorize(scalar_arccos_theta)(v)
+        np.testing.assert_allclose(arccos_theta(v), expected, equal_nan = True)
+        np.testing.assert_allclose(arccos_theta(v.astype(np.float32)), expected, rtol = 1e-5, atol = 1e-5, equal_nan = True)
+        self.assertAlmostEqual(arccos_theta(0.5), np.arccos(0.5))
+        out = np.empty_like(v)
+        self.assertIs(arccos_theta(v, out = out), out)
+        # In place
+        np.testing.assert_allclose(arccos_theta(out, out = out), np.vectorize(scalar_arccos_theta)(expected), equal_nan = True)
+        # Non-negative cosines fold without masks
+        v = np.concatenate([np.linspace(0, 2.9, 1001), [1, np.nan]])
+        expected = np.vectorize(scalar_arccos_theta)(v)
+        self.assertTrue(np.isnan(expected[-2]))
+        np.testing.assert_allclose(arccos_theta(v), expected, equal_nan = True)
+        np.testing.assert_allclose(arccos_theta(v.astype(np.float32)), expected, rtol = 1e-5, atol = 1e-5, equal_nan = True)
+
+    def test_calc_inc_angle(self):
+        rng = np.random.default_rng(0)
+        dem = rng.normal(2000, 20, size = (40, 30))
+        lkv = [rng.normal(size = dem.shape) * s for s in [3000, 3000, -5000]]
+        lkv[0][0, 0] = lkv[1][0, 0] = lkv[2][0, 0] = 0
+
+        # Reference from the previous implementation
+        dx, dy = np.gradient(dem, 5.556)
+        mag = np.sqrt(sum(l**2 for l in lkv))
+        mag[mag == 0] = np.nan
+        inc_cos = -lkv[0]/mag*dx - lkv[1]/mag*dy - lkv[2]/mag
+        expected = np.rad2deg(np.vectorize(scalar_arccos_theta)(inc_cos))
+
+        inc = calc_inc_angle(dem, *lkv)
+        self.assertEqual(inc.dtype, np.float32)
+        self.assertTrue(np.isnan(inc[0, 0]))
+        # float32 arccos is ill conditioned close to 1 so allow ~0.01 degrees
+        np.testing.assert_allclose(inc, expected, rtol = 1e-4, atol = 1e-2, equal_nan = True)
+        inc64 = calc_inc_angle(dem, *lkv, dtype = np.float64)
+        np.testing.assert_allclose(inc64, expected, equal_nan = True)
+        # Blocks use a halo so the gradient matches at block edges
+        np.testing.assert_array_equal(calc_inc_angle(dem, *lkv, dtype = np.float64, block_rows = 3), inc64)
+        out = np.empty(dem.shape, dtype = np.float32)
+        self.assertIs(calc_inc_angle(dem, *lkv, out = out), out)
+    def test_calc_inc_angle_tiff(self):
+        rng = np.random.default_rng(1)
+        shape = (70, 45)
+        dem = rng.normal(2000, 20, size = shape).astype(np.float32)
+        lkv = [(rng.normal(size = shape) * s).astype(np.float32) for s in [3000, 3000, -5000]]
+        expected = calc_inc_angle(dem, *lkv)
+        profile = dict(driver = 'GTiff', height = shape[0], width = shape[1], count = 1, dtype = 'float32',
+                       crs = 'EPSG:4326', transform = Affine(0.0001, 0, -108.2, 0, -0.0001, 39.1))
+        with tempfile.TemporaryDirectory() as tmp:
+            fps = []
+            for name, arr in zip(['dem', 'x', 'y', 'z'], [dem] + lkv):
+                fps.append(join(tmp, f'{name}.tif'))
+                with rio.open(fps[-1], 'w', **profile) as dst:
+                    dst.write(arr, 1)
+            for workers in [1, 3]:
+                out_fp = calc_inc_angle_tiff(*fps, join(tmp, f'inc_{workers}.tif'), tile_size = 16, workers = workers)
+                with rio.open(out_fp) as src:
+                    self.assertEqual(src.transform, profile['transform'])
+                    # Tiles read a halo so the result matches the whole array calculation
+                    np.testing.assert_array_equal(src.read(1), expected)
+
+if __name__ == '__main__':
+    unittest.main()
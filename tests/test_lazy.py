@@ -0,0 +1,53 @@
+import unittest
+import tempfile
+import pickle
+import numpy as np
+import dask.array as da
+
+from uavsar_pytools.lazy import open_uavsar
+from uavsar_pytools.convert.tiff_conversion import grd_tiff_convert
+from tests.test_tiff_conversion import write_insar_dir, BASE
+from tests.test_polsar import write_polsar_dir, random_stack
+
+class TestOpenUavsar(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_insar(self):
+        cor, inter = write_insar_dir(self.tmp.name)
+        ds = open_uavsar(self.tmp.name, chunks = 4)
+        self.assertEqual(sorted(ds.data_vars), ['cor', 'int'])
+        self.assertIsInstance(ds.cor.data, da.Array)
+        self.assertEqual(ds.cor.data.chunks[0], (4, 4, 1))
+        self.assertEqual(ds.int.dtype, np.complex64)
+        self.assertEqual(ds.rio.crs.to_epsg(), 4326)
+        self.assertAlmostEqual(float(ds.x[0]), -108.2 + 0.00005)
+        self.assertEqual(str(ds.time.values)[:19], '2021-02-11T18:01:55')
+        # Graphs only hold the path so they pickle without the data
+        self.assertLess(len(pickle.dumps(ds.cor.data.dask)), 4000)
+        arr = ds.cor.values
+        self.assertTrue(np.isnan(arr[0, 0]) and np.isnan(arr[1, 1]))
+        np.testing.assert_array_equal(arr[2:], cor[2:])
+        self.assertEqual(list(open_uavsar(self.tmp.name, products = ['int']).data_vars), ['int'])
+
+    def test_polsar(self):
+        stack = random_stack(6, 5)
+        write_polsar_dir(stack, self.tmp.name)
+        ds = open_uavsar(self.tmp.name, pols = ['HHHH', 'HVHV', 'VVVV'])
+        self.assertEqual(sorted(ds.data_vars), ['HHHH', 'HVHV', 'VVVV'])
+        self.assertEqual(ds.VVVV.dtype, np.float32)
+        np.testing.assert_allclose(ds.VVVV.values, stack[..., 5].real.astype(np.float32))
+
+    def test_tiffs(self):
+        cor, _ = write_insar_dir(self.tmp.name)
+        _, _, _, out_fp = grd_tiff_convert(f'{self.tmp.name}/{BASE}.cor.grd', self.tmp.name, overwrite = True)
+        ds = open_uavsar([out_fp])
+        self.assertEqual(list(ds.data_vars), ['cor'])
+        np.testing.assert_array_equal(ds.cor.values[2:], cor[2:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import tempfile
+from os.path import join, basename
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from uavsar_pytools.snow_depth_inversion import phase_from_depth, invert_stack
+from uavsar_pytools.phase_calibration import sample_raster, solve_offset, calibrate_pairs, apply_offset
+
+TRANSFORM = from_origin(-108, 39, 0.001, 0.001)
+
+def write_tiff(fp, arr):
+    with rio.open(fp, 'w', driver = 'GTiff', height = arr.shape[0], width = arr.shape[1], count = 1,
+                  dtype = arr.dtype, crs = 'EPSG:4326', transform = TRANSFORM, nodata = np.nan) as dst:
+        dst.write(arr, 1)
+
+def read_tiff(fp):
+    with rio.open(fp) as src:
+        return src.read(1)
+
+class TestPhaseCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.shape = (40, 70)
+        self.inc = np.broadcast_to(np.linspace(0.4, 1.0, 70, dtype = np.float32), self.shape).copy()
+        self.inc_fp = join(self.tmp.name, 'inc.tif')
+        write_tiff(self.inc_fp, self.inc)
+        self.offsets = [0.8, -1.5]
+        self.depths, self.phase_fps = [], []
+        for i, offset in enumerate(self.offsets):
+            depth = rng.uniform(-0.1, 0.2, self.shape).astype(np.float32)
+            phase = phase_from_depth(depth, self.inc, density = 250) - offset
+            self.phase_fps.append(join(self.tmp.name, f'pair_{i}_unw.tif'))
+            write_tiff(self.phase_fps[-1], phase)
+            self.depths.append(depth)
+        # Points at pixel centers
+        self.rows, self.cols = rng.integers(0, 40, 25), rng.integers(0, 70, 25)
+        self.xs, self.ys = TRANSFORM * (self.cols + 0.5, self.rows + 0.5)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_sample_raster(self):
+        xs = np.r_[self.xs, -109]
+        ys = np.r_[self.ys, 38.99]
+        values = sample_raster(self.inc_fp, xs, ys, tile_size = 16)
+        np.testing.assert_array_equal(values[:-1], self.inc[self.rows, self.cols])
+        # Points outside the raster are NaN
+        self.assertTrue(np.isnan(values[-1]))
+        # Median of a box around each point
+        values = sample_raster(self.inc_fp, xs, ys, radius = 1, tile_size = 16)
+        padded = np.pad(self.inc.astype(np.float64), 1, constant_values = np.nan)
+        boxes = np.stack([padded[self.rows + dr, self.cols + dc] for dr in range(3) for dc in range(3)])
+        np.testing.assert_allclose(values[:-1], np.nanmedian(boxes, axis = 0))
+        # Points in another crs are reprojected to the raster
+        utm = gpd.GeoDataFrame(geometry = gpd.points_from_xy(self.xs, self.ys), crs = 'EPSG:4326').to_crs('EPSG:32612')
+        values = sample_raster(self.inc_fp, utm.geometry.x, utm.geometry.y, crs = utm.crs)
+        np.testing.assert_array_equal(values, self.inc[self.rows, self.cols])
+
+    def test_calibrate(self):
+        phase = read_tiff(self.phase_fps[0])[self.rows, self.cols]
+        depth = self.depths[0][self.rows, self.cols]
+        inc = self.inc[self.rows, self.cols]
+        offset, n, residual = solve_offset(phase, depth, inc, density = 250)
+        self.assertAlmostEqual(offset, self.offsets[0], places = 4)
+        self.assertEqual(n, 25)
+        # One bad observation does not move the offset
+        depth[0] += 1
+        self.assertAlmostEqual(solve_offset(phase, depth, inc, density = 250)[0], self.offsets[0], places = 4)
+
+        # Pair ids where one is contained in the other are matched exactly
+        points = pd.concat([pd.DataFrame({'lon': self.xs, 'lat': self.ys, 'pair': pair,
+                                          'delta_sd': self.depths[i][self.rows, self.cols]}) for i, pair in enumerate([1, 10])])
+        points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points.lon, points.lat), crs = 'EPSG:4326')
+        offsets = calibrate_pairs(self.phase_fps, points, self.inc_fp, density = 250, pairs = [1, 10])
+        self.assertEqual(list(offsets.points), [25, 25])
+        np.testing.assert_allclose(offsets.offset, self.offsets, atol = 1e-4)
+        # Pair ids default to the file names without extensions
+        points['pair'] = np.where(points.pair == 1, 'pair_0_unw', 'pair_1_unw')
+        offsets = calibrate_pairs(self.phase_fps, points, self.inc_fp, density = 250)
+        self.assertEqual(list(offsets.pair), ['pair_0_unw', 'pair_1_unw'])
+        np.testing.assert_allclose(offsets.offset, self.offsets, atol = 1e-4)
+
+        # Calibrated phase inverts back to the true depth changes
+        out_fp = apply_offset(self.phase_fps[0], offsets.offset[0])
+        self.assertEqual(basename(out_fp), 'pair_0_unw.cal.tif')
+        expected = phase_from_depth(self.depths[0], self.inc, density = 250)
+        np.testing.assert_allclose(read_tiff(out_fp), expected, atol = 1e-4)
+        out_fps = invert_stack(self.phase_fps, self.inc_fp, join(self.tmp.name, 'out'), density = 250,
+                               offsets = offsets.offset)
+        for i in range(2):
+            np.testing.assert_allclose(read_tiff(out_fps['delta_z'][i]), self.depths[i], atol = 1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+import tempfile
+from os.path import join
+import numpy as np
+import rasterio as rio
+
+from uavsar_pytools.polsar import calc_C3, C3_to_T3, vectorized_calc_T3, \
+    decomp_components, vectorized_decomp_components, uavsar_H_A_alpha, \
+    get_polsar_stack, H_A_alpha_decomp, multilook, POLSAR_ORDER, COMPLEX_POLS
+
+ANN = """grd_pwr.set_rows                 (pixels)        = {rows}        ; ground rows
+grd_pwr.set_cols                 (pixels)        = {cols}        ; ground cols
+grd_pwr.row_addr                 (deg)           = 39.1          ; upper left lat
+grd_pwr.col_addr                 (deg)           = -108.2        ; upper left lon
+grd_pwr.row_mult                 (deg/pixel)     = -0.0001       ; lat spacing
+grd_pwr.col_mult                 (deg/pixel)     = 0.0001        ; lon spacing
+grd_pwr.val_size                 (bytes)         = 4             ; bytes per value
+grd_pwr.val_frmt                 (&)             = REAL*4        ; format
+val_endi                         (&)             = LITTLE ENDIAN ; byte order
+"""
+
+def write_polsar_dir(stack, out_dir):
+    """
+    Writes a stack as a directory of UAVSAR polsar .grd binaries with annotation.
+    """
+    rows, cols = stack.shape[:2]
+    base = 'grmesa_27416_21021_005_210211_L090{}_CX_01'
+    with open(join(out_dir, base.format('') + '.ann'), 'w') as f:
+        f.write(ANN.format(rows = rows, cols = cols))
+    for i, name in enumerate(POLSAR_ORDER):
+        dtype = np.complex64 if name in COMPLEX_POLS else np.float32
+        arr = stack[..., i] if name in COMPLEX_POLS else stack[..., i].real
+        arr.astype(dtype).tofile(join(out_dir, base.format(name) + '.grd'))
+
+def random_stack(rows, cols, looks = 8, seed = 0):
+    """
+    Builds a [rows x cols x 6] crossproduct stack from multi-looked random
+    scattering vectors so every pixel has a full rank covariance matrix.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (rows, cols, looks)
+    hh, hv, vv = [rng.normal(size = shape) + 1j*rng.normal(size = shape) for _ in range(3)]
+    hv *= 0.4
+    vv += 0.5*hh
+    stack = np.stack([
+        np.mean(hh*np.conjugate(hh), axis = -1).real,
+        np.mean(hh*np.conjugate(hv), axis = -1),
+        np.mean(hv*np.conjugate(hv), axis = -1).real,
+        np.mean(hv*np.conjugate(vv), axis = -1),
+        np.mean(hh*np.conjugate(vv), axis = -1),
+        np.mean(vv*np.conjugate(vv), axis = -1).real], axis = -1)
+    return stack.astype(np.complex128)
+
+class TestPolsar(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = random_stack(6, 5)
+
+    def test_calc_T3(self):
+        T3 = vectorized_calc_T3(self.stack)
+        for i, j in np.ndindex(self.stack.shape[:2]):
+            expected = C3_to_T3(calc_C3(*self.stack[i, j]))
+            np.testing.assert_allclose(T3[i, j], expected, atol = 1e-12)
+
+    def test_decomp_matches_per_pixel(self):
+        res = vectorized_decomp_components(self.stack)
+        for i, j in np.ndindex(self.stack.shape[:2]):
+            expected = decomp_components(self.stack[i, j])
+            for arr, value in zip(res, expected):
+                np.testing.assert_allclose(arr[i, j], value, rtol = 1e-6, atol = 1e-6)
+
+    def test_degenerate_anisotropy(self):
+        # Single scatterer pixels have two zero eigenvalues and undefined anisotropy
+        stack = self.stack.copy()
+        stack[0, 0] = [1, 0, 0, 0, 0, 0]
+        stack[0, 1] = [1, 0, 0, 0, 1, 1]
+        A = vectorized_decomp_components(stack)[1]
+        for j in range(2):
+            self.assertTrue(np.isnan(decomp_components(stack[0, j])[1]))
+            self.assertTrue(np.isnan(A[0, j]))
+        self.assertEqual(np.isnan(A).sum(), 2)
+
+    def test_nan_masking(self):
+        stack = self.stack.copy()
+        stack[1, 2, 3] = np.nan
+        H, A, alpha1, mean_alpha = uavsar_H_A_alpha(stack)
+        for arr in [H, A, alpha1, mean_alpha]:
+            self.assertTrue(np.isnan(arr[1, 2]))
+            self.assertEqual(np.isnan(arr).sum(), 1)
+
+    def test_no_mean_alpha(self):
+        res = uavsar_H_A_alpha(self.stack, mean_alpha = False)
+        self.assertEqual(len(res), 3)
+        self.assertEqual(res[0].shape, self.stack.shape[:2])
+
+    def test_multilook(self):
+        stack = random_stack(7, 5)
+        stack[0, 1, 2] = np.nan
+        looked = multilook(stack, (2, 3), block_rows = 2)
+        self.assertEqual(looked.shape, (4, 2, 6))
+        np.testing.assert_allclose(looked[1, 0], stack[2:4, 0:3].reshape(-1, 6).mean(axis = 0))
+        # Partial windows at the edges and pixels with NaN are left out of the means
+        np.testing.assert_allclose(looked[3, 1], stack[6, 3:5].mean(axis = 0))
+        np.testing.assert_allclose(looked[0, 0], np.delete(stack[0:2, 0:3].reshape(-1, 6), 1, axis = 0).mean(axis = 0))
+
+        sliding = multilook(stack, 3, mode = 'sliding', block_rows = 2)
+        self.assertEqual(sliding.shape, stack.shape)
+        np.testing.assert_allclose(sliding[3, 2], stack[2:5, 1:4].reshape(-1, 6).mean(axis = 0))
+        # CarSAR stacks have the crossproducts first
+        carsar = multilook(np.moveaxis(stack, -1, 0), (2, 3), channel_axis = 0)
+        np.testing.assert_allclose(np.moveaxis(carsar, 0, -1), looked)
+        with self.assertRaises(ValueError):
+            multilook(stack, 2, mode = 'median')
+
+class TestPolsarScene(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stack = random_stack(7, 5).astype(np.complex64)
+        self.stack[0, 0, 0] = 0
+        write_polsar_dir(self.stack, self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_polsar_stack(self):
+        stack, desc = get_polsar_stack(self.tmp.name)
+        self.assertEqual(stack.shape, (7, 5, 6))
+        self.assertTrue(np.isnan(stack[0, 0, 0]))
+        np.testing.assert_array_equal(stack[1:], self.stack[1:])
+        sub, _ = get_polsar_stack(self.tmp.name, bounds = (2, 5, 1, 3))
+        np.testing.assert_array_equal(sub, self.stack[2:5, 1:3])
+
+    def test_decomp_strips(self):
+        out_dir = join(self.tmp.name, 'out')
+        H_A_alpha_decomp(self.tmp.name, out_dir, block_rows = 3)
+        stack, _ = get_polsar_stack(self.tmp.name)
+        expected = uavsar_H_A_alpha(stack)
+        for name, arr in zip(['entropy', 'anisotropy', 'alpha1', 'mean_alpha'], expected):
+            with rio.open(join(out_dir, name)) as src:
+                np.testing.assert_allclose(src.read(1), arr, rtol = 1e-5)
+                self.assertAlmostEqual(src.transform.c, -108.2)
+
+    def test_decomp_multilook(self):
+        stack, _ = get_polsar_stack(self.tmp.name)
+        for mode, shape, res in [('decimate', (4, 3), 0.0002), ('sliding', (7, 5), 0.0001)]:
+            out_dir = join(self.tmp.name, mode)
+            H_A_alpha_decomp(self.tmp.name, out_dir, block_rows = 3, looks = 2, multilook_mode = mode)
+            expected = uavsar_H_A_alpha(multilook(stack, 2, mode = mode))
+            for name, arr in zip(['entropy', 'anisotropy', 'alpha1', 'mean_alpha'], expected):
+                with rio.open(join(out_dir, name)) as src:
+                    self.assertEqual(src.shape, shape)
+                    self.assertAlmostEqual(src.transform.a, res)
+                    self.assertAlmostEqual(src.transform.c, -108.2)
+                    np.testing.assert_allclose(src.read(1), arr, rtol = 1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+import os
+from os.path import join, exists
+import zipfile
+import numpy as np
+import rasterio as rio
+
+from uavsar_pytools import UavsarScene
+from tests.test_tiff_conversion import write_insar_dir, BASE
+
+class TestScene(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = join(self.tmp.name, 'bin_imgs')
+        os.makedirs(self.bin_dir)
+        self.cor, self.int = write_insar_dir(self.bin_dir)
+        self.url = f'https://unzip.asf.alaska.edu/INTERFEROMETRY_GRD/UA/{BASE}_int_grd.zip'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_binary_to_tiffs_workers(self):
+        images = []
+        for workers in [1, 2]:
+            scene = UavsarScene(self.url, self.tmp.name, clean = False, workers = workers)
+            scene.binary_to_tiffs(binary_dir = self.bin_dir)
+            self.assertEqual(list(scene.images.keys()), ['cor', 'int'])
+            self.assertTrue(exists(scene.images['cor']['out_fp']))
+            images.append(scene.images)
+        np.testing.assert_array_equal(images[0]['cor']['array'], images[1]['cor']['array'])
+
+    def test_stream_to_tiffs(self):
+        zip_fp = join(self.tmp.name, BASE + '_int_grd.zip')
+        with zipfile.ZipFile(zip_fp, 'w', compression = zipfile.ZIP_DEFLATED) as zip_file:
+            for f in os.listdir(self.bin_dir):
+                zip_file.write(join(self.bin_dir, f), arcname = f)
+        scene = UavsarScene(self.url, join(self.tmp.name, 'stream'), clean = False, stream = True)
+        scene.zipped_fp = zip_fp
+        scene.tmp_dir = join(self.tmp.name, 'stream', 'tmp', scene.pair_name)
+        scene.zip_to_tiffs()
+        self.assertEqual(list(scene.images.keys()), ['cor', 'int'])
+        # No binaries are extracted, only the annotation
+        self.assertEqual(os.listdir(join(scene.tmp_dir, 'bin_imgs')), [BASE + '.ann'])
+        with rio.open(scene.images['cor']['out_fp']) as src:
+            arr = src.read(1)
+            self.assertAlmostEqual(src.transform.c, -108.2)
+        self.assertTrue(np.isnan(arr[0, 0]))
+        np.testing.assert_array_equal(arr[2:], self.cor[2:])
+        with rio.open(scene.images['int']['out_fp']) as src:
+            arr = src.read(1)
+        self.assertTrue(np.isnan(arr[2, 3]))
+        np.testing.assert_array_equal(arr[3:], self.int[3:])
+        self.assertTrue(exists(join(scene.out_dir, scene.pair_name + '.csv')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+import tempfile
+from os.path import join, basename
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from uavsar_pytools.snow_depth_inversion import depth_from_phase, phase_from_depth, permittivity_from_density, geometry_term, invert_stack
+
+def write_tiff(fp, arr):
+    with rio.open(fp, 'w', driver = 'GTiff', height = arr.shape[0], width = arr.shape[1], count = 1,
+                  dtype = arr.dtype, crs = 'EPSG:4326', transform = from_origin(-108, 39, 0.001, 0.001)) as dst:
+        dst.write(arr, 1)
+
+def expected_scalar(phase, inc, perm):
+    return -phase * 0.238403545 / (4 * np.pi * (np.cos(inc) - np.sqrt(perm - np.sin(inc)**2)))
+
+def read_tiff(fp):
+    with rio.open(fp) as src:
+        return src.read(1)
+
+class TestSnowDepthInversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.inc = rng.uniform(0.3, 1.1, (30, 20)).astype(np.float32)
+        self.density = rng.uniform(150, 400, (30, 20)).astype(np.float32)
+        self.phases = [rng.uniform(-2, 2, (30, 20)).astype(np.float32) for i in range(3)]
+        self.phases[1][4, 5] = np.nan
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_arrays(self):
+        # Arrays are valid inputs for permittivity and density
+        perm = permittivity_from_density(self.density)
+        depth = depth_from_phase(self.phases[0], self.inc, permittivity = perm)
+        np.testing.assert_allclose(depth_from_phase(self.phases[0], self.inc, density = self.density), depth)
+        np.testing.assert_allclose(phase_from_depth(depth, self.inc, permittivity = perm), self.phases[0], rtol = 1e-4)
+        with self.assertRaises(ValueError):
+            depth_from_phase(self.phases[0], self.inc)
+        with self.assertRaises(ValueError):
+            permittivity_from_density(self.density, method = 'unknown')
+
+    def test_fused(self):
+        # Blocked float32 kernels match the closed form in float64
+        inc, density = self.inc.astype(np.float64), self.density.astype(np.float64)
+        perm = permittivity_from_density(density)
+        phase = self.phases[1].astype(np.float64)
+        expected = (-phase * 0.238403545) / (4 * np.pi * (np.cos(inc) - np.sqrt(perm - np.sin(inc)**2)))
+        with mock.patch('uavsar_pytools.snow_depth_inversion._BLOCK', 50):
+            depth = depth_from_phase(phase, inc, density = density)
+        self.assertEqual(depth.dtype, np.float32)
+        np.testing.assert_allclose(depth, expected, rtol = 1e-5)
+
+        # A precomputed geometry term skips the incidence angle and permittivity
+        geometry = geometry_term(inc, density = density)
+        out = np.empty(phase.shape, dtype = np.float32)
+        self.assertIs(depth_from_phase(phase, None, geometry = geometry, out = out), out)
+        np.testing.assert_allclose(out, expected, rtol = 1e-5)
+        np.testing.assert_allclose(phase_from_depth(out, None, geometry = geometry), phase, rtol = 1e-4, atol = 1e-6)
+
+        # Scalars give scalars and validation can be skipped
+        self.assertAlmostEqual(float(depth_from_phase(1, 0.5, permittivity = 1.5)), expected_scalar(1, 0.5, 1.5), places = 6)
+        with self.assertRaises(ValueError):
+            depth_from_phase(phase, np.rad2deg(inc), permittivity = 1.5)
+        depth_from_phase(phase, np.rad2deg(inc), permittivity = 1.5, validate = False)
+
+    def test_invert_stack(self):
+        phase_fps = []
+        for i, phase in enumerate(self.phases):
+            phase_fps.append(join(self.tmp.name, f'pair_{i}.unw.tif'))
+            write_tiff(phase_fps[-1], phase)
+        inc_fp, density_fp = join(self.tmp.name, 'inc.tif'), join(self.tmp.name, 'density.tif')
+        write_tiff(inc_fp, self.inc)
+        write_tiff(density_fp, self.density)
+
+        expected = [depth_from_phase(phase, self.inc, density = self.density) for phase in self.phases]
+        for workers in [1, 2]:
+            out_dir = join(self.tmp.name, f'out_{workers}')
+            out_fps = invert_stack(phase_fps, inc_fp, out_dir, density = density_fp, tile_size = 8, workers = workers)
+            self.assertEqual(basename(out_fps['cumulative_z'][1]), 'pair_1.unw.cumulative_z.tif')
+            results = {name: [read_tiff(fp) for fp in fps] for name, fps in out_fps.items()}
+            for i in range(3):
+                np.testing.assert_allclose(results['delta_z'][i], expected[i], rtol = 1e-5)
+                np.testing.assert_allclose(results['cumulative_z'][i], np.sum(expected[:i + 1], axis = 0), rtol = 1e-4, atol = 1e-6)
+                np.testing.assert_allclose(results['swe'][i], results['cumulative_z'][i] * self.density / 1000, rtol = 1e-4, atol = 1e-6)
+            # No data carries through to later dates
+            self.assertFalse(np.isnan(results['cumulative_z'][0][4, 5]))
+            self.assertTrue(np.isnan(results['swe'][2][4, 5]))
+
+        # Constant inputs and permittivity without density
+        out_fps = invert_stack(phase_fps, 0.5, join(self.tmp.name, 'const'), permittivity = 1.5)
+        self.assertEqual(out_fps['swe'], [])
+        with rio.open(out_fps['delta_z'][0]) as src:
+            np.testing.assert_allclose(src.read(1), depth_from_phase(self.phases[0], 0.5, permittivity = 1.5), rtol = 1e-5)
+        with self.assertRaises(ValueError):
+            invert_stack(phase_fps, [inc_fp], self.tmp.name, density = 250)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+import tempfile
+import os
+import pickle
+import re
+from os.path import join
+import numpy as np
+import rasterio as rio
+
+from uavsar_pytools.convert.tiff_conversion import grd_tiff_convert, read_annotation
+from uavsar_pytools.convert.binary_reader import annotation_dtype
+from uavsar_pytools.convert.annotation import Annotation
+
+ANN = """; Sample insar annotation
+Start Time of Acquisition for Pass 1     (&)        = 11-Feb-2021 18:01:55 UTC   ; pass 1 start
+Stop Time of Acquisition for Pass 1      (&)        = 11-Feb-2021 18:07:12 UTC   ; pass 1 stop
+val_endi                                 (&)        = LITTLE ENDIAN              ; byte order
+grd.set_rows                             (pixels)   = {rows}                     ; rows
+grd.set_cols                             (pixels)   = {cols}                     ; cols
+grd.row_addr                             (deg)      = 39.1                       ; upper left lat
+grd.col_addr                             (deg)      = -108.2                     ; upper left lon
+grd.row_mult                             (deg/pixel)= -0.0001                    ; lat spacing
+grd.col_mult                             (deg/pixel)= 0.0001                     ; lon spacing
+grd.val_size                             (bytes)    = 4                          ; bytes per value
+grd.val_frmt                             (&)        = REAL*4                     ; format
+grd_phs.set_rows                         (pixels)   = {rows}                     ; rows
+grd_phs.set_cols                         (pixels)   = {cols}                     ; cols
+grd_phs.row_addr                         (deg)      = 39.1                       ; upper left lat
+grd_phs.col_addr                         (deg)      = -108.2                     ; upper left lon
+grd_phs.row_mult                         (deg/pixel)= -0.0001                    ; lat spacing
+grd_phs.col_mult                         (deg/pixel)= 0.0001                     ; lon spacing
+grd_phs.val_size                         (bytes)    = 8                          ; bytes per value
+grd_phs.val_frmt                         (&)        = COMPLEX*8                  ; format
+"""
+
+BASE = 'grmesa_27416_21019-017_21021-005_0006d_s01_L090HH_01'
+
+def write_insar_dir(out_dir, rows = 9, cols = 4, seed = 0):
+    """
+    Writes a small insar scene (annotation, coherence and interferogram binaries).
+    """
+    rng = np.random.default_rng(seed)
+    with open(join(out_dir, BASE + '.ann'), 'w') as f:
+        f.write(ANN.format(rows = rows, cols = cols))
+    cor = rng.random((rows, cols)).astype(np.float32)
+    cor[0, 0] = 0
+    cor[1, 1] = -10000
+    cor.tofile(join(out_dir, BASE + '.cor.grd'))
+    inter = (rng.normal(size = (rows, cols)) + 1j*rng.normal(size = (rows, cols))).astype(np.complex64)
+    inter[2, 3] = 0
+    inter.tofile(join(out_dir, BASE + '.int.grd'))
+    return cor, inter
+
+class TestTiffConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cor, self.int = write_insar_dir(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_annotation(self):
+        desc = read_annotation(join(self.tmp.name, BASE + '.ann'))
+        self.assertEqual(desc['grd.set_rows']['value'], 9)
+        self.assertEqual(desc['grd.row_mult']['units'], 'deg/pixel')
+        self.assertEqual(desc['grd.val_frmt']['value'], 'REAL*4')
+        self.assertEqual(desc['grd.set_cols']['comment'], 'cols')
+        self.assertEqual(desc['val_endi']['units'], '&')
+        self.assertEqual(desc['val_endi']['value'], 'LITTLE ENDIAN')
+        self.assertNotIn('; sample insar annotation', desc)
+        t = desc['start time of acquisition for pass 1']['value']
+        self.assertEqual((t.year, t.month, t.day, t.hour), (2021, 2, 11, 11))
+        self.assertEqual(str(t.tzinfo), 'US/Mountain')
+
+    def test_annotation_cache(self):
+        ann_fp = join(self.tmp.name, BASE + '.ann')
+        desc = read_annotation(ann_fp)
+        self.assertIsInstance(desc, Annotation)
+        self.assertIs(read_annotation(ann_fp), desc)
+        # Entries are read only so callers can not change the cached annotation
+        with self.assertRaises(TypeError):
+            desc['grd.set_rows']['value'] = 0
+        editable = desc.to_dict()
+        editable['grd.set_rows']['value'] = 0
+        self.assertEqual(read_annotation(ann_fp)['grd.set_rows']['value'], 9)
+        # Modified files are parsed again
+        with open(ann_fp, 'a') as f:
+            f.write('extra (m) = 1.5 ; new\n')
+        os.utime(ann_fp, ns = (0, os.stat(ann_fp).st_mtime_ns + 10**9))
+        new = read_annotation(ann_fp)
+        self.assertIsNot(new, desc)
+        self.assertEqual(new['extra'], {'value': 1.5, 'units': 'm', 'comment': 'new'})
+        self.assertEqual(pickle.loads(pickle.dumps(new)).to_dict(), new.to_dict())
+
+    def test_convert_cor(self):
+        for return_array in [True, False]:
+            desc, z, type, out_fp = grd_tiff_convert(join(self.tmp.name, BASE + '.cor.grd'), self.tmp.name,
+                                overwrite = True, return_array = return_array, block_rows = 2)
+            self.assertEqual(type, 'cor')
+            with rio.open(out_fp) as src:
+                arr = src.read(1)
+                self.assertAlmostEqual(src.transform.c, -108.2)
+                # The default profile is written without a nodata tag as before
+                self.assertIsNone(src.nodata)
+            self.assertTrue(np.isnan(arr[0, 0]))
+            self.assertTrue(np.isnan(arr[1, 1]))
+            np.testing.assert_array_equal(arr[2:], self.cor[2:])
+            if return_array:
+                np.testing.assert_array_equal(z, arr)
+            else:
+                self.assertIsNone(z)
+
+    def test_convert_int(self):
+        desc, z, type, out_fp = grd_tiff_convert(join(self.tmp.name, BASE + '.int.grd'), self.tmp.name,
+                                overwrite = True, return_array = False, block_rows = 4)
+        with rio.open(out_fp) as src:
+            arr = src.read(1)
+        self.assertEqual(arr.dtype, np.complex64)
+        self.assertTrue(np.isnan(arr[2, 3]))
+        np.testing.assert_array_equal(arr[3:], self.int[3:])
+
+    def test_convert_slope(self):
+        # Slopes hold east and north REAL*4 values per pixel so val_size is 8 bytes
+        slope_ann = re.sub(r'(slope.val_size.*= )4', r'\g<1>8', ANN.replace('grd.', 'slope.'))
+        with open(join(self.tmp.name, BASE + '.ann'), 'w') as f:
+            f.write(slope_ann.format(rows = 9, cols = 4))
+        desc = read_annotation(join(self.tmp.name, BASE + '.ann'))
+        self.assertEqual(desc['slope.val_size']['value'], 8)
+        self.assertEqual(annotation_dtype(desc, 'slope', bands = 2), np.dtype('<f4'))
+        slope = np.random.default_rng(1).normal(size = (9, 4, 2)).astype(np.float32)
+        # Flat pixels are valid slopes and only -10000 is nodata
+        slope[2, 1] = 0
+        slope[5, 3, 1] = -10000
+        slope.tofile(join(self.tmp.name, BASE + '.slope'))
+
+        desc, z, type, fps = grd_tiff_convert(join(self.tmp.name, BASE + '.slope'), self.tmp.name,
+                                              overwrite = True, return_array = False, block_rows = 4)
+        self.assertEqual(type, 'slope')
+        for fp, direction, band in zip(fps, ['east', 'north'], [0, 1]):
+            self.assertTrue(fp.endswith(f'.{direction}.tiff'))
+            with rio.open(fp) as src:
+                self.assertEqual(src.dtypes[0], 'float32')
+                expected = np.where(slope[..., band] == -10000, np.nan, slope[..., band])
+                np.testing.assert_array_equal(src.read(1), expected)
+                self.assertEqual(src.read(1)[2, 1], 0)
+
+    def test_convert_cog(self):
+        cor, inter = write_insar_dir(self.tmp.name, rows = 600, cols = 520)
+        profile = {'profile': 'cog', 'blocksize': 256, 'quantize': True}
+        for name in ['cor', 'int']:
+            desc, z, type, out_fp = grd_tiff_convert(join(self.tmp.name, f'{BASE}.{name}.grd'), self.tmp.name,
+                                    overwrite = True, return_array = False, block_rows = 100, tiff_profile = profile)
+            self.assertFalse(os.path.exists(out_fp + '.tmp.tif'))
+            with rio.open(out_fp) as src:
+                self.assertEqual(src.tags(ns = 'IMAGE_STRUCTURE')['LAYOUT'], 'COG')
+                self.assertEqual(src.compression.name, 'deflate')
+                # Horizontal differencing for int16 coherence and none for complex values
+                self.assertEqual(src.tags(ns = 'IMAGE_STRUCTURE').get('PREDICTOR'), '2' if name == 'cor' else None)
+                self.assertEqual(src.block_shapes[0], (256, 256))
+                self.assertTrue(src.overviews(1))
+                arr = src.read(1, masked = True)
+                nodata, scale = src.nodata, src.scales[0]
+            if name == 'cor':
+                # Coherence is stored as scaled int16 with a nodata tag
+                self.assertEqual(arr.dtype, np.int16)
+                self.assertEqual(nodata, -32768)
+                self.assertTrue(arr.mask[0, 0] and arr.mask[1, 1])
+                np.testing.assert_allclose(arr[2:].data * scale, cor[2:], atol = scale)
+            else:
+                self.assertEqual(arr.dtype, np.complex64)
+                np.testing.assert_array_equal(arr[3:], inter[3:])
+
+        # Listed overview factors are kept in the COG
+        profile = {'profile': 'cog', 'blocksize': 256, 'overviews': [3, 9]}
+        desc, z, type, out_fp = grd_tiff_convert(join(self.tmp.name, f'{BASE}.cor.grd'), self.tmp.name,
+                                overwrite = True, return_array = False, block_rows = 100, tiff_profile = profile)
+        with rio.open(out_fp) as src:
+            self.assertEqual(src.tags(ns = 'IMAGE_STRUCTURE')['LAYOUT'], 'COG')
+            self.assertEqual(src.overviews(1), [3, 9])
+            self.assertEqual(src.tags(ns = 'IMAGE_STRUCTURE')['PREDICTOR'], '3')
+            self.assertTrue(np.isnan(src.nodata))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import tempfile
+import os
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from uavsar_pytools import UavsarScene
+from uavsar_pytools.zarr_store import UavsarZarr, zarr
+from tests.test_tiff_conversion import write_insar_dir, BASE
+
+def write_tiff(fp, arr, transform):
+    with rio.open(fp, 'w', driver = 'GTiff', height = arr.shape[0], width = arr.shape[1], count = 1,
+                  dtype = arr.dtype, crs = 'EPSG:4326', transform = transform, nodata = np.nan) as dst:
+        dst.write(arr, 1)
+
+def append_tiff(store_fp, i, fp):
+    # Later appends are earlier dates so the store is not in time order
+    return UavsarZarr(store_fp, chunks = 4, time_chunks = 2).append(f'pair_{i}', {'cor': fp}, t = f'2020-02-{10 - i:02d}T18:00Z')
+
+@unittest.skipIf(zarr is None, 'zarr is not installed')
+class TestZarrStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store_fp = join(self.tmp.name, 'uavsar.zarr')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_scene(self):
+        bin_dir = join(self.tmp.name, 'bin_imgs')
+        os.makedirs(bin_dir)
+        cor, _ = write_insar_dir(bin_dir)
+        url = f'https://unzip.asf.alaska.edu/INTERFEROMETRY_GRD/UA/{BASE}_int_grd.zip'
+        scene = UavsarScene(url, self.tmp.name, clean = False, zarr_store = self.store_fp)
+        scene.binary_to_tiffs(binary_dir = bin_dir)
+        self.assertEqual(scene.zarr_store.append_scene(scene), 0)
+        # Scenes already in the store are skipped
+        self.assertIsNone(scene.zarr_store.append_scene(scene))
+
+        ds = scene.zarr_store.open()
+        self.assertEqual(ds['data'].dims, ('time', 'band', 'y', 'x'))
+        # A pixel's time series of a season is a single chunk by default
+        self.assertEqual(ds['data'].encoding['chunks'][0], 16)
+        # Complex interferograms are skipped
+        self.assertEqual(list(ds.band.values), ['cor'])
+        self.assertEqual(str(ds.time.values[0])[:19], '2021-02-11T18:01:55')
+        self.assertAlmostEqual(float(ds.x[0]), -108.2 + 0.00005)
+        attrs = ds.attrs['scenes'][scene.pair_name]
+        self.assertTrue(attrs['complete'])
+        self.assertEqual(attrs['annotation']['grd.set_rows']['value'], 9)
+        arr = ds['data'].values[0, 0]
+        self.assertTrue(np.isnan(arr[0, 0]))
+        np.testing.assert_array_equal(arr[2:], cor[2:])
+
+    def test_new_bands(self):
+        rng = np.random.default_rng(1)
+        cor, hgt = rng.random((2, 6, 8)).astype(np.float32)
+        transform = from_origin(-108, 39, 0.001, 0.001)
+        for name, arr in [('cor', cor), ('hgt', hgt)]:
+            write_tiff(join(self.tmp.name, f'{name}.tif'), arr, transform)
+        store = UavsarZarr(self.store_fp, chunks = 4)
+        store.append('pair_0', {'cor': join(self.tmp.name, 'cor.tif')}, t = '2020-02-01T18:00Z')
+        # Bands of later scenes are added instead of dropped
+        store.append('pair_1', {'hgt': join(self.tmp.name, 'hgt.tif'), 'cor': join(self.tmp.name, 'cor.tif')},
+                     t = '2020-02-08T18:00Z')
+
+        ds = store.open()
+        self.assertEqual(list(ds.band.values), ['cor', 'hgt'])
+        data = ds['data'].values
+        np.testing.assert_array_equal(data[:, 0], [cor, cor])
+        self.assertTrue(np.isnan(data[0, 1]).all())
+        np.testing.assert_array_equal(data[1, 1], hgt)
+
+    def test_parallel_append(self):
+        rng = np.random.default_rng(0)
+        fps, arrs = [], []
+        for i in range(4):
+            arr = rng.random((10, 12)).astype(np.float32)
+            fps.append(join(self.tmp.name, f'{i}.tif'))
+            # Later scenes are offset by i pixels to the east of the grid of the first
+            write_tiff(fps[-1], arr, from_origin(-108 + i * 0.001, 39, 0.001, 0.001))
+            arrs.append(arr)
+        self.assertEqual(append_tiff(self.store_fp, 0, fps[0]), 0)
+        with ProcessPoolExecutor(max_workers = 3) as executor:
+            indexes = list(executor.map(append_tiff, [self.store_fp] * 3, range(1, 4), fps[1:]))
+        self.assertEqual(sorted(indexes), [1, 2, 3])
+        self.assertFalse(os.path.exists(self.store_fp + '.lock'))
+
+        ds = UavsarZarr(self.store_fp).open()
+        self.assertEqual(ds['data'].shape, (4, 1, 10, 12))
+        self.assertEqual(ds['data'].encoding['chunks'][0], 2)
+        # Opened sorted by time whatever order the appends finished in
+        self.assertTrue(ds.indexes['time'].is_monotonic_increasing)
+        for i in range(4):
+            arr = ds['data'].sel(time = f'2020-02-{10 - i:02d}').values[0, 0]
+            np.testing.assert_array_equal(arr[:, i:], arrs[i][:, :12 - i])
+            self.assertTrue(np.isnan(arr[:, :i]).all())
+
+if __name__ == '__main__':
+    unittest.main()
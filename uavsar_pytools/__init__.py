@@ -2,6 +2,9 @@
 from .uavsar_image import UavsarImage
 from .uavsar_scene import UavsarScene
 from .uavsar_collection import UavsarCollection
+from .catalog import UavsarCatalog
+from .lazy import open_uavsar
+from .zarr_store import UavsarZarr
 
 
 # Version of the package
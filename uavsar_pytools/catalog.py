@@ -0,0 +1,293 @@
+"""
+SQLite catalog of downloaded and converted UAVSAR products. Scenes are indexed as
+they are converted so what is on disk can be queried by bounding box, date range,
+flight line and product without walking the directory tree or searching ASF again.
+"""
+
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from os.path import basename, dirname, expanduser, abspath
+from datetime import datetime, timezone
+import pandas as pd
+import rasterio
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    pair_name TEXT PRIMARY KEY,
+    url TEXT,
+    out_dir TEXT,
+    site TEXT,
+    flight_line TEXT,
+    start_time TEXT,
+    stop_time TEXT,
+    min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+    footprint TEXT,
+    indexed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    out_fp TEXT PRIMARY KEY,
+    pair_name TEXT REFERENCES scenes(pair_name) ON DELETE CASCADE,
+    product TEXT,
+    polarization TEXT,
+    min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    pair_name TEXT REFERENCES scenes(pair_name) ON DELETE CASCADE,
+    key TEXT,
+    value TEXT,
+    units TEXT,
+    comment TEXT,
+    PRIMARY KEY (pair_name, key)
+);
+CREATE INDEX IF NOT EXISTS scenes_time ON scenes (start_time);
+CREATE INDEX IF NOT EXISTS scenes_line ON scenes (flight_line);
+CREATE INDEX IF NOT EXISTS scenes_bbox ON scenes (min_lon, max_lon, min_lat, max_lat);
+CREATE INDEX IF NOT EXISTS images_scene ON images (pair_name);
+CREATE INDEX IF NOT EXISTS images_product ON images (product);
+"""
+
+# Annotation keys of the scene corners
+CORNERS = ['upper left', 'upper right', 'lower right', 'lower left']
+
+# Annotation keys of the acquisition start and stop (in order of preference)
+TIME_KEYS = [('start time of acquisition for pass 1', ['stop time of acquisition for pass 2', 'stop time of acquisition for pass 1']),
+             ('start time of acquisition', ['stop time of acquisition']),
+             ('date of acquisition', ['date of acquisition'])]
+
+def _utc_iso(dt):
+    """
+    Converts a datetime (or string) to an ISO 8601 UTC string so times sort and compare as text.
+    """
+    dt = pd.to_datetime(dt)
+    if dt.tzinfo is None:
+        dt = dt.tz_localize('UTC')
+    return dt.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S')
+
+def scene_times(desc):
+    """
+    Returns the start and stop acquisition time of a scene from its annotation as UTC ISO strings.
+    """
+    for start_key, stop_keys in TIME_KEYS:
+        if start_key in desc:
+            stop_keys = [k for k in stop_keys if k in desc]
+            try:
+                start = _utc_iso(desc[start_key]['value'])
+                stop = _utc_iso(desc[stop_keys[0]]['value']) if stop_keys else start
+            except (ValueError, TypeError):
+                log.warning(f'Unable to parse acquisition time {desc[start_key]["value"]}')
+                return None, None
+            return start, stop
+    return None, None
+
+def scene_footprint(desc):
+    """
+    Returns the footprint polygon of a scene from the approximate corner coordinates
+    in its annotation.
+
+    Args:
+        desc (dict): annotation description
+    Returns:
+        corners (list): (lon, lat) of the corners or None if the annotation has no corners
+    """
+    corners = []
+    for corner in CORNERS:
+        lat = desc.get(f'approximate {corner} latitude')
+        lon = desc.get(f'approximate {corner} longitude')
+        if lat is None or lon is None:
+            return None
+        corners.append((float(lon['value']), float(lat['value'])))
+    return corners
+
+def _polygon_wkt(corners):
+    ring = corners + corners[:1]
+    return 'POLYGON ((' + ', '.join(f'{lon} {lat}' for lon, lat in ring) + '))'
+
+def _bounds(corners):
+    lons, lats = zip(*corners)
+    return min(lons), min(lats), max(lons), max(lats)
+
+def _polarization(name, type):
+    """
+    Polarization from the image type (polsar) or the file name (insar, e.g. L090HH).
+    """
+    if re.fullmatch('[HV]{4}', str(type)):
+        return type
+    match = re.search(r'_L\d{3}([HV]{2})', basename(name))
+    return match.group(1) if match else None
+
+class UavsarCatalog():
+    """
+    Local SQLite catalog of converted UAVSAR scenes, their images and annotations.
+
+    Args:
+        db_fp (str): path to the SQLite database. Created if it doesn't exist.
+
+    Methods:
+        add_scene(scene): index a converted UavsarScene
+        add_images(...): index a scene from its annotation and output geotiffs
+        query(...): find images by bounding box, date range, flight line, product and polarization
+        scenes(...): find scenes with the same filters
+        annotation(pair_name): annotation of an indexed scene
+    """
+
+    def __init__(self, db_fp):
+        self.db_fp = abspath(expanduser(db_fp))
+        os.makedirs(dirname(self.db_fp), exist_ok = True)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # One connection per call so a catalog can be shared between threads
+        con = sqlite3.connect(self.db_fp, timeout = 60)
+        try:
+            con.execute('PRAGMA foreign_keys = ON')
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def add_scene(self, scene):
+        """
+        Index a converted UavsarScene.
+
+        Args:
+            scene (UavsarScene): scene after zip_to_tiffs or binary_to_tiffs
+        """
+        images = [(img['out_fp'], img['type']) for img in scene.images.values()]
+        desc = next(iter(scene.images.values()))['description'] if scene.images else {}
+        self.add_images(scene.pair_name, desc, images, url = scene.url, out_dir = getattr(scene, 'out_dir', None))
+
+    def add_images(self, pair_name, desc, images, url = None, out_dir = None):
+        """
+        Index a scene from its annotation and output geotiffs. Re-indexing a scene replaces it.
+
+        Args:
+            pair_name (str): name of the scene (zip file name without extension)
+            desc (dict): annotation description of the scene
+            images (list): (out_fp, type) pairs. out_fp may be a list (e.g. slope east and north).
+            url (str): url the scene was downloaded from [Default = None]
+            out_dir (str): directory of the geotiffs [Default = None]
+        """
+        start, stop = scene_times(desc)
+        rows = []
+        for out_fps, type in images:
+            for out_fp in (out_fps if isinstance(out_fps, (list, tuple)) else [out_fps]):
+                try:
+                    with rasterio.open(out_fp) as src:
+                        bounds = tuple(src.bounds) if src.crs else (None,) * 4
+                except rasterio.errors.RasterioIOError:
+                    log.warning(f'Unable to read {out_fp}. Indexing without bounds.')
+                    bounds = (None,) * 4
+                rows.append((abspath(out_fp), pair_name, type, _polarization(out_fp, type)) + bounds)
+
+        corners = scene_footprint(desc)
+        if corners:
+            footprint = _polygon_wkt(corners)
+            bounds = _bounds(corners)
+        else:
+            # Fall back to the union of the image bounds
+            boxes = [r[4:] for r in rows if r[4] is not None]
+            if boxes:
+                bounds = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+                west, south, east, north = bounds
+                footprint = _polygon_wkt([(west, north), (east, north), (east, south), (west, south)])
+            else:
+                bounds, footprint = (None,) * 4, None
+
+        parts = pair_name.split('_')
+        site = parts[0]
+        flight_line = parts[1] if len(parts) > 1 else None
+        annotations = [(pair_name, key, str(entry['value']), entry['units'], entry['comment']) for key, entry in desc.items()]
+
+        with self._connect() as con:
+            con.execute('DELETE FROM scenes WHERE pair_name = ?', (pair_name,))
+            con.execute('INSERT INTO scenes VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', (pair_name, url, out_dir and abspath(out_dir), \
+                site, flight_line, start, stop) + tuple(bounds) + (footprint, datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')))
+            con.executemany('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?,?,?)', rows)
+            con.executemany('INSERT OR REPLACE INTO annotations VALUES (?,?,?,?,?)', annotations)
+        log.info(f'Indexed {pair_name} with {len(rows)} images')
+
+    def _where(self, bbox = None, start = None, end = None, flight_line = None):
+        clauses, params = [], []
+        if bbox is not None:
+            # Scenes whose bounding box intersects the requested one
+            min_lon, min_lat, max_lon, max_lat = bbox
+            clauses.append('s.max_lon >= ? AND s.min_lon <= ? AND s.max_lat >= ? AND s.min_lat <= ?')
+            params += [min_lon, max_lon, min_lat, max_lat]
+        if start is not None:
+            clauses.append('COALESCE(s.stop_time, s.start_time) >= ?')
+            params.append(_utc_iso(start))
+        if end is not None:
+            clauses.append('s.start_time <= ?')
+            params.append(_utc_iso(end))
+        if flight_line is not None:
+            clauses.append('s.flight_line = ?')
+            params.append(str(flight_line))
+        return clauses, params
+
+    def scenes(self, bbox = None, start = None, end = None, flight_line = None):
+        """
+        Find indexed scenes.
+
+        Args:
+            bbox (tuple): (min_lon, min_lat, max_lon, max_lat) the scenes must intersect [Default = None]
+            start (str or datetime): scenes acquired on or after this time [Default = None]
+            end (str or datetime): scenes acquired on or before this time [Default = None]
+            flight_line (str): flight line id, e.g. '27416' [Default = None]
+        Returns:
+            df (DataFrame): one row per scene
+        """
+        clauses, params = self._where(bbox, start, end, flight_line)
+        sql = 'SELECT * FROM scenes s' + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + ' ORDER BY s.start_time'
+        with self._connect() as con:
+            return pd.read_sql_query(sql, con, params = params)
+
+    def query(self, bbox = None, start = None, end = None, flight_line = None, product = None, pol = None):
+        """
+        Find indexed images.
+
+        Args:
+            bbox (tuple): (min_lon, min_lat, max_lon, max_lat) the scenes must intersect [Default = None]
+            start (str or datetime): scenes acquired on or after this time [Default = None]
+            end (str or datetime): scenes acquired on or before this time [Default = None]
+            flight_line (str): flight line id, e.g. '27416' [Default = None]
+            product (str or list): image types, e.g. 'unw' or ['cor', 'int'] [Default = None]
+            pol (str or list): polarizations, e.g. 'VV' [Default = None]
+        Returns:
+            df (DataFrame): one row per image with its scene name, times and geotiff path
+        """
+        clauses, params = self._where(bbox, start, end, flight_line)
+        for column, values in [('i.product', product), ('i.polarization', pol)]:
+            if values is not None:
+                values = [values] if isinstance(values, str) else list(values)
+                clauses.append(f'{column} IN ({",".join("?" * len(values))})')
+                params += values
+        sql = 'SELECT i.out_fp, i.pair_name, i.product, i.polarization, s.flight_line, s.start_time, s.stop_time, ' \
+            'i.min_lon, i.min_lat, i.max_lon, i.max_lat FROM images i JOIN scenes s ON i.pair_name = s.pair_name'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY s.start_time, i.out_fp'
+        with self._connect() as con:
+            return pd.read_sql_query(sql, con, params = params)
+
+    def annotation(self, pair_name):
+        """
+        Returns the annotation of an indexed scene as a dictionary of dictionaries. Values are strings.
+        """
+        with self._connect() as con:
+            rows = con.execute('SELECT key, value, units, comment FROM annotations WHERE pair_name = ?', (pair_name,)).fetchall()
+        return {key: {'value': value, 'units': units, 'comment': comment} for key, value, units, comment in rows}
+
+    def remove(self, pair_name):
+        """
+        Remove a scene, its images and annotation from the catalog. Files are not deleted.
+        """
+        with self._connect() as con:
+            con.execute('DELETE FROM scenes WHERE pair_name = ?', (pair_name,))
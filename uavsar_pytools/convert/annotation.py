@@ -0,0 +1,166 @@
+"""
+Parser for UAVSAR annotation (.ann) files. Lines are matched with a single precompiled
+regex, acquisition times are only converted to datetimes when they are accessed and
+parsed files are memoized by path and modification time.
+"""
+
+import os
+import re
+from collections.abc import Mapping
+from functools import lru_cache
+from types import MappingProxyType
+import pandas as pd
+import pytz
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Number of parsed annotation files kept in memory
+ANNOTATION_CACHE_SIZE = 128
+
+# `key (units) = value ; comment`. Units are the first parenthesized group before the '='.
+_LINE = re.compile(r'^(?P<key>[^=(;]*)(?:\((?P<units>[^)]*)\))?[^=;]*=(?P<value>[^=;]*)')
+
+# Keys holding acquisition times. Converted to US/Mountain datetimes on access.
+TIME_KEYS = frozenset([f'{timing} time of acquisition{suffix}' for timing in ['start', 'stop']
+                       for suffix in ['', ' for pass 1', ' for pass 2']])
+
+def _cast(value):
+    """
+    Casts values that look numeric to floats (with a decimal) or integers.
+    """
+    if value.strip('-').replace('.', '').isnumeric():
+        if '.' in value:
+            return float(value)
+        return int(value)
+    return value
+
+class Annotation(Mapping):
+    """
+    Read only description of a UAVSAR image from its annotation file. Indexing with a
+    key returns a read only mapping with the value, units and comment of that entry, so
+    `desc['grd.set_rows']['value']` works as it did with the old dictionary of dictionaries.
+    Assigning to an entry raises a TypeError. Use to_dict for an editable copy.
+
+    Args:
+        entries (dict): key -> (value, units, comment) as parsed from the annotation file
+    """
+
+    __slots__ = ('_entries', '_times')
+
+    def __init__(self, entries):
+        self._entries = entries
+        self._times = {}
+
+    def __getstate__(self):
+        return self._entries
+
+    def __setstate__(self, entries):
+        self._entries = entries
+        self._times = {}
+
+    def __getitem__(self, key):
+        _, units, comment = self._entries[key]
+        return MappingProxyType({'value': self.value(key), 'units': units, 'comment': comment})
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return f'Annotation({len(self)} entries)'
+
+    def value(self, key, default = None):
+        """
+        Returns the value of key (datetime for acquisition times) or default if missing.
+        """
+        if key not in self._entries:
+            return default
+        if key in TIME_KEYS:
+            if key not in self._times:
+                dt = pd.to_datetime(self._entries[key][0])
+                self._times[key] = dt.astimezone(pytz.timezone('US/Mountain'))
+            return self._times[key]
+        return self._entries[key][0]
+
+    def units(self, key):
+        """
+        Returns the units of key or None if the entry has no units.
+        """
+        return self._entries[key][1]
+
+    def comment(self, key):
+        """
+        Returns the comment of key.
+        """
+        return self._entries[key][2]
+
+    def to_dict(self):
+        """
+        Returns the annotation as a dictionary of dictionaries (e.g. for pd.DataFrame).
+        """
+        return {key: dict(self[key]) for key in self._entries}
+
+def parse_annotation(text):
+    """
+    Parses the text of an annotation file.
+
+    Args:
+        text (str): contents of a UAVSAR annotation file
+    Returns:
+        desc (Annotation): parsed annotation
+    """
+    entries = {}
+    match = _LINE.match
+    for line in text.splitlines():
+        line = line.strip()
+        m = match(line)
+        if m is None:
+            continue
+        key = m.group('key').strip().lower()
+        # Everything after the last ';' is the comment
+        comment = line.rsplit(';', 1)[-1].strip().lower()
+        entries[key] = (_cast(m.group('value').strip()), m.group('units'), comment)
+    return Annotation(entries)
+
+@lru_cache(maxsize = ANNOTATION_CACHE_SIZE)
+def _read_cached(ann_file, mtime_ns, size):
+    with open(ann_file) as fp:
+        return parse_annotation(fp.read())
+
+def read_annotation(ann_file):
+    """
+    .ann files describe the INSAR data. Use this function to read all that
+    information in and return it as a dictionary like Annotation.
+    Originally written by Micah J. Amended for uavsar_pytools by Zach Keskinen.
+
+    Expected format:
+    `DEM Original Pixel spacing (arcsec) = 1`
+    Where this is interpretted as:
+    `key (units) = [value]`
+    Then stored in the annotation as:
+    `data[key] = {'value':value, 'units':units, 'comment':comment}`
+    values that are found to be numeric and have a decimal are converted to a
+    float otherwise numeric data is cast as integers. Acquisition times are converted
+    to datetimes, including the pass 1 and pass 2 times of interferograms which
+    were previously left as strings. Everything else is left as strings.
+
+    Files are only parsed again if they have been modified and the same Annotation
+    is returned to every caller, so entries are read only and writing to one (e.g.
+    `data[key]['value'] = x`) raises a TypeError instead of changing the shared copy.
+    Use data.to_dict() for an editable dictionary of dictionaries.
+
+    Args:
+        ann_file: path to UAVSAR annotation file
+    Returns:
+        data: Annotation with a dictionary for each entry with keys
+              for value, units and comments
+    """
+    st = os.stat(ann_file)
+    return _read_cached(os.path.abspath(ann_file), st.st_mtime_ns, st.st_size)
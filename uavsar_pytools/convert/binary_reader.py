@@ -0,0 +1,88 @@
+"""
+Memory mapped readers for UAVSAR binary images. Binaries are mapped lazily with
+np.memmap so windows of rows can be read (and NaN masked) without loading the
+whole image into memory.
+"""
+
+import re
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Values marking no data in UAVSAR binaries (see the UAVSAR format documentation)
+NODATA_VALUES = (0, -10000)
+
+def annotation_dtype(desc, search, bands = 1):
+    """
+    Builds the numpy dtype of a binary image from its annotation. The value type
+    comes from val_frmt (e.g. REAL*4 or COMPLEX*8). val_size is bytes per pixel,
+    so it only cross-checks the dtype against the number of interleaved bands.
+
+    Args:
+        desc (dict): annotation description from read_annotation
+        search (string): annotation search key of the image (e.g. 'grd_pwr')
+        bands (int): number of pixel interleaved values per pixel (e.g. 2 for slopes)
+    Returns:
+        dtype (np.dtype): dtype with the byte order given by val_endi
+    """
+    frmt = str(desc[f'{search}.val_frmt']['value']).upper()
+    kind = 'c' if 'COMPLEX' in frmt else 'f'
+    size = re.search(r'\*\s*(\d+)', frmt)
+    size = int(size.group(1)) if size else (8 if kind == 'c' else 4)
+    endian = '<'
+    if 'val_endi' in desc.keys() and 'BIG' in str(desc['val_endi']['value']).upper():
+        endian = '>'
+    dtype = np.dtype(f'{endian}{kind}{size}')
+
+    if f'{search}.val_size' in desc.keys():
+        val_size = int(desc[f'{search}.val_size']['value'])
+        if val_size != dtype.itemsize * bands:
+            log.warning(f'{search}.val_size of {val_size} bytes does not match {bands} band(s) of {frmt}.')
+    return dtype
+
+def open_binary(in_fp, shape, dtype, bands = 1):
+    """
+    Memory maps a UAVSAR binary image. No data is read until the map is indexed.
+
+    Args:
+        in_fp (string): path to binary file
+        shape (tuple): number of rows and columns of the image
+        dtype (np.dtype): dtype of each value (see annotation_dtype)
+        bands (int): number of pixel interleaved values per pixel (e.g. 2 for slopes)
+    Returns:
+        mm (np.memmap): array of size [rows x cols] or [rows x cols x bands]
+    """
+    nrows, ncols = shape
+    full_shape = (nrows, ncols) if bands == 1 else (nrows, ncols, bands)
+    return np.memmap(in_fp, dtype = dtype, mode = 'r', shape = full_shape)
+
+def read_window(mm, rows = None, cols = None, nodata = NODATA_VALUES):
+    """
+    Reads a window of a memory mapped binary into memory and sets no data values to NaN.
+    Only the requested rows are read from disk.
+
+    Args:
+        mm (np.memmap): output of open_binary
+        rows (slice): rows to read [Default = all]
+        cols (slice): columns to read [Default = all]
+        nodata (tuple): values to replace with NaN [Default = 0 and -10000]
+    Returns:
+        arr (np.array): native byte order copy of the window
+    """
+    rows = slice(None) if rows is None else rows
+    cols = slice(None) if cols is None else cols
+    window = mm[rows, cols]
+    arr = window.astype(window.dtype.newbyteorder('='))
+    for value in nodata:
+        arr[arr == value] = np.nan
+    return arr
+
+def iter_row_blocks(nrows, block_rows):
+    """
+    Yields slices covering nrows rows in blocks of block_rows rows.
+    """
+    block_rows = max(1, int(block_rows))
+    for start in range(0, nrows, block_rows):
+        yield slice(start, min(start + block_rows, nrows))
@@ -5,6 +5,7 @@ File control functions for uavsar_pytools.
 from zipfile import ZipFile
 from tqdm import tqdm
 import os
+from threading import Lock
 from os.path import exists, join
 
 import logging
@@ -12,7 +13,30 @@ log = logging.getLogger(__name__)
 logging.basicConfig()
 log.setLevel(logging.DEBUG)
 
-def unzip(dir_path, out_dir, pols = None):
+def select_members(names, pols = None, products = None):
+    """
+    Filters zip member names by polarization and product. Annotation files are
+    always kept as they are needed for conversion.
+
+    Args:
+        names (list) - member names of a zip file
+        pols (list) - polarizations to keep (e.g. ['VV']) [Default = all]
+        products (list) - product extensions to keep (e.g. ['unw', 'cor']) [Default = all]
+    Returns:
+        names (list) - member names that match
+    """
+    selected = []
+    for name in names:
+        if name.endswith('/'):
+            continue
+        exts = os.path.basename(name).split('.')[1:]
+        if 'ann' in exts:
+            selected.append(name)
+        elif (not pols or any(pol in name for pol in pols)) and (not products or any(p in exts for p in products)):
+            selected.append(name)
+    return selected
+
+def unzip(dir_path, out_dir, pols = None, products = None):
     """
     Function to extract zipped directory with tqdm progress bar.
     From: https://stackoverflow.com/questions/4006970/monitor-zip-file-extraction-python.
@@ -20,18 +44,16 @@ def unzip(dir_path, out_dir, pols = None):
     Args:
         dir_path (string) - path to zipped directory to unpack
         out_dir (string) - path to directory to extract files to.
+        pols (list) - polarizations to extract [Default = all]
+        products (list) - product extensions to extract, e.g. ['unw', 'cor'] [Default = all]
     """
     assert exists(dir_path), f'Zipped directory at {dir_path} not found.'
 
     # Open your .zip file
     with ZipFile(file=dir_path) as zip_file:
 
-        if pols:
-            pol_list = [s for s in zip_file.namelist() if any(xs in s for xs in pols)]
-            checked_list = [f for f in pol_list if not exists(join(out_dir, f))]
-        else:
-            pol_list = zip_file.namelist()
-            checked_list = [f for f in pol_list if not exists(join(out_dir, f))]
+        pol_list = select_members(zip_file.namelist(), pols = pols, products = products)
+        checked_list = [f for f in pol_list if not exists(join(out_dir, f))]
 
 
         # Loop over each file
@@ -42,4 +64,37 @@ def unzip(dir_path, out_dir, pols = None):
         else:
             log.info('No files found to unzip. Check if polarizations exist.')
 
-    return [join(out_dir, fp) for fp in pol_list]
\ No newline at end of file
+    return [join(out_dir, fp) for fp in pol_list]
+
+
+_manifest_lock = Lock()
+
+def read_manifest(manifest_fp):
+    """
+    Reads the names recorded as completed in a manifest file.
+
+    Args:
+        manifest_fp (string) - path to manifest file. One name per line.
+    Returns:
+        names (set) - completed names. Empty if the manifest does not exist yet.
+    """
+    if not exists(manifest_fp):
+        return set()
+    with open(manifest_fp) as f:
+        return set(line.strip() for line in f if line.strip())
+
+def append_manifest(manifest_fp, name):
+    """
+    Records a name as completed in a manifest file. Safe to call from multiple threads
+    and flushed to disk immediately so a crashed run can be resumed.
+
+    Args:
+        manifest_fp (string) - path to manifest file
+        name (string) - name to record (e.g. a pair name)
+    """
+    with _manifest_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_fp)), exist_ok = True)
+        with open(manifest_fp, 'a') as f:
+            f.write(name + '\n')
+            f.flush()
+            os.fsync(f.fileno())
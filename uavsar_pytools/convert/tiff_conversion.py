@@ -9,13 +9,18 @@ from re import L
 from matplotlib.pyplot import polar
 from tqdm import tqdm
 import numpy as np
-import pandas as pd
-import pytz
 import rasterio
 from rasterio.transform import Affine
 from rasterio.crs import CRS
+from rasterio.windows import Window
 from pyproj import Geod, Proj
+from zipfile import ZipFile
 import logging
+from uavsar_pytools.convert.file_control import select_members
+from uavsar_pytools.convert.annotation import read_annotation
+from uavsar_pytools.convert.binary_reader import annotation_dtype, open_binary, read_window, \
+    iter_row_blocks, NODATA_VALUES
+from uavsar_pytools.convert.tiff_profile import TiffWriter
 
 log = logging.getLogger(__name__)
 logging.basicConfig()
@@ -58,82 +63,159 @@ def get_encapsulated(str_line, encapsulator):
 
     return result
 
-def read_annotation(ann_file):
+def _split_extensions(in_fp):
     """
-    .ann files describe the INSAR data. Use this function to read all that
-    information in and return it as a dictionary
-    Originally written by Micah J. Amended for uavsar_pytools by Zach Keskinen.
+    Splits a UAVSAR file name into its image type and extension (e.g. 'unw', 'grd').
+    """
+    exts = basename(in_fp).split('.')[1:]
+    if len(exts) == 2:
+        ext = exts[1]
+        type = exts[0]
+    elif len(exts) == 1:
+        type = ext = exts[0]
+    else:
+        raise ValueError('Unable to parse extensions')
+    return type, ext
+
+def _check_convertible(type):
+    """
+    Raises an exception for products that can not be converted to geotiffs.
+    """
+    if type == 'zip':
+        raise Exception('Can not convert zipped directories. Unzip first.')
+    if type == 'dat' or type == 'kmz' or type == 'kml' or type == 'png' or type == 'tif':
+        raise Exception(f'Can not handle {type} products')
+    if type == 'ann':
+        raise Exception(f'Can not convert annotation files.')
+
+def image_search(in_fp, desc, type, ext):
+    """
+    Determines the annotation search key of a binary image.
 
-    Expected format:
-    `DEM Original Pixel spacing (arcsec) = 1`
-    Where this is interpretted as:
-    `key (units) = [value]`
-    Then stored in the dictionary as:
-    `data[key] = {'value':value, 'units':units}`
-    values that are found to be numeric and have a decimal are converted to a
-    float otherwise numeric data is cast as integers. Everything else is left
-    as strings.
     Args:
-        ann_file: path to UAVSAR annotation file
+        in_fp (string): path or name of the binary image
+        desc (dict): annotation description from read_annotation
+        type (string): image type from the file name (e.g. 'unw')
+        ext (string): image extension from the file name (e.g. 'grd')
     Returns:
-        data: Dictionary containing a dictionary for each entry with keys
-              for value, units and comments
+        search (string): annotation search key (e.g. 'grd_phs')
+        type (string): image type. Polarization for polsar images.
+        anc (bool): True for ancillary slope and incidence angle images
     """
+    # Check for slant range files and ancillary files
+    anc = None
+    if type == 'slope' or type == 'inc':
+        anc = True
+        log.info(f'Identified as ancillary')
+
+    if 'start time of acquisition for pass 1' in desc.keys():
+        mode = 'insar'
+    else:
+        mode = 'polsar'
+    log.info(f'Working with {mode}')
+
+    # Determine the correct file typing for searching our data dictionary
+    if not anc:
+        if mode == 'polsar':
+            if type == 'hgt':
+                search = type
+            else:
+                polarization = basename(in_fp).split('_')[5][-4:]
+                if polarization == 'HHHH' or polarization == 'HVHV' or polarization == 'VVVV':
+                        search = f'{type}_pwr'
+                else:
+                    search = f'{type}_phase'
+                type = polarization
 
-    with open(ann_file) as fp:
-        lines = fp.readlines()
-        fp.close()
-    data = {}
-
-    # loop through the data and parse
-    for line in lines:
-
-        # Filter out all comments and remove any line returns
-        info = line.strip().split(';')
-        comment = info[-1].strip().lower()
-        info = info[0]
-        # ignore empty strings
-        if info and "=" in info:
-            d = info.split('=')
-            name, value = d[0], d[1]
-            # Clean up tabs, spaces and line returns
-            key = name.split('(')[0].strip().lower()
-            units = get_encapsulated(name, '()')
-            if not units:
-                units = None
+        elif mode == 'insar':
+            if ext == 'grd':
+                if type == 'int':
+                    search = f'grd_phs'
+                else:
+                    search = 'grd'
             else:
-                units = units[0]
+                if type == 'int':
+                    search = 'slt_phs'
+                else:
+                    search = 'slt'
+    else:
+        if type == 'inc':
+            search = 'hgt'
+        search = type
 
-            value = value.strip()
+    log.debug(f'Searching with: {search}')
+    return search, type, anc
 
-            # Cast the values that can be to numbers ###
-            if value.strip('-').replace('.', '').isnumeric():
-                if '.' in value:
-                    value = float(value)
-                else:
-                    value = int(value)
-
-            # Assign each entry as a dictionary with value and units
-            data[key] = {'value': value, 'units': units, 'comment': comment}
-
-    # Convert times to datetimes
-    if 'start time of acquistion for pass 1' in data.keys():
-        for pass_num in ['1', '2']:
-            for timing in ['start', 'stop']:
-                key = f'{timing} time of acquisition for pass {pass_num}'
-                dt = pd.to_datetime(data[key]['value'])
-                dt = dt.astimezone(pytz.timezone('US/Mountain'))
-                data[key]['value'] = dt
-    elif 'start time of acquisition' in data.keys():
-        for timing in ['start', 'stop']:
-                key = f'{timing} time of acquisition'
-                dt = pd.to_datetime(data[key]['value'])
-                dt = dt.astimezone(pytz.timezone('US/Mountain'))
-                data[key]['value'] = dt
-
-    return data
-
-def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug = False):
+def _binary_layout(desc, search, type, ext, anc, out_fp):
+    """
+    Pulls the shape, data type and output geotiff profile of a binary image from its annotation.
+
+    Returns:
+        shape (tuple): rows and columns of the image
+        dtype (np.dtype): dtype of the binary values
+        nodata (tuple): values to set to NaN
+        profile (dict): rasterio profile of the output geotiffs
+        bands (list): index of each output in the last axis of the image (None for single band)
+        fps (list): output geotiff paths
+    """
+    # Pull the appropriate values from our annotation dictionary
+    nrow = desc[f'{search}.set_rows']['value']
+    ncol = desc[f'{search}.set_cols']['value']
+    log.debug(f'rows: {nrow} x cols: {ncol} pixels')
+
+    # Get data type specific data. Slopes are pixel interleaved east and north values
+    dtype = annotation_dtype(desc, search, bands = 2 if type == 'slope' else 1)
+    log.debug(f'Data type = {dtype}, Endian = {desc["val_endi"]["value"]}')
+    # Change zeros and -10,000 to nans based on documentation. Zero is a valid slope.
+    if dtype.kind == 'c':
+        nodata = (0,)
+    elif type == 'slope':
+        nodata = (-10000,)
+    else:
+        nodata = NODATA_VALUES
+
+    profile = dict(driver='GTiff', height=nrow, width=ncol, count=1, dtype=dtype.newbyteorder('='))
+    if ext == 'grd' or anc:
+        # Ground projected images
+        t, crs = grd_geotransform(desc, search)
+        profile.update(crs=crs, transform=t)
+
+    # Slopes are pixel interleaved east and north values
+    if type == 'slope':
+        bands = [0, 1]
+        fps = [out_fp.replace('.tiff',f'.{direction}.tiff') for direction in ['east', 'north']]
+    else:
+        bands = [None]
+        fps = [out_fp]
+
+    return (nrow, ncol), dtype, nodata, profile, bands, fps
+
+def _write_blocks(fps, bands, profile, blocks, tiff_profile = None, product = None):
+    """
+    Writes blocks of rows to one geotiff per band.
+
+    Args:
+        fps (list): output geotiff paths
+        bands (list): index of each output in the last axis of the blocks (None for single band)
+        profile (dict): rasterio profile of the output geotiffs
+        blocks (iterable): (row slice, array) pairs covering the image
+        tiff_profile (str or dict): output profile, see tiff_profile.resolve_profile [Default = plain geotiff]
+        product (str): image type used to pick a quantization (e.g. 'cor') [Default = None]
+    """
+    writers = []
+    try:
+        for fp in fps:
+            writers.append(TiffWriter(fp, profile, tiff_profile, product))
+        for rows, block in blocks:
+            window = Window(0, rows.start, profile['width'], rows.stop - rows.start)
+            for writer, band in zip(writers, bands):
+                writer.write(block if band is None else block[..., band], window = window)
+    finally:
+        for writer in writers:
+            writer.close()
+
+def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug = False, return_array = True, block_rows = 1024,
+                     tiff_profile = None):
     """
     Converts a single binary image either polsar or insar to geotiff.
     See: https://uavsar.jpl.nasa.gov/science/documents/polsar-format.html for polsar
@@ -145,6 +227,16 @@ def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug =
         in_fp (string): path to input binary file
         out_dir (string): directory to save geotiff in
         ann_fp (string): path to UAVSAR annotation file
+        return_array (bool): read the whole image into memory and return it [Default = True].
+            If False the binary is converted in blocks of rows and None is returned as the array.
+        block_rows (int): number of rows per block when return_array is False [Default = 1024]
+        tiff_profile (str or dict): output layout and compression. 'tiled', 'cog' or a dictionary
+            of options (see tiff_profile.resolve_profile) [Default = untiled and uncompressed]
+    Returns:
+        desc (dict): annotation description
+        z (np.array): image array (None if return_array is False). Slopes are [rows x cols x 2].
+        type (string): type of the image
+        out_fp (string): path to geotiff (list of east and north paths for slopes)
     """
 
     if debug:
@@ -161,14 +253,7 @@ def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug =
     if not exists(in_fp):
         raise Exception(f'Input file path: {in_fp} does not exist.')
 
-    exts = basename(in_fp).split('.')[1:]
-    if len(exts) == 2:
-        ext = exts[1]
-        type = exts[0]
-    elif len(exts) == 1:
-        type = ext = exts[0]
-    else:
-        raise ValueError('Unable to parse extensions')
+    type, ext = _split_extensions(in_fp)
     log.info(f'Extenstion: {ext}, type : {type}')
     
     # Find annotation file in same directory if no user given one
@@ -190,18 +275,8 @@ def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug =
             log.info(f'No annotation file path specificed. Using f{ann_fp}.')
 
     # Check for compatible extensions
-    if type == 'zip':
-        raise Exception('Can not convert zipped directories. Unzip first.')
-    if type == 'dat' or type == 'kmz' or type == 'kml' or type == 'png' or type == 'tif':
-        raise Exception(f'Can not handle {type} products')
-    if type == 'ann':
-        raise Exception(f'Can not convert annotation files.')
+    _check_convertible(type)
 
-    # Check for slant range files and ancillary files
-    anc = None
-    if type == 'slope' or type == 'inc':
-        anc = True
-        log.info(f'Identified as ancillary')
     # Check if file already exists and for overwriting
     ans = 'N'
     if exists(out_fp):
@@ -219,159 +294,155 @@ def grd_tiff_convert(in_fp, out_dir, ann_fp = None, overwrite = 'user', debug =
 
         # Read in annotation file
         desc = read_annotation(ann_fp)
-        #pd.DataFrame.from_dict(desc).to_csv('../data/test.csv')
-        if 'start time of acquisition for pass 1' in desc.keys():
-            mode = 'insar'
-        else:
-            mode = 'polsar'
-        log.info(f'Working with {mode}')
-
-        # Determine the correct file typing for searching our data dictionary
-        if not anc:
-            if mode == 'polsar':
-                if type == 'hgt':
-                    search = type
-                else:
-                    polarization = basename(in_fp).split('_')[5][-4:]
-                    if polarization == 'HHHH' or polarization == 'HVHV' or polarization == 'VVVV':
-                            search = f'{type}_pwr'
-                    else:
-                        search = f'{type}_phase'
-                    type = polarization
-
-            elif mode == 'insar':
-                if ext == 'grd':
-                    if type == 'int':
-                        search = f'grd_phs'
-                    else:
-                        search = 'grd'
-                else:
-                    if type == 'int':
-                        search = 'slt_phs'
-                    else:
-                        search = 'slt'
-        else:
-            if type == 'inc':
-                search = 'hgt'
-            search = type
-
-        log.debug(f'Searching with: {search}')
-
-        # Pull the appropriate values from our annotation dictionary
-        nrow = desc[f'{search}.set_rows']['value']
-        ncol = desc[f'{search}.set_cols']['value']
-        log.debug(f'rows: {nrow} x cols: {ncol} pixels')
-
-        if ext == 'grd' or anc:
-            # Ground projected images
-            # Delta latitude and longitude
-            dlat = desc[f'{search}.row_mult']['value']
-            dlon = desc[f'{search}.col_mult']['value']
-            log.debug(f'latitude delta: {dlat}, longitude delta: {dlon} deg/pixel')
-            # Upper left corner coordinates
-            lat1 = desc[f'{search}.row_addr']['value']
-            lon1 = desc[f'{search}.col_addr']['value']
-            log.debug(f'Ref Latitude: {lat1}, Longitude: {lon1} degrees')
-
-            # Lat1/lon1 are already the center so for geotiff were good to go.
-            t = Affine.translation(float(lon1), float(lat1))* Affine.scale(float(dlon), float(dlat))
-
-            # Build the transform and CRS
-            crs = CRS.from_user_input("EPSG:4326")
-
-        # Get data type specific data
-        bytes = desc[f'{search}.val_size']['value']
-        endian = desc['val_endi']['value']
-        log.debug(f'Bytes = {bytes}, Endian = {endian}')
-
-        # Set up datatypes
-        com_des = desc[f'{search}.val_frmt']['value']
-        com = False
-        if 'COMPLEX' in com_des:
-            com = True
-        log.debug(f'Complex descriptor {com_des}')
-        if com:
-            dtype = np.complex64
+        search, type, anc = image_search(in_fp, desc, type, ext)
+        shape, dtype, nodata, profile, bands, fps = _binary_layout(desc, search, type, ext, anc, out_fp)
+        nrow = shape[0]
+
+        # Memory map binary data with the shape the text file says the image is
+        mm = open_binary(in_fp, shape, dtype, bands = 2 if type == 'slope' else 1)
+
+        if return_array:
+            z = read_window(mm, nodata = nodata)
+            blocks = [(slice(0, nrow), z)]
         else:
-            dtype = np.float32
-        log.debug(f'Data type = {dtype}')
-        # Read in binary data
-        z = np.fromfile(in_fp, dtype = dtype)
+            z = None
+            blocks = ((rows, read_window(mm, rows = rows, nodata = nodata)) for rows in iter_row_blocks(nrow, block_rows))
+
+        log.debug(f'Writing to {fps}...')
+        _write_blocks(fps, bands, profile, blocks, tiff_profile, product = type)
+        del mm
+        if 'crs' in profile:
+            log.info('Finished converting image to WGS84 Geotiff.')
 
-        # Reshape it to match what the text file says the image is
         if type == 'slope':
-            z[z==-10000]= np.nan
-            slopes = {}
-            slopes['east'] = z[::2].reshape(nrow, ncol)
-            slopes['north'] = z[1::2].reshape(nrow, ncol)
-        else:
-            slopes = None
-            z = z.reshape(nrow, ncol)
+            return desc, z, type, fps
+        return desc, z, type, out_fp
 
+def pair_annotations(binary_fps, ann_fps, ann_fp = None):
+    """
+    Pairs each binary image with its annotation file. Polsar and insar zips can
+    hold one annotation per polarization, otherwise the first annotation is used.
 
-        # Change zeros and -10,000 to nans based on documentation.
-        if com:
-            z[z== 0 + 0*1j] = np.nan + np.nan * 1j
-        else:
-            z[z==0]= np.nan
-            z[z==-10000]= np.nan
-
-        if slopes:
-            slope_fps = []
-            for direction, array in slopes.items():
-                slope_fp = out_fp.replace('.tiff',f'.{direction}.tiff')
-                log.debug(f'Writing to {slope_fp}...')
-                dataset = rasterio.open(
-                slope_fp,
-                'w+',
-                driver='GTiff',
-                height=array.shape[0],
-                width=array.shape[1],
-                count=1,
-                dtype=dtype,
-                crs=crs,
-                transform=t,)
-                # Write out the data
-                dataset.write(array, 1)
-
-                dataset.close()
-                slope_fps.append(slope_fp)
-            return desc, z, type, slope_fps
-        else:
-            log.debug(f'Writing to {out_fp}...')
-
-            if ext == 'grd' or anc:
-                dataset = rasterio.open(
-                    out_fp,
-                    'w+',
-                    driver='GTiff',
-                    height=z.shape[0],
-                    width=z.shape[1],
-                    count=1,
-                    dtype=dtype,
-                    crs=crs,
-                    transform=t,)
-                log.info('Finished converting image to WGS84 Geotiff.')
+    Args:
+        binary_fps (list): binary image paths or zip member names
+        ann_fps (list): annotation paths or zip member names
+        ann_fp (string): annotation to use for every image [Default = None]
+    Returns:
+        jobs (list): (binary, annotation) pairs in sorted binary order
+    """
+    pols = ['VV','VH','HV','HH']
+    ann_dic = {}
+    if not ann_fp:
+        for pol in pols:
+            ann_pol = [fp for fp in ann_fps if pol in fp]
+            if ann_pol:
+                ann_dic[pol] = ann_pol[0]
+
+        if not ann_fps:
+            log.warning('No annotation file found for binary files.')
+
+    jobs = []
+    for f in sorted(binary_fps):
+        f_ann = ann_fp
+        if len(ann_dic) > 0:
+            f_pol = [pol for pol in pols if pol in basename(f)][0]
+            f_ann = ann_dic[f_pol]
+        if not f_ann:
+            f_ann = ann_fps[0]
+        jobs.append((f, f_ann))
+    return jobs
+
+def _stream_blocks(src, shape, dtype, bands, nodata, block_rows):
+    """
+    Decodes blocks of rows from a binary stream (e.g. a zip member) without seeking.
+    """
+    nrow, ncol = shape
+    row_shape = (ncol,) if bands == 1 else (ncol, bands)
+    row_bytes = ncol * bands * dtype.itemsize
+    for rows in iter_row_blocks(nrow, block_rows):
+        n = rows.stop - rows.start
+        buf = src.read(n * row_bytes)
+        if len(buf) != n * row_bytes:
+            raise ValueError(f'Binary ended after {rows.start} rows. Expected {nrow} rows.')
+        block = np.frombuffer(buf, dtype = dtype).reshape((n,) + row_shape)
+        yield rows, read_window(block, nodata = nodata)
+
+def zip_tiff_convert(zip_fp, out_dir, ann_dir = None, pols = None, products = None, overwrite = True,
+                     debug = False, block_rows = 1024, tiff_profile = None):
+    """
+    Converts the binary images of a UAVSAR zip file to geotiffs without extracting them.
+    Each member is decompressed as a stream and written to its geotiff in blocks of rows,
+    so only the annotation files are written to disk besides the geotiffs.
+
+    Args:
+        zip_fp (string): path to zip file (or a seekable file object of one)
+        out_dir (string): directory to save geotiffs in
+        ann_dir (string): directory to extract annotation files into [Default = out_dir]
+        pols (list): polarizations to convert [Default = all]
+        products (list): product extensions to convert, e.g. ['unw', 'cor'] [Default = all]
+        overwrite (bool): overwrite existing geotiffs [Default = True]
+        block_rows (int): number of rows decoded per block [Default = 1024]
+        tiff_profile (str or dict): output layout and compression as in grd_tiff_convert [Default = None]
+    Returns:
+        results (list): (desc, None, type, out_fp) for each image as from grd_tiff_convert
+    """
+    if debug:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARNING)
+
+    if not ann_dir:
+        ann_dir = out_dir
+    for d in [out_dir, ann_dir]:
+        os.makedirs(d, exist_ok = True)
+
+    results = []
+    with ZipFile(zip_fp) as zip_file:
+        members = select_members(zip_file.namelist(), pols = pols, products = products)
+        ann_members = [m for m in members if m.endswith('.ann')]
+        # Annotations are small and parsed first to get the geometry of each binary
+        ann_fps = {}
+        for member in ann_members:
+            ann_fps[member] = join(ann_dir, basename(member))
+            with zip_file.open(member) as src, open(ann_fps[member], 'wb') as dst:
+                dst.write(src.read())
+        descs = {}
+
+        bin_members = [m for m in members if m not in ann_members]
+        for member, ann_member in tqdm(pair_annotations(bin_members, ann_members), unit = 'file', desc = 'Converting'):
+            type, ext = _split_extensions(member)
+            _check_convertible(type)
+            out_fp = join(out_dir, basename(member)) + '.tiff'
+
+            if ann_member not in descs:
+                descs[ann_member] = read_annotation(ann_fps[ann_member])
+            desc = descs[ann_member]
+            search, type, anc = image_search(member, desc, type, ext)
+            shape, dtype, nodata, profile, bands, fps = _binary_layout(desc, search, type, ext, anc, out_fp)
+
+            if all(exists(fp) for fp in fps) and not overwrite:
+                log.info(f'{fps} already exist. Skipping.')
             else:
-                dataset = rasterio.open(
-                    out_fp,
-                    'w+',
-                    driver='GTiff',
-                    height=z.shape[0],
-                    width=z.shape[1],
-                    count=1,
-                    dtype=dtype,)
-            # Write out the data
-            dataset.write(z, 1)
-
-            dataset.close()
+                log.debug(f'Streaming {member} to {fps}...')
+                with zip_file.open(member) as src:
+                    blocks = _stream_blocks(src, shape, dtype, len(bands) if type == 'slope' else 1, nodata, block_rows)
+                    _write_blocks(fps, bands, profile, blocks, tiff_profile, product = type)
 
-        return desc, z, type, out_fp
+            results.append((desc, None, type, fps if type == 'slope' else out_fp))
 
-def array_to_tiff(arr, out_fp, desc, type):
-    # Pull the appropriate values from our annotation dictionary
-    nrow = desc[f'{type}.set_rows']['value']
-    ncol = desc[f'{type}.set_cols']['value']
+    return results
+
+def grd_geotransform(desc, type):
+    """
+    Builds the WGS84 geotransform of a ground projected image from its annotation.
+
+    Args:
+        desc (dict): annotation description from read_annotation
+        type (string): annotation search key of the image (e.g. 'grd_pwr')
+    Returns:
+        t (Affine): geotransform of the image
+        crs (CRS): WGS84 coordinate reference system
+    """
     # Pixel spacing
     dlat = desc[f'{type}.row_mult']['value']
     dlon = desc[f'{type}.col_mult']['value']
@@ -382,19 +453,23 @@ def array_to_tiff(arr, out_fp, desc, type):
     t = Affine.translation(float(lon1), float(lat1))* Affine.scale(float(dlon), float(dlat))
     # Build the transform and CRS
     crs = CRS.from_user_input("EPSG:4326")
+    return t, crs
 
-    dataset = rasterio.open(
-        out_fp,
-        'w+',
-        driver='GTiff',
-        height=arr.shape[0],
-        width=arr.shape[1],
-        count=1,
-        dtype=arr.dtype,
-        crs=crs,
-        transform=t,
-    )
-    # Write out the data
-    dataset.write(arr, 1)
+def array_to_tiff(arr, out_fp, desc, type, tiff_profile = None, product = None):
+    """
+    Writes an array to a WGS84 geotiff georeferenced from its annotation.
 
-    dataset.close()
+    Args:
+        arr (np.array): image to write
+        out_fp (string): path of the geotiff
+        desc (dict): annotation description from read_annotation
+        type (string): annotation search key of the image (e.g. 'grd_pwr')
+        tiff_profile (str or dict): output layout and compression as in grd_tiff_convert [Default = None]
+        product (string): image type used to pick a quantization (e.g. 'cor') [Default = None]
+    """
+    t, crs = grd_geotransform(desc, type)
+    profile = dict(driver='GTiff', height=arr.shape[0], width=arr.shape[1], count=1,
+                   dtype=arr.dtype, crs=crs, transform=t)
+    # Write out the data
+    with TiffWriter(out_fp, profile, tiff_profile, product) as writer:
+        writer.write(arr)
@@ -0,0 +1,212 @@
+"""
+Output profiles for the geotiffs written by uavsar_pytools. A profile sets the
+layout (striped, tiled or cloud optimized), compression, overviews and optional
+quantization of products such as coherence and amplitude.
+"""
+
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Named profiles. 'gtiff' is the uncompressed striped layout written previously.
+PROFILES = {
+    'gtiff': {},
+    'tiled': {'compress': 'deflate', 'blocksize': 512},
+    'cog': {'compress': 'deflate', 'blocksize': 512, 'overviews': True, 'cog': True},
+}
+
+# Quantization used with quantize = True. int16 values are stored as round((value - offset) / scale).
+DEFAULT_QUANTIZE = {
+    'cor': {'dtype': 'int16', 'scale': 1 / 30000, 'offset': 0},
+    'amp1': {'dtype': 'float16'},
+    'amp2': {'dtype': 'float16'},
+    'amp': {'dtype': 'float16'},
+}
+
+INT16_NODATA = -32768
+# GTiff takes numeric predictors but the COG driver names them
+COG_PREDICTORS = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+def resolve_profile(profile = None):
+    """
+    Resolves a profile name or dictionary to a dictionary of options.
+
+    Args:
+        profile (str or dict): name in PROFILES or dictionary with any of:
+            compress (str): deflate, zstd, lerc, lerc_deflate, lerc_zstd or lzw
+            predictor (int): predictor for deflate/zstd/lzw [Default = 3 for floats, 2 for integers]
+            level (int): compression level
+            max_z_error (float): maximum error for lerc compression
+            blocksize (int): tile size in pixels
+            overviews (bool or list): internal overview factors (True for automatic). Listed
+                factors are kept as given in cloud optimized geotiffs.
+            cog (bool): write a cloud optimized geotiff
+            quantize (bool or dict): product -> {'dtype': 'int16', 'scale', 'offset'} or
+                {'dtype': 'float16'}. True uses DEFAULT_QUANTIZE.
+            nodata (float): nodata tag for float images [Default = NaN, except for the plain
+                'gtiff' profile which is written without a nodata tag as before]
+    Returns:
+        options (dict): profile options
+    """
+    if profile is None:
+        return {}
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown tiff profile {profile}. Options are {list(PROFILES)}')
+        return dict(PROFILES[profile])
+    options = {}
+    if 'profile' in profile:
+        options.update(resolve_profile(profile['profile']))
+    options.update({k: v for k, v in profile.items() if k != 'profile'})
+    return options
+
+def _quantization(options, product):
+    quantize = options.get('quantize')
+    if quantize is True:
+        quantize = DEFAULT_QUANTIZE
+    if not quantize or product is None:
+        return None
+    return quantize.get(product)
+
+def creation_profile(base, options = None, product = None):
+    """
+    Builds the rasterio creation profile of an output geotiff.
+
+    Args:
+        base (dict): rasterio profile with driver, height, width, count, dtype, crs and transform
+        options (str or dict): output profile (see resolve_profile)
+        product (str): product of the image (e.g. 'cor') for quantization
+    Returns:
+        profile (dict): rasterio profile to open the output with
+        encoding (dict): quantization applied to blocks before writing (None if not quantized)
+    """
+    options = resolve_profile(options)
+    profile = dict(base)
+    profile['driver'] = 'GTiff'
+    dtype = np.dtype(profile['dtype'])
+    encoding = _quantization(options, product)
+    if encoding and dtype.kind == 'c':
+        log.warning(f'Can not quantize complex {product} images.')
+        encoding = None
+
+    if encoding:
+        if encoding['dtype'] == 'int16':
+            profile.update(dtype = 'int16', nodata = INT16_NODATA)
+            dtype = np.dtype('int16')
+        elif encoding['dtype'] == 'float16':
+            # Stored as half precision floats
+            profile.update(dtype = 'float32', nbits = 16)
+        else:
+            raise ValueError(f'Unknown quantization {encoding["dtype"]}')
+
+    # NaN is the no data value of converted float images so tag it for readers. The
+    # default profile is left untagged so existing conversions are unchanged.
+    if dtype.kind == 'f' and profile.get('nodata') is None and (options or encoding):
+        profile['nodata'] = options.get('nodata', np.nan)
+
+    blocksize = options.get('blocksize')
+    if blocksize:
+        profile.update(tiled = True, blockxsize = blocksize, blockysize = blocksize)
+    compress = options.get('compress')
+    if compress:
+        profile['compress'] = compress
+        if compress.startswith('lerc'):
+            if options.get('max_z_error') is not None:
+                profile['max_z_error'] = options['max_z_error']
+        else:
+            predictor = options.get('predictor')
+            if predictor is None and dtype.kind != 'c':
+                predictor = 3 if dtype.kind == 'f' else 2
+            if predictor:
+                profile['predictor'] = predictor
+        if options.get('level') is not None:
+            profile['zstd_level' if 'zstd' in compress else 'zlevel'] = options['level']
+    if options:
+        profile['bigtiff'] = 'if_safer'
+    return profile, encoding
+
+def encode(block, encoding):
+    """
+    Applies quantization to a block of values before writing.
+    """
+    if not encoding or encoding['dtype'] != 'int16':
+        return block
+    scaled = (block - encoding.get('offset', 0)) / encoding['scale']
+    out = np.clip(np.round(scaled), -32767, 32767)
+    out[~np.isfinite(scaled)] = INT16_NODATA
+    return out.astype(np.int16)
+
+class TiffWriter():
+    """
+    Writes a single band geotiff block by block with an output profile. Cloud optimized
+    geotiffs are written to a temporary tiled geotiff first and copied to the COG layout
+    when closed.
+
+    Args:
+        out_fp (str): path of the output geotiff
+        base (dict): rasterio profile with height, width, dtype, crs and transform
+        options (str or dict): output profile (see resolve_profile) [Default = plain geotiff]
+        product (str): product of the image (e.g. 'cor') for quantization [Default = None]
+    """
+    def __init__(self, out_fp, base, options = None, product = None):
+        self.out_fp = out_fp
+        self.options = resolve_profile(options)
+        self.profile, self.encoding = creation_profile(dict(base, count = 1), self.options, product)
+        self.cog = self.options.get('cog', False)
+        self.fp = out_fp + '.tmp.tif' if self.cog else out_fp
+        self.dataset = rasterio.open(self.fp, 'w+', **self.profile)
+        if self.encoding and self.encoding['dtype'] == 'int16':
+            self.dataset.scales = (self.encoding['scale'],)
+            self.dataset.offsets = (self.encoding.get('offset', 0),)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, block, window = None):
+        self.dataset.write(encode(block, self.encoding), 1, window = window)
+
+    def _overview_factors(self):
+        overviews = self.options.get('overviews')
+        if overviews is True:
+            factors, size = [], max(self.profile['height'], self.profile['width'])
+            while size / 2 ** (len(factors) + 1) >= 256:
+                factors.append(2 ** (len(factors) + 1))
+            return factors
+        return list(overviews or [])
+
+    def close(self):
+        if self.dataset is None:
+            return
+        factors = self._overview_factors()
+        # The COG driver builds automatic overviews itself but listed factors are built here
+        listed = bool(factors) and self.options.get('overviews') is not True
+        if factors and (not self.cog or listed):
+            self.dataset.build_overviews(factors, Resampling.average)
+        self.dataset.close()
+        self.dataset = None
+        if self.cog:
+            options = {k: v for k, v in self.profile.items() if k in ('compress', 'predictor', 'max_z_error', 'bigtiff')}
+            if 'predictor' in options:
+                options['predictor'] = COG_PREDICTORS.get(options['predictor'], options['predictor'])
+            # The COG driver takes a single LEVEL option for deflate and zstd
+            if self.options.get('level') is not None:
+                options['level'] = self.options['level']
+            options['blocksize'] = self.profile.get('blockxsize', 512)
+            if listed:
+                options['overviews'] = 'force_use_existing'
+            else:
+                options['overviews'] = 'auto' if self.options.get('overviews') else 'none'
+            options['overview_resampling'] = 'average'
+            if self.profile.get('nbits'):
+                options['nbits'] = self.profile['nbits']
+            rio_copy(self.fp, self.out_fp, driver = 'COG', **options)
+            os.remove(self.fp)
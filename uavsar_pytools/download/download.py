@@ -2,12 +2,21 @@
 Originally written by HP Marshall in matlab. Transcribed by Micah J. into python. Amended for uavsar_pytools by Zach Keskinen.
 Functions uses the urls to download uavsar data. It will not overwrite files
 so if you want to re-download fresh manually remove the output_dir.
-Warning: Canceling the script mid run will produce a file partially written. Rerunning the script will think the
-file is already downloaded and skip it. You will have to remove that file if you want to re-download it.
+Downloads are written to a .part file next to the output file and only moved into place once their
+size (and checksum if known) has been verified. Canceling the script mid run leaves the .part file,
+which is resumed with an HTTP range request on the next run.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import re
+import hashlib
+import threading
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import join, isdir, isfile, basename, dirname, exists
 from tqdm.auto import tqdm
 import logging
@@ -18,23 +27,261 @@ log = logging.getLogger(__name__)
 logging.basicConfig()
 log.setLevel(logging.WARNING)
 
-def stream_download(url, output_f):
+# Bytes read from the response per iteration
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Files smaller than this are never split into segments
+SEGMENT_MIN_SIZE = 64 * 1024**2
+
+# Shared session so connections (and Earthdata login cookies) are reused across requests
+_session = None
+_session_lock = threading.Lock()
+
+def _build_session(retries = 5, backoff_factor = 0.5, pool_maxsize = 16,
+                   status_forcelist = (429, 500, 502, 503, 504)):
+    retry = Retry(total = retries, backoff_factor = backoff_factor, status_forcelist = status_forcelist,
+                  allowed_methods = ['HEAD', 'GET'], respect_retry_after_header = True, raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = pool_maxsize, pool_maxsize = pool_maxsize, max_retries = retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def configure_session(retries = 5, backoff_factor = 0.5, pool_maxsize = 16,
+                      status_forcelist = (429, 500, 502, 503, 504)):
+    """
+    Creates the requests session shared by all downloads with connection pooling and
+    a retry/backoff policy. Call again to change the policy.
+    Args:
+        retries: number of retries for failed requests [Default = 5]
+        backoff_factor: exponential backoff factor between retries in seconds [Default = 0.5]
+        pool_maxsize: maximum number of pooled connections per host [Default = 16]
+        status_forcelist: HTTP status codes that are retried [Default = 429 and 5xx gateway errors]
+    Returns:
+        session (requests.Session): the shared session
+    """
+    global _session
+    session = _build_session(retries, backoff_factor, pool_maxsize, status_forcelist)
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = session
+    return session
+
+def get_session():
+    """
+    Returns the shared requests session, creating it with the default policy if needed.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session()
+        return _session
+
+def url_exists(url):
+    """
+    Checks if a url exists with a HEAD request so no body is downloaded. Falls back to
+    a streamed GET (closed before reading the body) for servers that do not allow HEAD.
+    """
+    session = get_session()
+    r = session.head(url, allow_redirects = True)
+    if r.status_code in [403, 405, 501]:
+        r = session.get(url, stream = True)
+        r.close()
+    return r.status_code == 200
+
+def file_md5(fp, chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Calculates the md5 hex digest of a file in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for ch in iter(lambda: f.read(chunk_size), b''):
+            md5.update(ch)
+    return md5.hexdigest()
+
+def _total_size(r, offset):
+    """
+    Total size of the remote file from a (partial) response or None if unknown.
+    """
+    content_range = r.headers.get('content-range')
+    if content_range:
+        match = re.search(r'/(\d+)$', content_range)
+        if match:
+            return int(match.group(1))
+    if 'content-length' in r.headers:
+        return offset + int(r.headers['content-length'])
+    return None
+
+def _finalize_part(url, part_f, output_f, total_size, md5, chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Verifies the size and checksum of a downloaded .part file and moves it into place.
+    """
+    size = os.path.getsize(part_f)
+    if total_size is not None and size != total_size:
+        log.warning(f'Downloaded {size} of {total_size} bytes of {url}. Rerun to resume from {part_f}.')
+        return None
+    if md5 and file_md5(part_f, chunk_size) != md5.lower():
+        log.warning(f'Checksum mismatch for {url}. Removing {part_f}.')
+        os.remove(part_f)
+        return None
+    os.replace(part_f, output_f)
+    return output_f
+
+def _download_segment(url, part_f, start, end, chunk_size, pbar, lock):
     """
+    Downloads bytes start-end (inclusive) of a url into the same bytes of part_f.
+    """
+    r = get_session().get(url, stream = True, headers = {'Range': f'bytes={start}-{end}'})
+    try:
+        if r.status_code != 206:
+            raise requests.exceptions.HTTPError(f'HTTP CODE {r.status_code} for range {start}-{end}')
+        with open(part_f, 'r+b') as f:
+            f.seek(start)
+            for ch in r.iter_content(chunk_size = chunk_size):
+                if ch:
+                    f.write(ch)
+                    with lock:
+                        pbar.update(len(ch))
+            position = f.tell()
+        if position != end + 1:
+            raise requests.exceptions.ConnectionError(f'Incomplete range {start}-{end}')
+    finally:
+        r.close()
+
+def segmented_download(url, output_f, segments = 4, chunk_size = DEFAULT_CHUNK_SIZE, md5 = None,
+                       min_size = SEGMENT_MIN_SIZE):
+    """
+    Downloads a url as several byte ranges fetched concurrently into a preallocated
+    .part file. Finished segments are recorded in a .segments file next to it so an
+    interrupted download only refetches unfinished segments.
     Args:
         url: url to download
         output_f: path to save the data to
+        segments: number of byte ranges fetched concurrently [Default = 4]
+        chunk_size: number of bytes read per iteration [Default = 1 MiB]
+        md5: expected md5 hex digest of the file [Default = None]
+        min_size: files smaller than this many bytes are not split [Default = 64 MiB]
+    Returns:
+        output_f if the download completed and was verified, None if it failed and
+        False if the server does not support ranges (or the file is too small).
     """
+    head = get_session().head(url, allow_redirects = True)
+    total_size = int(head.headers.get('content-length', 0))
+    if head.status_code != 200 or head.headers.get('accept-ranges', '').lower() != 'bytes' \
+        or total_size < max(min_size, 1) or head.headers.get('content-encoding', 'identity') != 'identity':
+        return False
 
-    r = requests.get(url, stream=True)
-    if r.status_code == 200:
-        # Progress bar - https://towardsdatascience.com/how-to-download-files-using-python-part-2-19b95be4cdb5
-        total_size= int(r.headers.get('content-length', 0))
-        with open(output_f, 'wb') as f:
-            with tqdm(total=total_size, unit='B', unit_scale=True , desc=f'Downloading {basename(url)}') as pbar:
-                for ch in r.iter_content(chunk_size=1024):
-                    if ch:
-                        f.write(ch)
-                        pbar.update(len(ch))
+    part_f = output_f + '.part'
+    seg_f = part_f + '.segments'
+    bounds = np.linspace(0, total_size, segments + 1).astype(np.int64)
+    ranges = [(int(start), int(end) - 1) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    done = []
+    if isfile(part_f) and isfile(seg_f):
+        with open(seg_f) as f:
+            state = json.load(f)
+        if state['size'] == total_size and [tuple(r) for r in state['ranges']] == ranges:
+            done = state['done']
+    if not done:
+        # Preallocate a sparse file that every segment writes into
+        with open(part_f, 'wb') as f:
+            f.truncate(total_size)
+
+    lock = threading.Lock()
+    def record(i):
+        with lock:
+            done.append(i)
+            with open(seg_f, 'w') as f:
+                json.dump({'size': total_size, 'ranges': ranges, 'done': done}, f)
+
+    todo = [i for i in range(len(ranges)) if i not in done]
+    initial = sum(ranges[i][1] - ranges[i][0] + 1 for i in done)
+    failed = False
+    with tqdm(total=total_size, initial=initial, unit='B', unit_scale=True, desc=f'Downloading {basename(url)}') as pbar:
+        with ThreadPoolExecutor(max_workers = len(ranges)) as executor:
+            futures = {executor.submit(_download_segment, url, part_f, *ranges[i], chunk_size, pbar, lock): i for i in todo}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    record(futures[future])
+                except requests.exceptions.RequestException as e:
+                    log.warning(f'Segment {ranges[futures[future]]} of {url} failed ({e}).')
+                    failed = True
+
+    if failed:
+        log.warning(f'Download of {url} incomplete. Rerun to resume from {part_f}.')
+        return None
+    os.remove(seg_f)
+    return _finalize_part(url, part_f, output_f, total_size, md5, chunk_size)
+
+def stream_download(url, output_f, chunk_size = DEFAULT_CHUNK_SIZE, md5 = None, resume = True, segments = 1,
+                    min_segment_size = SEGMENT_MIN_SIZE):
+    """
+    Args:
+        url: url to download
+        output_f: path to save the data to
+        chunk_size: number of bytes read per iteration [Default = 1 MiB]
+        md5: expected md5 hex digest of the file (e.g. md5sum of an ASF search result) [Default = None]
+        resume: resume a partial download left by an earlier run [Default = True]
+        segments: number of byte ranges to download concurrently. Falls back to a single stream
+            if the server does not advertise Accept-Ranges. [Default = 1]
+        min_segment_size: files smaller than this many bytes use a single stream [Default = 64 MiB]
+    Returns:
+        output_f if the download completed and was verified, otherwise None
+    """
+    if segments > 1:
+        res = segmented_download(url, output_f, segments = segments, chunk_size = chunk_size, md5 = md5,
+                                 min_size = min_segment_size)
+        if res is not False:
+            return res
+        log.debug(f'Segmented download not possible for {url}. Using a single stream.')
+
+    part_f = output_f + '.part'
+    if isfile(part_f + '.segments'):
+        # A preallocated segmented .part file has holes and can't be resumed as a stream
+        os.remove(part_f + '.segments')
+        resume = False
+    offset = os.path.getsize(part_f) if resume and isfile(part_f) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    session = get_session()
+    r = session.get(url, stream=True, headers = headers)
+    complete = False
+    if r.status_code == 416:
+        # Range not satisfiable - the partial file may already hold the whole file
+        total_size = _total_size(r, offset)
+        r.close()
+        if total_size == offset:
+            complete = True
+        else:
+            log.info(f'Unable to resume {part_f}. Restarting download.')
+            offset = 0
+            r = session.get(url, stream=True)
+    elif r.status_code == 200 and offset:
+        log.info(f'Server does not support resuming. Restarting download of {basename(url)}.')
+        offset = 0
+
+    if complete or r.status_code in [200, 206]:
+        if not complete:
+            total_size = _total_size(r, offset)
+            if r.headers.get('content-encoding', 'identity') != 'identity':
+                # content-length counts encoded bytes, not the decoded bytes written
+                total_size = None
+            try:
+                # Progress bar - https://towardsdatascience.com/how-to-download-files-using-python-part-2-19b95be4cdb5
+                with open(part_f, 'ab' if offset else 'wb') as f:
+                    with tqdm(total=total_size, initial=offset, unit='B', unit_scale=True , desc=f'Downloading {basename(url)}') as pbar:
+                        for ch in r.iter_content(chunk_size=chunk_size):
+                            if ch:
+                                f.write(ch)
+                                pbar.update(len(ch))
+            except requests.exceptions.RequestException as e:
+                log.warning(f'Download of {url} interrupted ({e}). Rerun to resume from {part_f}.')
+                return None
+            finally:
+                r.close()
+
+        return _finalize_part(url, part_f, output_f, total_size, md5, chunk_size)
     else:
         if r.status_code == 401:
             log.warning(f'HTTP CODE 401. DOWNLOADING REQUIRES A NETRC FILE AND SIGNED UAVSAR END USER AGREEMENT! See ReadMe for instructions.')
@@ -44,16 +291,20 @@ def stream_download(url, output_f):
             log.warning(f'HTTP CODE {r.status_code}. Skipping download!')
 
 
-def download_image(url, output_dir, ann = True, ann_url = None):
+def download_image(url, output_dir, ann = True, ann_url = None, md5 = None, chunk_size = DEFAULT_CHUNK_SIZE, segments = 4):
     """
     Downloads uavsar InSAR files from a url.
     Args:
         url (string): A url containing uavsar flight data. Can be from JPL or ASF
         output_dir (string): Directory to save the data in
+        md5 (string): expected md5 checksum of the image [Default = None]
+        chunk_size (int): number of bytes read per iteration [Default = 1 MiB]
+        segments (int): number of byte ranges to fetch concurrently for large files [Default = 4]
     Returns:
         out_fp (string): File path to downloaded image.
+        ann_fp (string): File path to downloaded annotation. None if it could not be downloaded.
     Raises:
-       None
+       ValueError: if the image download fails or does not match its size or md5
     """
 
     log.info(f'Starting download of {url}...')
@@ -64,7 +315,8 @@ def download_image(url, output_dir, ann = True, ann_url = None):
         os.makedirs(output_dir)
 
     if not isfile(local):
-        stream_download(url, local)
+        if stream_download(url, local, chunk_size = chunk_size, md5 = md5, segments = segments) is None:
+            raise ValueError(f'Download of {url} failed or could not be verified.')
     else:
         log.info(f'{local} already exists, skipping download!')
 
@@ -78,7 +330,7 @@ def download_image(url, output_dir, ann = True, ann_url = None):
                 # ASF formatting - query parent directory
                 if parent.split('.')[-1] == 'zip':
                     log.debug(f'ASF url found for {url}')
-                    parent_files = requests.get(parent).json()['response']
+                    parent_files = get_session().get(parent).json()['response']
                     ann_info = [i for i in parent_files if '.ann' in i['name']][0]
                     # assert len(ann_info) == 1, 'More than one ann file detected'
                     ann_url = ann_info['url']
@@ -104,8 +356,7 @@ def download_image(url, output_dir, ann = True, ann_url = None):
                     ann_url = url.replace(f'.{ext}', '.ann')
                     log.debug(f'Parsed annotation url: {ann_url}')
 
-                    response = requests.get(ann_url)
-                    if response.status_code == 200:
+                    if url_exists(ann_url):
                         log.debug('Success in parsing ann url')
                     else:
                         ann_url = None
@@ -113,10 +364,10 @@ def download_image(url, output_dir, ann = True, ann_url = None):
                 if ann_url:
                     ann_local = join(output_dir, basename(ann_url))
                     log.debug(f'Annotation local: {ann_local} and url {ann_url}')
-                    if not isfile(ann_local):
-                        stream_download(ann_url, ann_local)
-                    else:
+                    if isfile(ann_local):
                         log.info(f'{ann_local} already exists, skipping download!')
+                    elif stream_download(ann_url, ann_local) is None:
+                        ann_local = None
                     return local, ann_local
                 else:
                     log.warning('No ann url found. Manually provide .ann url.')
@@ -124,22 +375,25 @@ def download_image(url, output_dir, ann = True, ann_url = None):
                     ann_local = None
         else:
             ann_local = join(output_dir, basename(ann_url))
-            if not isfile(ann_local):
-                stream_download(ann_url, ann_local)
+            if not isfile(ann_local) and stream_download(ann_url, ann_local) is None:
+                ann_local = None
             return local, ann_local
 
         return local, None
 
-def download_zip(url, output_dir):
+def download_zip(url, output_dir, md5 = None, chunk_size = DEFAULT_CHUNK_SIZE, segments = 4):
     """
     Downloads uavsar InSAR files from a zip url.
     Args:
         url (string): A url containing uavsar flight zip. Can be from JPL or ASF
         output_dir (string): Directory to save the data in
+        md5 (string): expected md5 checksum of the zip file [Default = None]
+        chunk_size (int): number of bytes read per iteration [Default = 1 MiB]
+        segments (int): number of byte ranges to fetch concurrently for large files [Default = 4]
     Returns:
         out_fp (string): File path to downloaded images.
     Raises:
-       None
+       ValueError: if the download fails or does not match its size or md5
     """
 
     log.info(f'Starting download of {url}...')
@@ -151,7 +405,8 @@ def download_zip(url, output_dir):
     local = join(output_dir, basename(url))
 
     if not exists(local):
-        stream_download(url, local)
+        if stream_download(url, local, chunk_size = chunk_size, md5 = md5, segments = segments) is None:
+            raise ValueError(f'Download of {url} failed or could not be verified.')
     else:
         log.info(f'{local} already exists, skipping download!')
 
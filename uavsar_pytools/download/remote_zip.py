@@ -0,0 +1,140 @@
+"""
+Reads members of a remote zip file with HTTP range requests. Only the zip central
+directory and the requested members are transferred, so single products can be
+pulled out of multi-GB UAVSAR zips without downloading the whole archive.
+"""
+
+import io
+import os
+import shutil
+from os.path import join, exists, isdir, dirname
+from zipfile import ZipFile
+from tqdm.auto import tqdm
+import logging
+
+from uavsar_pytools.download.download import get_session
+from uavsar_pytools.convert.file_control import select_members
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(logging.WARNING)
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object backed by HTTP range requests. Small reads are
+    served from a read-ahead buffer of block_size bytes to limit the number of requests.
+
+    Args:
+        url (str): url of the remote file. Redirects (e.g. Earthdata login) are resolved once.
+        block_size (int): minimum number of bytes fetched per request [Default = 1 MiB]
+
+    Attributes:
+        size (int): size of the remote file in bytes
+        bytes_read (int): number of bytes transferred so far
+    """
+
+    def __init__(self, url, block_size = 1024 * 1024):
+        self.session = get_session()
+        head = self.session.head(url, allow_redirects = True)
+        if head.status_code != 200:
+            raise ValueError(f'HTTP CODE {head.status_code} for {url}')
+        if head.headers.get('accept-ranges', '').lower() != 'bytes' or 'content-length' not in head.headers:
+            raise ValueError(f'Server does not support range requests for {url}')
+        self.url = head.url
+        self.size = int(head.headers['content-length'])
+        self.block_size = block_size
+        self.bytes_read = 0
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        return self._pos
+
+    def _fetch(self, start, end):
+        r = self.session.get(self.url, headers = {'Range': f'bytes={start}-{end}'})
+        if r.status_code != 206:
+            raise IOError(f'HTTP CODE {r.status_code} requesting bytes {start}-{end} of {self.url}')
+        self.bytes_read += len(r.content)
+        return r.content
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        offset = self._pos - self._buffer_start
+        if 0 <= offset and offset + n <= len(self._buffer):
+            data = self._buffer[offset:offset + n]
+        elif n >= self.block_size:
+            data = self._fetch(self._pos, self._pos + n - 1)
+        else:
+            end = min(self._pos + self.block_size, self.size) - 1
+            self._buffer = self._fetch(self._pos, end)
+            self._buffer_start = self._pos
+            data = self._buffer[:n]
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+def list_zip_members(url):
+    """
+    Lists the members of a remote zip file by reading only its central directory.
+
+    Args:
+        url (str): url of the zip file
+    Returns:
+        names (list): member names
+    """
+    with HttpRangeFile(url) as f, ZipFile(f) as zip_file:
+        return zip_file.namelist()
+
+def download_zip_members(url, output_dir, pols = None, products = None):
+    """
+    Downloads only the members of a remote zip file that match the requested
+    polarizations and products. Annotation files are always included.
+
+    Args:
+        url (str): url of the zip file. Server must support range requests.
+        output_dir (str): directory to extract the members into
+        pols (list): polarizations to keep (e.g. ['VV']) [Default = all]
+        products (list): product extensions to keep (e.g. ['unw', 'cor']) [Default = all]
+    Returns:
+        out_fps (list): local file paths of the selected members
+    Raises:
+        ValueError: if the server does not support range requests
+    """
+    if not isdir(output_dir):
+        os.makedirs(output_dir)
+
+    with HttpRangeFile(url) as f, ZipFile(f) as zip_file:
+        members = select_members(zip_file.namelist(), pols = pols, products = products)
+        todo = [m for m in members if not exists(join(output_dir, m))]
+        if not todo:
+            log.info('No files found to download. Check if polarizations and products exist.')
+        for member in tqdm(todo, unit = 'file', desc = 'Extracting remote'):
+            out_fp = join(output_dir, member)
+            os.makedirs(dirname(out_fp), exist_ok = True)
+            # Extract to a temporary file so interrupted members are not mistaken for complete ones
+            with zip_file.open(member) as src, open(out_fp + '.part', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(out_fp + '.part', out_fp)
+        log.info(f'Transferred {f.bytes_read} of {f.size} bytes from {url}')
+
+    return [join(output_dir, m) for m in members]
@@ -0,0 +1,115 @@
+"""
+Cached ASF searches. Results of asf_search queries are stored on disk as JSON keyed
+by the query parameters so re-runs reuse them until they expire and offline runs
+(e.g. CI with a recorded cache) can replay them without network access.
+"""
+
+import os
+import json
+import time
+import hashlib
+from os.path import join, exists, expanduser
+import pandas as pd
+import asf_search as asf
+import logging
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+log.setLevel(logging.WARNING)
+
+# Default time in seconds before a cached search is repeated
+DEFAULT_TTL = 24 * 60 * 60
+
+class SearchResult():
+    """
+    Search result restored from the cache. Has the same properties and geometry
+    dictionaries as an asf_search ASFProduct but none of its methods (e.g. download).
+    """
+    def __init__(self, properties, geometry = None):
+        self.properties = properties
+        self.geometry = geometry
+
+    def __repr__(self):
+        return f'SearchResult({self.properties.get("fileID", self.properties.get("url"))})'
+
+def search_key(params):
+    """
+    Returns the cache key of a set of asf_search parameters. Parameter order does not matter.
+    """
+    normalized = {k: sorted(v) if isinstance(v, (list, tuple, set)) else v for k, v in params.items() if v is not None}
+    text = json.dumps(normalized, sort_keys = True, default = str)
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+def cached_search(cache_dir = None, ttl = DEFAULT_TTL, offline = False, **params):
+    """
+    Runs asf_search.search with a disk cache.
+
+    Args:
+        cache_dir (str): directory of the cache. None disables caching. [Default = None]
+        ttl (float): seconds before a cached search is repeated. None never expires. [Default = 1 day]
+        offline (bool): only use the cache and never contact ASF [Default = False]
+        **params: keyword arguments of asf_search.search
+    Returns:
+        results (list): product of each result. Live asf_search ASFProducts when ASF was
+            searched and SearchResults (properties and geometry only) when read from the cache.
+    Raises:
+        FileNotFoundError: if offline and the search is not cached
+    """
+    fp = join(expanduser(cache_dir), search_key(params) + '.json') if cache_dir else None
+    cached = None
+    if fp and exists(fp):
+        with open(fp) as f:
+            cached = json.load(f)
+        age = time.time() - cached['created']
+        if offline or ttl is None or age < ttl:
+            log.info(f'Using cached search from {fp} ({age:.0f} s old)')
+            return [SearchResult(r['properties'], r.get('geometry')) for r in cached['results']]
+
+    if offline:
+        raise FileNotFoundError(f'Search {params} is not cached in {cache_dir} and offline is set.')
+
+    try:
+        results = list(asf.search(**params))
+    except Exception:
+        if cached is None:
+            raise
+        log.warning(f'ASF search failed. Using expired cache from {fp}.')
+        return [SearchResult(r['properties'], r.get('geometry')) for r in cached['results']]
+
+    if fp:
+        os.makedirs(expanduser(cache_dir), exist_ok = True)
+        record = {'created': time.time(), 'params': params,
+                  'results': [{'properties': r.properties, 'geometry': r.geometry} for r in results]}
+        # Write then rename so concurrent runs never read a partial cache file
+        tmp_fp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(record, f, default = str)
+        os.replace(tmp_fp, fp)
+    return results
+
+def match_results(results, candidates):
+    """
+    Matches each result to the first candidate product (e.g. an INC image) on the same
+    flight path whose acquisition overlaps it.
+
+    Args:
+        results (list): search results to match
+        candidates (list): search results to choose from
+    Returns:
+        matches (list): matching candidate (or None) for each result
+    """
+    by_path = {}
+    for c in candidates:
+        by_path.setdefault(str(c.properties.get('pathNumber')), []).append(c)
+
+    matches = []
+    for r in results:
+        start = pd.to_datetime(r.properties['startTime'])
+        stop = pd.to_datetime(r.properties['stopTime'])
+        match = None
+        for c in by_path.get(str(r.properties.get('pathNumber')), []):
+            if pd.to_datetime(c.properties['startTime']) <= stop and pd.to_datetime(c.properties['stopTime']) >= start:
+                match = c
+                break
+        matches.append(match)
+    return matches
@@ -0,0 +1,395 @@
+"""
+Geocoding of radar coordinate UAVSAR images (SLCs, look vectors, unwrapped phase) to a
+WGS84 grid from the latitude and longitude of each pixel in the .llh file. The mapping
+from output pixels to source pixels is computed once as a lookup table and any number of
+co-registered arrays are then resampled through it. Lookup tables can be saved to disk
+keyed by the llh contents and output grid so later runs skip the geometry entirely.
+"""
+
+import os
+import json
+import math
+import hashlib
+from functools import lru_cache
+from os.path import join, exists, expanduser, abspath
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine, from_origin
+from uavsar_pytools.convert.binary_reader import iter_row_blocks
+import logging
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Output pixel spacing in degrees (~6 m) used by default
+DEFAULT_SPACING = 0.00005556
+# No data value of geocoded images
+GEOCODE_NODATA = -9999
+# Output pixels refined at a time to bound memory use
+_REFINE_BLOCK = 2**22
+
+class GeoLookup():
+    """
+    Lookup table from output grid pixels to source image pixels.
+
+    Args:
+        shape (tuple): rows and columns of the output grid
+        transform (Affine): geotransform of the output grid
+        src_shape (tuple): rows and columns of the source image
+        out_index (np.array): flat indexes of the output pixels that fall on the source image
+        src_index (np.array): flat source indexes of each output pixel [n x 1 (nearest) or n x 4 (bilinear)]
+        weights (np.array): bilinear weights of each source index (None for nearest)
+        method (str): 'nearest' or 'bilinear'
+        src_coords (np.array): fractional source row and column of each output pixel [n x 2].
+            Used to resample images with a different number of looks than the source.
+    """
+    def __init__(self, shape, transform, src_shape, out_index, src_index, weights = None, method = 'nearest',
+                 src_coords = None):
+        self.shape = tuple(shape)
+        self.transform = transform
+        self.crs = CRS.from_epsg(4326)
+        self.src_shape = tuple(src_shape)
+        self.out_index = out_index
+        self.src_index = src_index
+        self.weights = weights
+        self.method = method
+        self.src_coords = src_coords
+        self._looked = {}
+        self._order = None
+
+    def looked(self, src_shape):
+        """
+        Lookup for an image of the same scene with a different number of looks, e.g. a
+        1x1 SLC with the lookup of a 2x8 llh. Source pixel i of the lookup covers pixels
+        i * looks to (i + 1) * looks of the image along each axis.
+
+        Args:
+            src_shape (tuple): rows and columns of the image
+        Returns:
+            lookup (GeoLookup): lookup on the same output grid for the image
+        """
+        src_shape = tuple(int(n) for n in src_shape)
+        if src_shape == self.src_shape:
+            return self
+        if self.src_coords is None:
+            raise ValueError(f'Image shape {src_shape} does not match the lookup source shape {self.src_shape}.')
+        if src_shape not in self._looked:
+            looks = [n / m for n, m in zip(src_shape, self.src_shape)]
+            if any(abs(l - round(l)) > 1e-6 or round(l) < 1 for l in looks):
+                raise ValueError(f'Image shape {src_shape} is not a multiple of the lookup source shape {self.src_shape}.')
+            r = (self.src_coords[:, 0].astype(np.float64) + 0.5) * looks[0] - 0.5
+            c = (self.src_coords[:, 1].astype(np.float64) + 0.5) * looks[1] - 0.5
+            src_index, weights = _source_indexes(r, c, src_shape, self.method)
+            self._looked[src_shape] = GeoLookup(self.shape, self.transform, src_shape, self.out_index,
+                                                src_index, weights, self.method)
+        return self._looked[src_shape]
+
+    def _sorted_index(self):
+        """
+        Order that sorts the source indexes and the sorted indexes, so the indexes falling
+        in a block of source rows are a contiguous range.
+        """
+        if self._order is None:
+            flat = self.src_index.reshape(-1)
+            self._order = np.argsort(flat, kind = 'stable')
+            self._sorted = flat[self._order]
+        return self._order, self._sorted
+
+    def _gather(self, arr, block_rows = None):
+        """
+        Source values of each lookup index read in blocks of source rows, so only one
+        block of a memory mapped image (or of a strided view such as its real part) is
+        in memory at a time.
+        """
+        ncols = self.src_shape[1]
+        if block_rows is None:
+            block_rows = max(1, _REFINE_BLOCK // ncols)
+        order, sorted_index = self._sorted_index()
+        vals = np.empty(self.src_index.size, dtype = arr.dtype)
+        for rows in iter_row_blocks(self.src_shape[0], block_rows):
+            lo, hi = np.searchsorted(sorted_index, [rows.start * ncols, rows.stop * ncols])
+            if lo == hi:
+                continue
+            block = np.asarray(arr[rows]).reshape(-1)
+            vals[order[lo:hi]] = block[sorted_index[lo:hi] - rows.start * ncols]
+        return vals.reshape(self.src_index.shape)
+
+    def resample(self, arr, nodata = GEOCODE_NODATA, dtype = None, block_rows = None):
+        """
+        Resamples a source image onto the output grid.
+
+        Args:
+            arr (np.array): image with the shape of the source or a whole number of looks
+                finer (see looked). May be a memory map or complex.
+            nodata (float): value of output pixels off the image or from NaN source pixels [Default = -9999]
+            dtype (np.dtype): output dtype [Default = dtype of arr]
+            block_rows (int): source rows read at a time [Default = about 4M pixels]
+        Returns:
+            out (np.array): image on the output grid
+        """
+        if tuple(arr.shape) != self.src_shape:
+            return self.looked(arr.shape).resample(arr, nodata = nodata, dtype = dtype, block_rows = block_rows)
+        vals = self._gather(arr, block_rows)
+        if self.weights is not None:
+            vals = np.einsum('ij,ij->i', vals, self.weights.astype(vals.real.dtype, copy = False))
+        else:
+            vals = vals[:, 0]
+        out = np.full(self.shape, nodata, dtype = dtype or arr.dtype)
+        vals = vals.astype(out.dtype, copy = False)
+        if np.iscomplexobj(vals) or vals.dtype.kind == 'f':
+            vals[np.isnan(vals)] = nodata
+        out.reshape(-1)[self.out_index] = vals
+        return out
+
+    def save(self, fp):
+        """
+        Saves the lookup table to an uncompressed .npz file (see load_lookup).
+        """
+        weights = self.weights if self.weights is not None else np.empty((0, 0), dtype = np.float32)
+        src_coords = self.src_coords if self.src_coords is not None else np.empty((0, 0), dtype = np.float32)
+        with open(fp, 'wb') as f:
+            np.savez(f, shape = self.shape, transform = list(self.transform)[:6], src_shape = self.src_shape,
+                     out_index = self.out_index, src_index = self.src_index, weights = weights,
+                     method = self.method, src_coords = src_coords)
+
+    def profile(self, dtype = 'float32', nodata = GEOCODE_NODATA):
+        """
+        Rasterio profile of a geotiff on the output grid.
+        """
+        return dict(driver = 'GTiff', height = self.shape[0], width = self.shape[1], count = 1,
+                    dtype = dtype, crs = self.crs, transform = self.transform, nodata = nodata)
+
+def output_grid(lat, lon, spacing = DEFAULT_SPACING, bounds = None):
+    """
+    Output grid covering the valid latitudes and longitudes.
+
+    Args:
+        lat, lon (np.array): latitude and longitude of each source pixel
+        spacing (float or list): pixel spacing in degrees ([x, y] or a single value)
+        bounds (tuple): (west, south, east, north) [Default = extent of lat and lon]
+    Returns:
+        transform (Affine), shape (tuple)
+    """
+    dx, dy = (spacing, spacing) if np.isscalar(spacing) else spacing
+    if bounds is None:
+        valid = _valid(lat, lon)
+        bounds = (float(lon[valid].min()), float(lat[valid].min()), float(lon[valid].max()), float(lat[valid].max()))
+    west, south, east, north = bounds
+    shape = (max(1, math.ceil((north - south) / dy)), max(1, math.ceil((east - west) / dx)))
+    return from_origin(west, north, dx, dy), shape
+
+def _valid(lat, lon):
+    # Zero latitude and longitude mark pixels without a location
+    return np.isfinite(lat) & np.isfinite(lon) & ~((lat == 0) & (lon == 0))
+
+def _seed(lat, lon, transform, shape, fill):
+    """
+    Approximate source row and column of each output pixel by scattering the source
+    pixels into the grid and growing the result into gaps by fill pixels.
+    """
+    nrows, ncols = lat.shape
+    seed_r = np.full(shape, -1, dtype = np.int32)
+    seed_c = np.full(shape, -1, dtype = np.int32)
+    rows = np.arange(ncols, dtype = np.int32)
+    block = max(1, _REFINE_BLOCK // ncols)
+    for start in range(0, nrows, block):
+        la = np.asarray(lat[start:start + block], dtype = np.float64)
+        lo = np.asarray(lon[start:start + block], dtype = np.float64)
+        oi = np.floor((lo - transform.c) / transform.a)
+        oj = np.floor((la - transform.f) / transform.e)
+        ok = _valid(la, lo) & (oi >= 0) & (oi < shape[1]) & (oj >= 0) & (oj < shape[0])
+        r, c = np.nonzero(ok)
+        seed_r[oj[ok].astype(np.intp), oi[ok].astype(np.intp)] = r + start
+        seed_c[oj[ok].astype(np.intp), oi[ok].astype(np.intp)] = rows[c]
+
+    # Output pixels smaller than the source leave gaps, so copy seeds from neighbours.
+    # Seeds off the image are rejected after refinement.
+    for _ in range(fill):
+        empty = seed_r < 0
+        if not empty.any():
+            break
+        for axis, step in [(0, 1), (0, -1), (1, 1), (1, -1)]:
+            shifted_r = np.roll(seed_r, step, axis = axis)
+            shifted_c = np.roll(seed_c, step, axis = axis)
+            edge = [slice(None)] * 2
+            edge[axis] = 0 if step == 1 else -1
+            shifted_r[tuple(edge)] = -1
+            take = empty & (shifted_r >= 0)
+            seed_r[take] = shifted_r[take]
+            seed_c[take] = shifted_c[take]
+            empty &= ~take
+    return seed_r, seed_c
+
+def _refine(lat, lon, r, c, target_lat, target_lon, iterations = 2):
+    """
+    Newton steps from the seed pixels to the fractional source row and column whose
+    location is the output pixel center, using the local lat/lon gradients.
+    """
+    nrows, ncols = lat.shape
+    r = r.astype(np.float64)
+    c = c.astype(np.float64)
+    for _ in range(iterations):
+        r0 = np.clip(np.rint(r), 0, nrows - 1).astype(np.intp)
+        c0 = np.clip(np.rint(c), 0, ncols - 1).astype(np.intp)
+        r1 = np.clip(r0, 0, nrows - 2)
+        c1 = np.clip(c0, 0, ncols - 2)
+        la0, lo0 = lat[r0, c0].astype(np.float64), lon[r0, c0].astype(np.float64)
+        # Forward differences along rows and columns
+        dla_r = lat[r1 + 1, c0] - lat[r1, c0]
+        dlo_r = lon[r1 + 1, c0] - lon[r1, c0]
+        dla_c = lat[r0, c1 + 1] - lat[r0, c1]
+        dlo_c = lon[r0, c1 + 1] - lon[r0, c1]
+        det = dla_r.astype(np.float64) * dlo_c - dla_c.astype(np.float64) * dlo_r
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            d_lat, d_lon = target_lat - la0, target_lon - lo0
+            r = r0 + (dlo_c * d_lat - dla_c * d_lon) / det
+            c = c0 + (dla_r * d_lon - dlo_r * d_lat) / det
+    valid = np.isfinite(r) & np.isfinite(c) & (r >= -0.5) & (r <= nrows - 0.5) & (c >= -0.5) & (c <= ncols - 0.5)
+    r0 = np.clip(np.rint(np.nan_to_num(r)), 0, nrows - 1).astype(np.intp)
+    c0 = np.clip(np.rint(np.nan_to_num(c)), 0, ncols - 1).astype(np.intp)
+    valid &= _valid(lat[r0, c0], lon[r0, c0])
+    return r, c, valid
+
+def _source_indexes(r, c, src_shape, method):
+    """
+    Flat source indexes (and bilinear weights) of fractional source rows and columns.
+    """
+    nrows, ncols = src_shape
+    if method == 'nearest':
+        src = np.rint(r).clip(0, nrows - 1).astype(np.int64) * ncols + np.rint(c).clip(0, ncols - 1).astype(np.int64)
+        return src[:, None], None
+    r0 = np.floor(r).clip(0, max(nrows - 2, 0)).astype(np.int64)
+    c0 = np.floor(c).clip(0, max(ncols - 2, 0)).astype(np.int64)
+    fr = np.clip(r - r0, 0, 1).astype(np.float32)
+    fc = np.clip(c - c0, 0, 1).astype(np.float32)
+    r1 = np.minimum(r0 + 1, nrows - 1)
+    c1 = np.minimum(c0 + 1, ncols - 1)
+    src = np.stack([r0 * ncols + c0, r0 * ncols + c1, r1 * ncols + c0, r1 * ncols + c1], axis = 1)
+    weights = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc], axis = 1)
+    return src, weights
+
+def build_lookup(lat, lon, spacing = DEFAULT_SPACING, bounds = None, method = 'nearest', fill = 4):
+    """
+    Computes the lookup table from an output WGS84 grid to source image pixels.
+
+    Args:
+        lat, lon (np.array): latitude and longitude of each source pixel (e.g. from the .llh file)
+        spacing (float or list): output pixel spacing in degrees [Default = 0.00005556]
+        bounds (tuple): (west, south, east, north) of the output [Default = extent of the image]
+        method (str): 'nearest' or 'bilinear' [Default = 'nearest']
+        fill (int): pixels to grow the scattered source positions into gaps of the output grid [Default = 4]
+    Returns:
+        lookup (GeoLookup): lookup table used to resample images
+    """
+    if method not in ('nearest', 'bilinear'):
+        raise ValueError(f'Unknown resampling method {method}. Use nearest or bilinear.')
+    if lat.shape != lon.shape:
+        raise ValueError('Latitude and longitude must have the same shape.')
+    nrows, ncols = lat.shape
+    transform, shape = output_grid(lat, lon, spacing, bounds)
+    seed_r, seed_c = _seed(lat, lon, transform, shape, fill)
+
+    seeded = np.flatnonzero(seed_r.reshape(-1) >= 0)
+    out_index, src_index, weights, src_coords = [], [], [], []
+    for start in range(0, len(seeded), _REFINE_BLOCK):
+        idx = seeded[start:start + _REFINE_BLOCK]
+        oj, oi = np.divmod(idx, shape[1])
+        # Output pixel centers
+        target_lon = transform.c + transform.a * (oi + 0.5)
+        target_lat = transform.f + transform.e * (oj + 0.5)
+        r, c, valid = _refine(lat, lon, seed_r.reshape(-1)[idx], seed_c.reshape(-1)[idx], target_lat, target_lon)
+        idx, r, c = idx[valid], r[valid], c[valid]
+        out_index.append(idx)
+        src, w = _source_indexes(r, c, (nrows, ncols), method)
+        src_index.append(src)
+        if w is not None:
+            weights.append(w)
+        src_coords.append(np.stack([r, c], axis = 1).astype(np.float32))
+
+    k = 1 if method == 'nearest' else 4
+    out_index = np.concatenate(out_index) if out_index else np.empty(0, dtype = np.int64)
+    src_index = np.concatenate(src_index) if src_index else np.empty((0, k), dtype = np.int64)
+    weights = (np.concatenate(weights) if weights else np.empty((0, 4), dtype = np.float32)) if method == 'bilinear' else None
+    src_coords = np.concatenate(src_coords) if src_coords else np.empty((0, 2), dtype = np.float32)
+    log.info(f'Geocoding lookup: {len(out_index)} of {shape[0] * shape[1]} output pixels on the image')
+    return GeoLookup(shape, transform, (nrows, ncols), out_index, src_index, weights, method, src_coords)
+
+def load_lookup(fp):
+    """
+    Loads a lookup table saved with GeoLookup.save.
+    """
+    with np.load(fp) as npz:
+        method = str(npz['method'])
+        weights = npz['weights'] if method == 'bilinear' else None
+        src_coords = npz['src_coords'] if 'src_coords' in npz.files and npz['src_coords'].size else None
+        return GeoLookup(tuple(npz['shape']), Affine(*npz['transform']), tuple(npz['src_shape']),
+                         npz['out_index'], npz['src_index'], weights, method, src_coords)
+
+@lru_cache(maxsize = 64)
+def _hash_cached(llh_fp, mtime_ns, size):
+    sha = hashlib.sha256()
+    with open(llh_fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**23), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def llh_hash(llh_fp):
+    """
+    SHA-256 of an llh file. Memoized by path, modification time and size so each file
+    is only read once per session.
+    """
+    stat = os.stat(llh_fp)
+    return _hash_cached(abspath(llh_fp), stat.st_mtime_ns, stat.st_size)
+
+def lookup_key(llh_fp, shape, spacing = DEFAULT_SPACING, bounds = None, method = 'nearest', fill = 4):
+    """
+    Cache key of the lookup table of an llh file and output grid.
+    """
+    # Version 2 tables hold the fractional source coordinates used for other numbers of looks
+    params = {'version': 2, 'llh': llh_hash(llh_fp), 'shape': list(shape), 'method': method, 'fill': fill,
+              'spacing': [float(v) for v in np.atleast_1d(spacing)],
+              'bounds': [float(v) for v in bounds] if bounds is not None else None}
+    return hashlib.sha256(json.dumps(params, sort_keys = True).encode()).hexdigest()[:32]
+
+def cached_lookup(llh_fp, nrows, ncols, cache_dir = None, spacing = DEFAULT_SPACING, bounds = None,
+                  method = 'nearest', fill = 4):
+    """
+    Returns the lookup table of an llh file, building and saving it on the first call.
+    Products from the same flight line and segment share the llh so a stack of images
+    needs one geometry computation.
+
+    Args:
+        llh_fp (str): path of the .llh file
+        nrows, ncols (int): rows and columns of the llh
+        cache_dir (str): directory of saved lookup tables. None only builds the lookup. [Default = None]
+        spacing, bounds, method, fill: output grid and resampling (see build_lookup)
+    Returns:
+        lookup (GeoLookup): lookup table used to resample images
+    """
+    fp = None
+    if cache_dir:
+        cache_dir = expanduser(cache_dir)
+        fp = join(cache_dir, f'lookup_{lookup_key(llh_fp, (nrows, ncols), spacing, bounds, method, fill)}.npz')
+        if exists(fp):
+            log.info(f'Using cached geocoding lookup {fp}')
+            return load_lookup(fp)
+
+    lat, lon, _ = read_llh(llh_fp, nrows, ncols)
+    lookup = build_lookup(lat, lon, spacing = spacing, bounds = bounds, method = method, fill = fill)
+    if fp:
+        os.makedirs(cache_dir, exist_ok = True)
+        # Write then rename so concurrent runs never read a partial lookup
+        tmp_fp = f'{fp}.{os.getpid()}.tmp'
+        lookup.save(tmp_fp)
+        os.replace(tmp_fp, fp)
+    return lookup
+
+def read_llh(llh_fp, nrows, ncols, dtype = '<f'):
+    """
+    Memory maps an .llh file of interleaved latitude, longitude and height.
+
+    Returns:
+        lat, lon, dem (np.memmap): views of each band [nrows x ncols]
+    """
+    mm = np.memmap(llh_fp, dtype = np.dtype(dtype), mode = 'r', shape = (nrows, ncols, 3))
+    return mm[..., 0], mm[..., 1], mm[..., 2]
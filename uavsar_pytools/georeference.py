@@ -1,13 +1,13 @@
 from pathlib import Path
 import os
-import shutil
-from glob import glob
+import re
 from os.path import join, basename, dirname
 import warnings
 import numpy as np
 import rasterio as rio
-from osgeo import gdal, osr
 from uavsar_pytools.convert.tiff_conversion import read_annotation, array_to_tiff
+from uavsar_pytools.convert.tiff_profile import TiffWriter
+from uavsar_pytools.geocode import cached_lookup, DEFAULT_SPACING, GEOCODE_NODATA
 import rioxarray
 
 def geocodeUsingGdalWarp(infile, latfile, lonfile, outfile,
@@ -18,6 +18,9 @@ def geocodeUsingGdalWarp(infile, latfile, lonfile, outfile,
     From: Dr. Gareth Funning, UC Riverside, UNAVCO InSAR Short Course
     Geocode a swath file using corresponding lat, lon files
     '''
+    # GDAL is optional and only needed for this function (see geolocate_uavsar)
+    from osgeo import gdal, osr
+
     sourcexmltmpl = '''    <SimpleSource>
       <SourceFilename>{0}</SourceFilename>
       <SourceBand>{1}</SourceBand>
@@ -61,143 +64,88 @@ def geocodeUsingGdalWarp(infile, latfile, lonfile, outfile,
     gdal.Warp(outfile, tempvrtname, options=warpOptions)
     os.remove('temp_ele.vrt')
 
-def geolocate_uavsar(in_fp, ann_fp, out_dir, llh_fp):
+def _read_products(in_fp, desc):
     """
-    Geolocates a uavsar image using an array of latitudes and longitudes.
-    Can be either an SLC or Look Vector. If SLC will save as a tif of real
-    and a tif of complex values.
-    in_fp: file path of file to geolocate
-    ann_fp: file path to annotation file
-    out_dir: directory to save geolocated files
-    llh_fp: file path to UAVSAR lat, long, elev files for georeferencing
+    Reads the arrays of a radar coordinate product to geocode.
 
-    returns:
-    List: files that have been created
+    Returns:
+        ext (str): product extension (e.g. 'slc', 'lkv', 'unw')
+        arrs (dict): name -> array. Real and imaginary parts for SLCs, y, x and z for look vectors.
     """
-
-    desc = read_annotation(ann_fp)
     ext = basename(in_fp).split('.')[-1]
-
-    tmp_dir = join(out_dir, 'tmp')
-    os.makedirs(tmp_dir, exist_ok=True)
-        
-    nrows = desc[f'llh_1_2x8.set_rows']['value']
-    ncols = desc[f'llh_1_2x8.set_cols']['value']
-    dt = np.dtype('<f')
-
-    arr = np.fromfile(llh_fp, dtype = dt)
-    res = {}
-    res[f'llh.lat'] = arr[::3].reshape(nrows, ncols)
-    res[f'llh.long'] = arr[1::3].reshape(nrows, ncols)
-    res[f'llh.dem'] = arr[2::3].reshape(nrows, ncols)
-
-    profile = {
-    'driver': 'GTiff',
-    'interleave': 'band',
-    'tiled': False,
-    'nodata': 0,
-    'width': ncols,
-    'height':nrows,
-    'count':1,
-    'dtype':'float32'
-    }
-    
-    # Save out tifs
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", message="Dataset has no geotransform, gcps, or rpcs. The identity matrix be returned.")
-        for name, arr in res.items():
-            with rio.open(join(tmp_dir, name + '.tif'), 'w', **profile) as dst:
-                dst.write(arr.astype(arr.dtype), 1)
-
-    # Add VRT file for each tif
-    tifs = glob(join(tmp_dir, '*.tif')) # list all .llh files
-    for tiff in tifs: # loop to open and translate .llh to .vrt, and save .vrt using gdal
-        raster_dataset = gdal.Open(tiff, gdal.GA_ReadOnly) # read in rasters
-        raster = gdal.Translate(join(tmp_dir, basename(tiff).replace('.tif','.vrt')), raster_dataset, format = 'VRT', outputType = gdal.GDT_Float32)
-    raster_dataset = None
-
-    vrts = glob(join(tmp_dir, '*.vrt'))
-    latf = [f for f in vrts if basename(f) == 'llh.lat.vrt'][0]
-    longf = [f for f in vrts if basename(f) == 'llh.long.vrt'][0]
-
-    profile = {
-        'driver': 'GTiff',
-        'interleave': 'band',
-        'tiled': False,
-        'nodata': 0,
-        'width': ncols,
-        'height':nrows,
-        'count':1,
-        'dtype':'float32'
-        }
-
+    arrs = {}
     if ext == 'slc':
         spacing = in_fp.replace(f'.{ext}','')[-3:]
         nrows = desc[f'{ext}_1_{spacing} rows']['value']
         ncols = desc[f'{ext}_1_{spacing} columns']['value']
-        dtype = np.complex64
-        arr = np.fromfile(in_fp, dtype = dtype).reshape(nrows, ncols)
-        d_arrs = {}
-        d_arrs['real'] = arr.real
-        d_arrs['imag'] = arr.imag
+        arr = np.memmap(in_fp, dtype = np.complex64, mode = 'r', shape = (nrows, ncols))
+        arrs['real'] = arr.real
+        arrs['imag'] = arr.imag
 
     elif ext == 'lkv':
         spacing = in_fp.replace(f'.{ext}','')[-3:]
         nrows = desc[f'{ext}_1_{spacing} rows']['value']
         ncols = desc[f'{ext}_1_{spacing} columns']['value']
-        dtype = np.dtype('<f')
-        arr = np.fromfile(in_fp, dtype = dtype)
-        d_arrs = {}
-        d_arrs[f'y'] = arr[::3].reshape(nrows, ncols)
-        d_arrs[f'x'] = arr[1::3].reshape(nrows, ncols)
-        d_arrs[f'z'] = arr[2::3].reshape(nrows, ncols)
+        arr = np.memmap(in_fp, dtype = np.dtype('<f'), mode = 'r', shape = (nrows, ncols, 3))
+        arrs['y'] = arr[..., 0]
+        arrs['x'] = arr[..., 1]
+        arrs['z'] = arr[..., 2]
 
     elif ext == 'vrt':
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore", message="Dataset has no geotransform, gcps, or rpcs. The identity matrix be returned.")
-            second_ext = basename(in_fp).split('.')[-2]
-            if second_ext == 'unw':
-                with rio.open(in_fp) as src:
-                    # 1st band is amplitude, 2nd band is unwrapped phase
-                    arr = src.read(2)
-            else:
-                with rio.open(in_fp) as src:
-                    arr = src.read(1)
-            d_arrs = {}
-            ext = second_ext
-            d_arrs[second_ext] = arr
-
-    # Save out tifs
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", message="Dataset has no geotransform, gcps, or rpcs. The identity matrix be returned.")
-        for name, arr in d_arrs.items():
-            with rio.open(join(tmp_dir, basename(in_fp) + f'.{name}.tif'), 'w', **profile) as dst:
-                dst.write(arr.astype(arr.dtype), 1)
-
-        tifs = glob(join(tmp_dir, f'*{ext}*.tif')) # list all .ext files
-        for tiff in tifs: # loop to open and translate .ext to .vrt, and save .vrt using gdal
-            raster_dataset = gdal.Open(tiff, gdal.GA_ReadOnly) # read in rasters
-            raster = gdal.Translate(join(tmp_dir, basename(tiff).replace('.tif','.vrt')), raster_dataset, format = 'VRT', outputType = gdal.GDT_Float64)
-        raster_dataset = None
-
-        vrts = glob(join(tmp_dir, f'*{ext}*.vrt'))
-        res_f = []
-        for f in vrts:
-            out_f = join(out_dir, basename(f).replace('vrt','tif'))
-            geocodeUsingGdalWarp(infile = f,
-                                latfile = latf,
-                                lonfile = longf,
-                                outfile = out_f,
-                                spacing=[.00005556,.00005556])
+            ext = basename(in_fp).split('.')[-2]
+            with rio.open(in_fp) as src:
+                # 1st band of unw is amplitude, 2nd band is unwrapped phase
+                arrs[ext] = src.read(2 if ext == 'unw' else 1)
+    else:
+        raise ValueError(f'Can not geolocate {ext} files. Use slc, lkv or vrt files.')
+    return ext, arrs
 
-            res_f.append(out_f)
+def geolocate_uavsar(in_fp, ann_fp, out_dir, llh_fp, spacing = DEFAULT_SPACING, bounds = None,
+                     method = 'nearest', tiff_profile = None, lookup_cache = True):
+    """
+    Geolocates a uavsar image using an array of latitudes and longitudes.
+    Can be either an SLC or Look Vector. If SLC will save as a tif of real
+    and a tif of complex values. The lookup from the output grid to the image
+    is computed once from the llh file and every product is resampled through
+    it from its memory map in blocks of rows. Products with more looks than the llh (e.g. 1x1 SLCs with a
+    2x8 llh) use the lookup scaled to their own shape.
+    in_fp: file path of file to geolocate or a list of co-registered files
+    ann_fp: file path to annotation file
+    out_dir: directory to save geolocated files
+    llh_fp: file path to UAVSAR lat, long, elev files for georeferencing
+    spacing: output pixel spacing in degrees [Default = 0.00005556]
+    bounds: (west, south, east, north) of the output [Default = extent of the llh]
+    method: 'nearest' or 'bilinear' resampling [Default = 'nearest']
+    tiff_profile: layout and compression of the output geotiffs (see convert.tiff_profile)
+    lookup_cache: directory to save and reuse lookup tables in so later products of the same
+        flight line skip the geometry. True uses out_dir/lookup_cache and False disables it.
+
+    returns:
+    List: files that have been created
+    """
 
-        if ext == 'unw':
-            print('Ignore the error message: Unable to compute bounds. It is related\n\
-                to the pixels created by the conversion along the edge of topography.\n\
-                Error message is known and should not be an issue.')
-        
-    shutil.rmtree(tmp_dir)
+    desc = read_annotation(ann_fp)
+    os.makedirs(out_dir, exist_ok=True)
+
+    nrows = desc[f'llh_1_2x8.set_rows']['value']
+    ncols = desc[f'llh_1_2x8.set_cols']['value']
+    if lookup_cache is True:
+        lookup_cache = join(out_dir, 'lookup_cache')
+    lookup = cached_lookup(llh_fp, nrows, ncols, cache_dir = lookup_cache or None, spacing = spacing,
+                           bounds = bounds, method = method)
+
+    res_f = []
+    for fp in ([in_fp] if isinstance(in_fp, (str, Path)) else in_fp):
+        fp = str(fp)
+        ext, arrs = _read_products(fp, desc)
+        for name, arr in arrs.items():
+            out_f = join(out_dir, (basename(fp) + f'.{name}.vrt').replace('vrt','tif'))
+            geocoded = lookup.resample(arr, nodata = GEOCODE_NODATA)
+            with TiffWriter(out_f, lookup.profile(dtype = geocoded.dtype), tiff_profile) as dst:
+                dst.write(geocoded)
+            res_f.append(out_f)
 
     return res_f
 
@@ -213,25 +161,121 @@ def reproject_clip_mask(in_fp, fp_to_match, out_fp):
     xds_repr_match.rio.to_raster(out_fp)
     return out_fp
 
-def combo_llhs(data_dir: Path):
+# Values (latitude, longitude and height) per llh pixel
+LLH_BANDS = ['lat', 'lon', 'height']
+
+def _llh_segments(data_dir, desc = None):
+    """
+    Segment llh files of a directory in segment order with their rows and columns.
+
+    Returns:
+        segments (list): (path, rows, cols) for each segment. Rows and columns are None
+            when they are not in the annotation.
+    """
+    segments = []
+    for llh in data_dir.glob('*.llh'):
+        parts = llh.stem.split('_')
+        # Only segment files (e.g. *_s1_2x8.llh), not a previously combined llh
+        if len(parts) < 2 or not re.fullmatch(r's\d+', parts[-2]):
+            continue
+        segment = parts[-2].replace('s','')
+        rows = cols = None
+        if desc is not None:
+            key = f'llh_{segment}_{parts[-1]}'
+            if f'{key}.set_rows' in desc:
+                rows, cols = desc[f'{key}.set_rows']['value'], desc[f'{key}.set_cols']['value']
+                if rows * cols * 3 * 4 != llh.stat().st_size:
+                    raise ValueError(f'{llh} does not have the {rows} x {cols} pixels in the annotation.')
+        segments.append((int(segment), llh, rows, cols))
+    # Sort numerically so segment 10 follows segment 9
+    segments.sort(key = lambda s: s[0])
+    return [s[1:] for s in segments]
+
+def _llh_vrt(segments, out_fp, ncols):
+    """
+    Writes a VRT mosaic of the segment llh files with latitude, longitude and height bands.
+    """
+    out_dir = dirname(os.path.abspath(out_fp))
+    total = 0
+    sources = {band: [] for band in LLH_BANDS}
+    for llh, rows, _ in segments:
+        if rows is None:
+            rows = llh.stat().st_size // (3 * 4 * ncols)
+        # Raw VRT of the segment's interleaved little endian floats
+        seg_vrt = join(out_dir, llh.stem + '.vrt')
+        bands = ''.join(f"""  <VRTRasterBand dataType="Float32" band="{i + 1}" subClass="VRTRawRasterBand">
+    <SourceFilename relativeToVRT="0">{llh.resolve()}</SourceFilename>
+    <ImageOffset>{4 * i}</ImageOffset>
+    <PixelOffset>12</PixelOffset>
+    <LineOffset>{12 * ncols}</LineOffset>
+    <ByteOrder>LSB</ByteOrder>
+  </VRTRasterBand>
+""" for i in range(3))
+        with open(seg_vrt, 'w') as f:
+            f.write(f'<VRTDataset rasterXSize="{ncols}" rasterYSize="{rows}">\n{bands}</VRTDataset>\n')
+        for i, band in enumerate(LLH_BANDS):
+            sources[band].append(f"""    <SimpleSource>
+      <SourceFilename relativeToVRT="0">{seg_vrt}</SourceFilename>
+      <SourceBand>{i + 1}</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="{ncols}" ySize="{rows}" />
+      <DstRect xOff="0" yOff="{total}" xSize="{ncols}" ySize="{rows}" />
+    </SimpleSource>
+""")
+        total += rows
+    bands = ''.join(f"""  <VRTRasterBand dataType="Float32" band="{i + 1}">
+    <Description>{band}</Description>
+{''.join(sources[band])}  </VRTRasterBand>
+""" for i, band in enumerate(LLH_BANDS))
+    with open(out_fp, 'w') as f:
+        f.write(f'<VRTDataset rasterXSize="{ncols}" rasterYSize="{total}">\n{bands}</VRTDataset>\n')
+    return out_fp
+
+def combo_llhs(data_dir: Path, out_fp = None, ann_fp = None, dtype = '>f', vrt = False, ncols = None):
     """
     Combines segment LLH files into a single combined llh file for georeferencing.
+    Segments are copied in order into a preallocated memory mapped file without
+    holding them in memory.
+
+    Args:
+        data_dir (Path): directory of the segment llh files (e.g. *_s1_2x8.llh, *_s2_2x8.llh)
+        out_fp (str): path of the combined llh [Default = full.llh (full.vrt for a VRT) in data_dir]
+        ann_fp (str): annotation file with the rows and columns of each segment (llh_<n>_2x8.set_rows).
+            Used to check the segment sizes and for the VRT. [Default = None]
+        dtype (str): data type of the combined llh [Default = big endian float32]
+        vrt (bool): write a VRT mosaic of the segments with lat, lon and height bands to out_fp
+            instead of copying them. Requires ann_fp or ncols. [Default = False]
+        ncols (int): columns of the llh files when there is no annotation [Default = None]
+    Returns:
+        full (np.memmap): interleaved lat, lon, height values of the combined llh, or the
+            path of the VRT if vrt is True
     """
+    data_dir = Path(data_dir)
     assert data_dir.exists()
+    if out_fp is None:
+        out_fp = str(data_dir.joinpath('full.vrt' if vrt else 'full.llh'))
 
-    re_llhs = {'lat':[], 'lon': [], 'height':[]}
-    for llh in sorted(data_dir.glob('*.llh')):
-        segment = llh.stem.split('_')[-2].replace('s','')
+    desc = read_annotation(ann_fp) if ann_fp else None
+    segments = _llh_segments(data_dir, desc)
+    if not segments:
+        raise ValueError(f'No llh files found in {data_dir}.')
 
-        data = np.fromfile(llh, np.dtype('<f'))
-        lat, lon, height = data[::3], data[1::3], data[2::3]
-        for key, da in zip(re_llhs.keys(), [lat, lon, height]):
-            re_llhs[key].extend(da)
-    full = np.empty(len(re_llhs['lat'])*3, dtype='>f')
-    full[0::3] = re_llhs['lat']
-    full[1::3] = re_llhs['lon']
-    full[2::3] = re_llhs['height']
+    if vrt:
+        ncols = ncols or segments[0][2]
+        if not ncols:
+            raise ValueError('Provide ann_fp or ncols to build a VRT.')
+        return _llh_vrt(segments, out_fp, ncols)
 
-    full.tofile('full.llh')
+    sizes = [llh.stat().st_size // 4 for llh, _, _ in segments]
+    full = np.memmap(out_fp, dtype = dtype, mode = 'w+', shape = (sum(sizes),))
+    start = 0
+    for (llh, _, _), size in zip(segments, sizes):
+        src = np.memmap(llh, dtype = np.dtype('<f'), mode = 'r', shape = (size,))
+        # Copy in blocks so only a block of each segment is paged in at a time
+        for i in range(0, size, 2**24):
+            stop = min(i + 2**24, size)
+            full[start + i:start + stop] = src[i:stop]
+        start += size
+        del src
+    full.flush()
 
     return full
@@ -1,21 +1,156 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import rasterio as rio
+from rasterio.windows import Window
+from uavsar_pytools.convert.tiff_profile import TiffWriter, resolve_profile
 
+# Offset of the v < -1 branch of arccos_theta
+_LOWER_OFFSET = np.arccos(-1 + 0.000001)
+# Pixels processed at a time so the arrays of a block stay in the CPU cache
+_BLOCK_PIXELS = 2**16
 
-def arccos_theta(v):
-    if v < 1 and v > -1:
-        return np.arccos(v)
-    elif v > 1 and v < 3:
-        return np.arccos(2-v)
-    elif v < -1 and v > -3:
-        return np.arccos(-1 + 0.000001) - np.arccos(2+v)
-    else:
-        return np.nan
+def arccos_theta(v, out = None):
+    """
+    Arccos extended to fold values between 1 and 3 and between -3 and -1 back into
+    the domain. Values outside of (-3, 3) and exactly -1 or 1 are NaN.
+
+    Parameters
+    ----------
+    v : np.array or float
+        Cosine of the incidence angle.
+    out : np.array
+        Optional buffer with the shape of v to write the result into.
+        Computed in the dtype of out (float32 arrays stay float32).
+
+    Returns
+    -------
+    theta : np.array
+        Angle in radians.
+    """
+    v = np.asarray(v)
+    if out is None:
+        out = np.empty(v.shape, dtype = v.dtype if v.dtype.kind == 'f' else np.float64)
+    if v.size and v.dtype.kind == 'f':
+        # Incidence angle cosines are non-negative outside of radar shadow, so the
+        # masks below are only needed for other inputs. fmin and fmax skip NaN, which
+        # stays NaN through both fast paths.
+        lo, hi = np.fmin.reduce(v, axis = None), np.fmax.reduce(v, axis = None)
+        if -1 < lo and hi < 1:
+            np.arccos(v, out = out, casting = 'unsafe')
+            return out if out.ndim else out[()]
+        if 0 <= lo and hi < 3:
+            # 1 - |1 - v| is v below 1 and the 2 - v fold above it
+            np.subtract(1, v, out = out, casting = 'unsafe')
+            np.abs(out, out = out)
+            np.subtract(1, out, out = out)
+            np.arccos(out, out = out)
+            # Only v == 1 folds to arccos(1) = 0 and it is NaN
+            if np.fmin.reduce(out, axis = None) == 0:
+                np.copyto(out, np.nan, where = out == 0)
+            return out if out.ndim else out[()]
+    # NaN outside of the open intervals (comparisons with NaN are False).
+    # Masks are computed first so out may be v itself.
+    w = np.abs(v)
+    invalid = w >= 3
+    invalid |= w == 1
+    invalid |= np.isnan(w)
+    # Fold the argument into (-1, 1): 1 < v < 3 -> 2 - v and -3 < v < -1 -> 2 + v.
+    # Skipped when nothing needs folding, which is the usual case for incidence angles.
+    folded = w > 1
+    with np.errstate(invalid = 'ignore'):
+        if folded.any():
+            lower = v < -1
+            np.copyto(out, v, casting = 'unsafe')
+            np.subtract(2, v, out = out, where = folded & ~lower, casting = 'unsafe')
+            np.add(2, v, out = out, where = lower, casting = 'unsafe')
+            np.arccos(out, out = out)
+            np.subtract(out.dtype.type(_LOWER_OFFSET), out, out = out, where = lower)
+        else:
+            np.arccos(v, out = out, casting = 'unsafe')
+    np.copyto(out, np.nan, where = invalid)
+    return out if out.ndim else out[()]
 
-arccos_theta = np.vectorize(arccos_theta)
+def _read(arr, name, shape = None, dtype = np.float32):
+    if type(arr) == str:
+        with rio.open(arr) as src:
+            arr = src.read(1)
+    elif type(arr) != np.ndarray:
+        raise ValueError(f'Pass filepath or np.array for {name} data.')
+    if shape is not None:
+        assert arr.shape == shape, 'Look vector data must be the same shape as DEM data.'
+    return arr.astype(dtype, copy = False)
 
+def _double_gradient(dem, rows, cols, out):
+    """
+    Twice the gradient of dem along its first axis (in pixels) over rows (start, stop)
+    and the cols slice. Central differences inside dem and doubled one sided differences
+    on its edges, as np.gradient.
+    """
+    (r0, r1), n = rows, dem.shape[0]
+    a, b = max(r0, 1), min(r1, n - 1)
+    if a < b:
+        np.subtract(dem[a + 1:b + 1, cols], dem[a - 1:b - 1, cols], out = out[a - r0:b - r0])
+    if r0 == 0:
+        np.subtract(dem[1, cols], dem[0, cols], out = out[0])
+        out[0] *= 2
+    if r1 == n:
+        np.subtract(dem[n - 1, cols], dem[n - 2, cols], out = out[-1])
+        out[-1] *= 2
+
+def _inc_block(dem, x, y, z, pixel_size, out, crop, scratch = None):
+    """
+    Incidence angle of a block. dem has a one pixel halo around the block where
+    available, so the gradient matches the gradient of the full DEM, and crop
+    selects the block from it. The gradient is taken with slices of the halo straight
+    into out and the rest of the calculation is done in place. scratch holds two
+    buffers of at least the block size to reuse between blocks.
+    """
+    (r0, r1, _), (c0, c1, _) = [c.indices(n) for c, n in zip(crop, dem.shape)]
+    shape = (r1 - r0, c1 - c0)
+    size = shape[0] * shape[1]
+    if scratch is None:
+        scratch = np.empty((2, size), dtype = out.dtype)
+    tmp, tmp2 = [buf[:size].reshape(shape) for buf in scratch]
+
+    # Cosine of the incidence angle: -(lkv . [dx, dy, 1]) / |lkv|. dx is the gradient
+    # along rows and dy along columns (np.gradient order).
+    _double_gradient(dem, (r0, r1), slice(c0, c1), out)
+    out *= x
+    _double_gradient(dem.T, (c0, c1), slice(r0, r1), tmp.T)
+    tmp *= y
+    out += tmp
+    out *= out.dtype.type(-0.5 / pixel_size)
+    out -= z
+    np.multiply(x, x, out = tmp)
+    tmp += np.multiply(y, y, out = tmp2)
+    tmp += np.multiply(z, z, out = tmp2)
+    np.sqrt(tmp, out = tmp)
+    with np.errstate(invalid = 'ignore'):
+        # Zero length look vectors give 0 / 0 = NaN
+        out /= tmp
+
+    # Calculate incidence angle
+    arccos_theta(out, out = out)
+    out *= out.dtype.type(180 / np.pi)
+
+def _inc_blocks(dem, x, y, z, pixel_size, out, crop, block_rows = None):
+    """
+    Incidence angle of the crop of dem in strips of block_rows rows, each with a one
+    row halo of dem where available. x, y, z and out have the shape of the crop.
+    """
+    (r0, r1, _), (c0, c1, _) = [c.indices(n) for c, n in zip(crop, dem.shape)]
+    if block_rows is None:
+        block_rows = max(1, _BLOCK_PIXELS // max(c1 - c0, 1))
+    scratch = np.empty((2, min(block_rows, r1 - r0) * (c1 - c0)), dtype = out.dtype)
+    for start in range(r0, r1, block_rows):
+        stop = min(start + block_rows, r1)
+        lo, hi = max(start - 1, 0), min(stop + 1, dem.shape[0])
+        strip = slice(start - r0, stop - r0)
+        _inc_block(dem[lo:hi], x[strip], y[strip], z[strip], pixel_size, out[strip],
+                   (slice(start - lo, stop - lo), slice(c0, c1)), scratch)
 
-def calc_inc_angle(dem, lkv_x, lkv_y, lkv_z, pixel_size=5.556):
+def calc_inc_angle(dem, lkv_x, lkv_y, lkv_z, pixel_size=5.556, out = None, dtype = np.float32, block_rows = None):
     """
     Calculates UAVSAR incidence angle from DEM and look vector components.
 
@@ -25,55 +160,116 @@ def calc_inc_angle(dem, lkv_x, lkv_y, lkv_z, pixel_size=5.556):
         Elevation data and the three components of the look vector.
         Strings are treated as filepaths to be handled by rasterio.
     pixel_size : float
-        Pixel size of all components in [m]. Default value is for 
+        Pixel size of all components in [m]. Default value is for
         UAVSAR images from JPL.
-    
+    out : np.array
+        Optional buffer with the shape of the DEM to write the incidence angle into.
+    dtype : np.dtype
+        Data type the calculation is done in. Default is float32.
+    block_rows : int
+        Rows processed at a time. Default is about 65k pixels per block, so the
+        arrays of a block stay in the CPU cache.
+
     Returns
     -------
     inc : np.array
         Incidence angle in degrees.
     """
-    # Calculate gradient of DEM
-    if type(dem) == str:
-        with rio.open(dem) as src:
-            dem_arr = src.read(1)
-            dx, dy = np.gradient(dem_arr, pixel_size)
-            dem_shape = dem_arr.shape
-    elif type(dem) == np.ndarray:
-        dx, dy = np.gradient(dem, pixel_size)
-        dem_shape = dem.shape
-    else:
-        raise ValueError('Pass filepath or np.array for DEM data.')
-
+    dem = _read(dem, 'DEM', dtype = dtype)
     # Look vectors
-    lkv = {}
-    components = [lkv_x, lkv_y, lkv_z]
-    directions = ['x','y','z']
-
-    for comp_idx, vector in enumerate(components):
-        if type(vector) == str:
-            with rio.open(vector) as src:
-                lkv[directions[comp_idx]] = src.read(1)
-        elif type(vector) == np.ndarray:
-            assert vector.shape == dem_shape, 'Look vector data must be the same shape as DEM data.'
-            lkv[directions[comp_idx]] = vector
-        else:
-            raise ValueError('Pass filepath or np.array for DEM data.')
-        
-    # Calculate look vector magnitude
-    lkv_mag = np.zeros_like(lkv['x'])
-    for direction, arr in lkv.items():
-        lkv_mag = lkv_mag + arr**2
-    lkv_mag = lkv_mag**0.5
-    lkv_mag[lkv_mag == 0] = np.nan
-    # Unit vectors
-    unit_lkv = {}
-    for direction, arr in lkv.items():
-        unit_lkv[direction] = -arr/lkv_mag
+    x, y, z = [_read(v, 'look vector', shape = dem.shape, dtype = dtype) for v in [lkv_x, lkv_y, lkv_z]]
+    if out is None:
+        out = np.empty(dem.shape, dtype = dtype)
 
-    # Calculate incidence angle
-    inc_cos = unit_lkv['x']*dx + unit_lkv['y']*dy + unit_lkv['z']
-    inc = arccos_theta(inc_cos)
+    _inc_blocks(dem, x, y, z, pixel_size, out, (slice(None), slice(None)), block_rows)
+    return out
+
+def _tile_windows(height, width, tile_size):
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+def calc_inc_angle_tiff(dem_fp, lkv_x_fp, lkv_y_fp, lkv_z_fp, out_fp, pixel_size=5.556, tile_size = 1024, workers = 1,
+                        tiff_profile = None):
+    """
+    Calculates UAVSAR incidence angle from DEM and look vector geotiffs tile by tile
+    and writes it to a geotiff, so rasters larger than memory can be processed. Tiles
+    are read with a one pixel halo so the DEM gradient is exact at tile edges.
+
+    Parameters
+    ----------
+    dem_fp, lkv_x_fp, lkv_y_fp, lkv_z_fp : str
+        Filepaths of the elevation data and the three components of the look vector.
+        All rasters must have the same shape.
+    out_fp : str
+        Filepath of the incidence angle geotiff to write. Georeferenced like the DEM.
+    pixel_size : float
+        Pixel size of all components in [m]. Default value is for
+        UAVSAR images from JPL.
+    tile_size : int
+        Size in pixels of the square tiles processed at a time. Default is 1024.
+    workers : int
+        Number of threads processing tiles in parallel. Default is 1.
+    tiff_profile : str or dict
+        Layout and compression of the output, e.g. 'cog' (see
+        convert.tiff_profile.resolve_profile). Default is tiled and uncompressed.
+
+    Returns
+    -------
+    out_fp : str
+        Filepath of the incidence angle geotiff in degrees.
+    """
+    fps = [dem_fp, lkv_x_fp, lkv_y_fp, lkv_z_fp]
+    with rio.open(dem_fp) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+    for fp in fps[1:]:
+        with rio.open(fp) as src:
+            assert (src.height, src.width) == (height, width), 'Look vector data must be the same shape as DEM data.'
+
+    profile.update(driver = 'GTiff', dtype = 'float32', count = 1, nodata = np.nan)
+    options = resolve_profile(tiff_profile)
+    if tile_size % 16 == 0 and 'blocksize' not in options:
+        options['blocksize'] = min(tile_size, 512)
+
+    # Datasets are not thread safe so each thread opens its own
+    local = threading.local()
+    opened = []
+    def compute(window):
+        if not hasattr(local, 'srcs'):
+            local.srcs = [rio.open(fp) for fp in fps]
+            opened.extend(local.srcs)
+        dem_src, x_src, y_src, z_src = local.srcs
+        r0, c0 = window.row_off, window.col_off
+        r1, c1 = r0 + window.height, c0 + window.width
+        lo_r, lo_c = max(r0 - 1, 0), max(c0 - 1, 0)
+        hi_r, hi_c = min(r1 + 1, height), min(c1 + 1, width)
+        halo = Window(lo_c, lo_r, hi_c - lo_c, hi_r - lo_r)
+        dem = dem_src.read(1, window = halo).astype(np.float32, copy = False)
+        x, y, z = [src.read(1, window = window).astype(np.float32, copy = False) for src in [x_src, y_src, z_src]]
+        out = np.empty(x.shape, dtype = np.float32)
+        crop = (slice(r0 - lo_r, r1 - lo_r), slice(c0 - lo_c, c1 - lo_c))
+        _inc_blocks(dem, x, y, z, pixel_size, out, crop)
+        return out
 
-    return np.rad2deg(inc)
-    
\ No newline at end of file
+    windows = list(_tile_windows(height, width, tile_size))
+    try:
+        with TiffWriter(out_fp, profile, options) as dst:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers = workers) as executor:
+                    # Keep a bounded number of tiles in flight so memory use stays flat
+                    pending = {}
+                    for i, window in enumerate(windows):
+                        pending[i] = executor.submit(compute, window)
+                        if len(pending) >= 2 * workers:
+                            j = min(pending)
+                            dst.write(pending.pop(j).result(), window = windows[j])
+                    for j in sorted(pending):
+                        dst.write(pending[j].result(), window = windows[j])
+            else:
+                for window in windows:
+                    dst.write(compute(window), window = window)
+    finally:
+        for src in opened:
+            src.close()
+    return out_fp
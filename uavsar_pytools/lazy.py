@@ -0,0 +1,174 @@
+"""
+Lazy xarray/dask access to UAVSAR binaries. Images are memory mapped and wrapped in
+chunked dask arrays so nothing is read from disk until the data is computed.
+"""
+
+import os
+import re
+from os.path import basename, isdir, join
+import numpy as np
+import pandas as pd
+import dask.array as da
+import xarray as xr
+import rioxarray
+import logging
+
+from uavsar_pytools.convert.annotation import read_annotation
+from uavsar_pytools.convert.binary_reader import open_binary
+from uavsar_pytools.convert.tiff_conversion import _split_extensions, image_search, _binary_layout, pair_annotations
+from uavsar_pytools.catalog import scene_times
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Binary image types that can be opened
+_BINARY_TYPES = {'grd', 'mlc', 'slc', 'unw', 'int', 'cor', 'amp1', 'amp2', 'hgt', 'slope', 'inc'}
+
+class BinaryArray():
+    """
+    Array like view of a UAVSAR binary for dask.array.from_array. Only the path and
+    layout are stored so it pickles cheaply, and each read maps the file and returns
+    a native byte order copy with no data values set to NaN.
+
+    Args:
+        in_fp (str): path to binary file
+        shape (tuple): rows and columns of the image
+        dtype (np.dtype): dtype of the binary values (see annotation_dtype)
+        nodata (tuple): values to set to NaN
+        band (int): index of the value to read for pixel interleaved images (e.g. slopes) [Default = None]
+        bands (int): number of pixel interleaved values [Default = 1]
+    """
+    def __init__(self, in_fp, shape, dtype, nodata, band = None, bands = 1):
+        self.in_fp = in_fp
+        self.file_shape = tuple(shape)
+        self.file_dtype = np.dtype(dtype)
+        self.nodata = nodata
+        self.band = band
+        self.bands = bands
+        self.shape = self.file_shape
+        self.dtype = self.file_dtype.newbyteorder('=')
+        self.ndim = 2
+
+    def __getitem__(self, key):
+        mm = open_binary(self.in_fp, self.file_shape, self.file_dtype, bands = self.bands)
+        if self.band is not None:
+            mm = mm[..., self.band]
+        arr = np.array(mm[key], dtype = self.dtype)
+        for value in self.nodata:
+            arr[arr == value] = np.nan
+        return arr
+
+def _coords(profile, shape, y_dim, x_dim):
+    """
+    Pixel center coordinates of a ground projected image from its geotransform.
+    """
+    t = profile['transform']
+    return {y_dim: t.f + t.e * (np.arange(shape[0]) + 0.5), x_dim: t.c + t.a * (np.arange(shape[1]) + 0.5)}
+
+def _tiff_name(fp):
+    """
+    Variable name of a converted geotiff, e.g. cor, slope_east or HHVV for polsar images.
+    """
+    stem = basename(fp).rsplit('.', 1)[0]
+    parts = [p for p in stem.split('.')[1:] if p not in ('grd', 'slc', 'mlc')]
+    if parts:
+        return '_'.join(parts)
+    pol = re.search(r'_L\d{3}([HV]{4})', stem)
+    return pol.group(1) if pol else stem
+
+def _source_fps(source):
+    """
+    Binary (or geotiff) paths of a UavsarScene, directory, list of paths or single path.
+    """
+    if hasattr(source, 'binary_fps'):
+        fps = [fp for fp in source.binary_fps if os.path.exists(fp)]
+        if not fps and source.images:
+            # Binaries were cleaned up so fall back to the converted geotiffs
+            for image in source.images.values():
+                fps.extend(image['out_fp'] if isinstance(image['out_fp'], list) else [image['out_fp']])
+        return fps
+    if isinstance(source, str):
+        if isdir(source):
+            return [join(source, f) for f in sorted(os.listdir(source))]
+        return [source]
+    return list(source)
+
+def open_uavsar(source, chunks = 1024, pols = None, products = None):
+    """
+    Opens UAVSAR images as a lazy, chunked xarray Dataset. Each image (product or polarization)
+    is a variable and no data is read until it is computed. Ground projected images have
+    latitude (y) and longitude (x) coordinates and a WGS84 CRS.
+
+    Args:
+        source (UavsarScene, str or list): scene, directory of binaries and annotation files,
+            list of paths or a single binary path. Geotiffs (.tif/.tiff) are opened with rioxarray.
+        chunks (int): number of rows per chunk [Default = 1024]
+        pols (list): only open images with these polarizations (e.g. ['VV']) [Default = all]
+        products (list): only open these products (e.g. ['unw', 'cor']) [Default = all]
+    Returns:
+        ds (xr.Dataset): lazy dataset. The acquisition start time is a scalar time coordinate
+            if found in the annotation so scenes can be concatenated along time.
+    """
+    fps = _source_fps(source)
+    if pols:
+        fps = [fp for fp in fps if fp.endswith('.ann') or any(pol in basename(fp) for pol in pols)]
+    ann_fps = [fp for fp in fps if fp.endswith('.ann')]
+    tiff_fps = [fp for fp in fps if fp.endswith('.tif') or fp.endswith('.tiff')]
+    bin_fps = [fp for fp in fps if fp not in ann_fps and fp not in tiff_fps and _split_extensions(fp)[0] in _BINARY_TYPES]
+    if products:
+        bin_fps = [fp for fp in bin_fps if _split_extensions(fp)[0] in products]
+        tiff_fps = [fp for fp in tiff_fps if any(p in basename(fp).split('.')[1:] for p in products)]
+
+    variables = {}
+    grids = []
+    desc = None
+    if bin_fps and not ann_fps:
+        raise ValueError('No annotation file found for binary files.')
+    for in_fp, ann_fp in pair_annotations(bin_fps, ann_fps):
+        desc = read_annotation(ann_fp)
+        type, ext = _split_extensions(in_fp)
+        search, type, anc = image_search(in_fp, desc, type, ext)
+        shape, dtype, nodata, profile, bands, _ = _binary_layout(desc, search, type, ext, anc, in_fp)
+        names = [type] if bands == [None] else [f'{type}_{d}' for d in ['east', 'north']]
+        for name, band in zip(names, bands):
+            arr = BinaryArray(in_fp, shape, dtype, nodata, band = band, bands = len(bands) if band is not None else 1)
+            data = da.from_array(arr, chunks = (chunks, shape[1]), lock = False, asarray = False, name = f'uavsar-{basename(in_fp)}-{name}')
+            variables[name] = (data, profile)
+
+    for fp in tiff_fps:
+        name = _tiff_name(fp)
+        arr = rioxarray.open_rasterio(fp, chunks = {'y': chunks}, mask_and_scale = True).squeeze('band', drop = True)
+        variables[name] = (arr, None)
+
+    # Variables on the same grid share dimensions, others get their own
+    data_vars = {}
+    coords = {}
+    crs = None
+    for name, (data, profile) in variables.items():
+        transform = data.rio.transform() if profile is None else profile.get('transform')
+        grid = (data.shape, tuple(transform) if transform else None)
+        if grid not in grids:
+            grids.append(grid)
+        i = grids.index(grid)
+        y_dim, x_dim = ('y', 'x') if i == 0 else (f'y_{i}', f'x_{i}')
+        if profile is None:
+            data = data.rename({'y': y_dim, 'x': x_dim})
+            coords.update({y_dim: data[y_dim].values, x_dim: data[x_dim].values})
+            crs = crs or data.rio.crs
+            data_vars[name] = ((y_dim, x_dim), data.data)
+        else:
+            if 'transform' in profile:
+                coords.update(_coords(profile, data.shape, y_dim, x_dim))
+                crs = crs or profile['crs']
+            data_vars[name] = ((y_dim, x_dim), data)
+
+    ds = xr.Dataset(data_vars, coords = coords)
+    if desc is not None:
+        start, _ = scene_times(desc)
+        if start:
+            ds = ds.assign_coords(time = pd.Timestamp(start))
+    if crs is not None and 'x' in ds.dims:
+        ds = ds.rio.write_crs(crs)
+    if hasattr(source, 'pair_name'):
+        ds.attrs['pair_name'] = source.pair_name
+    return ds
@@ -0,0 +1,222 @@
+"""
+Calibration of the phase reference of unwrapped interferograms with ground truth
+snow depth changes (e.g. snow pits or SNOTEL stations). The offset of each pair is
+solved from the phase predicted by phase_from_depth at the observation points and
+added to the interferogram before depth_from_phase or invert_stack.
+"""
+
+import os
+import warnings
+from os.path import join, basename
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.crs import CRS
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window
+from uavsar_pytools.convert.tiff_profile import TiffWriter
+from uavsar_pytools.incidence_angle import _tile_windows
+from uavsar_pytools.snow_depth_inversion import geometry_term, permittivity_from_density
+
+import logging
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+def point_coords(points):
+    """
+    Gets the coordinates of a table of points.
+
+    Args:
+        points (DataFrame): GeoDataFrame of points or DataFrame with x and y (or lon and lat) columns.
+    Returns:
+        xs (array): x coordinates
+        ys (array): y coordinates
+        crs (CRS or None): crs of a GeoDataFrame, otherwise None
+    """
+    if 'geometry' in points and hasattr(points, 'crs'):
+        return points.geometry.x.values, points.geometry.y.values, points.crs
+    for x, y in [('x', 'y'), ('lon', 'lat')]:
+        if x in points and y in points:
+            return points[x].values.astype(np.float64), points[y].values.astype(np.float64), None
+    raise ValueError('Points need a geometry or x and y (or lon and lat) columns.')
+
+def sample_raster(fp, xs, ys, crs = None, radius = 0, tile_size = 512):
+    """
+    Samples a raster at points. Points are bucketed by the tile of the raster they fall
+    in, so the part of each tile holding points is read once and all its points are
+    gathered with a single vectorized index.
+
+    Args:
+        fp (str): filepath of the raster
+        xs (array): x coordinates of the points
+        ys (array): y coordinates of the points
+        crs (optional): crs of the coordinates if different to the raster
+        radius (int): if above 0 the median of the (2 * radius + 1) pixel box around each
+            point is returned instead of the value of the pixel itself. Default is 0.
+        tile_size (int): size in pixels of the tiles read at a time. Default is 512.
+    Returns:
+        values (array): float64 values at each point. NaN for nodata and points outside the raster.
+    """
+    xs, ys = np.atleast_1d(np.asarray(xs, dtype = np.float64)), np.atleast_1d(np.asarray(ys, dtype = np.float64))
+    values = np.full(len(xs), np.nan)
+    with rio.open(fp) as src:
+        if crs is not None and src.crs is not None and CRS.from_user_input(crs) != src.crs:
+            xs, ys = map(np.asarray, warp_transform(crs, src.crs, xs, ys))
+        cols, rows = ~src.transform * (xs, ys)
+        rows, cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+        if len(inside) == 0:
+            return values
+
+        # Group the points by the tile they fall in
+        tiles = (rows[inside] // tile_size) * (src.width // tile_size + 1) + cols[inside] // tile_size
+        order = np.argsort(tiles, kind = 'stable')
+        inside, tiles = inside[order], tiles[order]
+        starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]])
+        dr, dc = [d.ravel() for d in np.mgrid[-radius:radius + 1, -radius:radius + 1]]
+
+        for idx in np.split(inside, starts[1:]):
+            r, c = rows[idx], cols[idx]
+            # Only read the part of the tile around its points
+            r0, c0 = r.min() - radius, c.min() - radius
+            h, w = r.max() + radius + 1 - r0, c.max() + radius + 1 - c0
+            lo_r, lo_c = max(r0, 0), max(c0, 0)
+            hi_r, hi_c = min(r0 + h, src.height), min(c0 + w, src.width)
+            block = np.full((h, w), np.nan)
+            data = src.read(1, window = Window(lo_c, lo_r, hi_c - lo_c, hi_r - lo_r), masked = True)
+            block[lo_r - r0:hi_r - r0, lo_c - c0:hi_c - c0] = data.astype(np.float64).filled(np.nan)
+            samples = block[(r - r0)[:, None] + dr, (c - c0)[:, None] + dc]
+            with warnings.catch_warnings():
+                # Points with no valid pixels in their box are left as NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                values[idx] = np.nanmedian(samples, axis = 1)
+    return values
+
+def solve_offset(phase, delta_sd, inc_angle, permittivity = None, density = None,
+                 method = 'guneriussen2001', wavelength = 0.238403545):
+    """
+    Solves the phase offset of an interferogram from observed snow depth changes.
+    The offset is the median difference between the phase predicted from the depth
+    changes and the measured phase, so single bad observations have little effect.
+
+    Args:
+        phase (array): unwrapped phase [radians] at the points
+        delta_sd (array): observed snow depth change [m] at the points
+        inc_angle (array or float): incidence angle [radians] at the points
+        permittivity (array or float): snow permittivity at the points. If given, density is ignored.
+        density (array or float): snow density [kg m-3] at the points
+        method (str): method to calculate permittivity from density. Default is 'guneriussen2001'.
+        wavelength (float): radar wavelength [m]. Default is UAVSAR L-band.
+    Returns:
+        offset (float): phase to add to the interferogram [radians]. NaN without valid points.
+        points (int): number of valid points used
+        residual (float): median absolute residual phase after the offset [radians]
+    """
+    if permittivity is None:
+        if density is None:
+            raise ValueError('Please provide either permittivity or density data.')
+        permittivity = permittivity_from_density(np.asarray(density, dtype = np.float64), method)
+    geometry = geometry_term(inc_angle, permittivity)
+    expected = -4 * np.pi / wavelength * np.asarray(delta_sd, dtype = np.float64) * geometry
+    diff = np.atleast_1d(expected - np.asarray(phase, dtype = np.float64))
+    diff = diff[~np.isnan(diff)]
+    if len(diff) == 0:
+        return np.nan, 0, np.nan
+    offset = np.median(diff)
+    return float(offset), len(diff), float(np.median(np.abs(diff - offset)))
+
+def _at_points(value, i, points, xs, ys, crs, radius):
+    """
+    Value of an input at the points. Lists hold one input per pair, strings are either
+    columns of the points table or raster filepaths and anything else is used as is.
+    """
+    if isinstance(value, (list, tuple)):
+        value = value[i]
+    if isinstance(value, str):
+        if value in points:
+            return points[value].values.astype(np.float64)
+        return sample_raster(value, xs, ys, crs = crs, radius = radius)
+    return value
+
+def calibrate_pairs(phase_fps, points, inc_angle, density = None, permittivity = None,
+                    method = 'guneriussen2001', wavelength = 0.238403545, inc_degrees = False,
+                    radius = 0, pair_column = 'pair', depth_column = 'delta_sd', pairs = None):
+    """
+    Solves the phase offset of each interferogram of a stack from a table of ground
+    truth snow depth changes.
+
+    Args:
+        phase_fps (list): filepaths of unwrapped phase rasters [radians]
+        points (DataFrame): observations with one row per point and pair. Needs point
+            coordinates (see point_coords), a pair column with the id of the pair (see
+            pairs) and a depth change [m] column.
+        inc_angle (str, float or list): incidence angle raster filepath, points column,
+            constant or list of one per pair
+        density (str, float or list): snow density [kg m-3] in the same forms
+        permittivity (str, float or list): snow permittivity in the same forms. Overrides density.
+        method (str): method to calculate permittivity from density. Default is 'guneriussen2001'.
+        wavelength (float): radar wavelength [m]. Default is UAVSAR L-band.
+        inc_degrees (bool): True if incidence angles are in degrees. Default is radians.
+        radius (int): pixel radius of the box around each point to take the median
+            phase of (see sample_raster). Default is 0.
+        pair_column (str): name of the pair column. Default is 'pair'.
+        depth_column (str): name of the depth change column. Default is 'delta_sd'.
+        pairs (list): pair id of each phase raster, matched exactly to the pair column.
+            Defaults to the basename of each raster without extensions (e.g.
+            'lowman_23205_21002-004_21004-003_0007d_s01_VV_01' for '...VV_01.unw.tif').
+    Returns:
+        offsets (DataFrame): pair, phase_fp, offset, points and residual (see solve_offset) of each pair
+    """
+    if permittivity is None and density is None:
+        raise ValueError('Please provide either permittivity or density data.')
+    for column in [pair_column, depth_column]:
+        if column not in points:
+            raise ValueError(f'Points are missing the {column} column.')
+    if pairs is None:
+        pairs = [basename(fp).split('.')[0] for fp in phase_fps]
+    if len(pairs) != len(phase_fps):
+        raise ValueError('Provide one pair id for each phase raster.')
+    point_pairs = points[pair_column].astype(str).values
+
+    results = []
+    for i, (fp, pair) in enumerate(zip(phase_fps, pairs)):
+        sel = points[point_pairs == str(pair)]
+        xs, ys, crs = point_coords(sel)
+        args = (i, sel, xs, ys, crs)
+        phase = sample_raster(fp, xs, ys, crs = crs, radius = radius)
+        inc = _at_points(inc_angle, *args, 0)
+        if inc_degrees:
+            inc = np.deg2rad(inc)
+        offset, n, residual = solve_offset(phase, sel[depth_column].values, inc,
+                                           permittivity = _at_points(permittivity, *args, 0),
+                                           density = _at_points(density, *args, 0),
+                                           method = method, wavelength = wavelength)
+        if n == 0:
+            log.warning(f'No valid points to calibrate {fp}.')
+        results.append({'pair': pair, 'phase_fp': fp, 'offset': offset, 'points': n, 'residual': residual})
+    return pd.DataFrame(results, columns = ['pair', 'phase_fp', 'offset', 'points', 'residual'])
+
+def apply_offset(phase_fp, offset, out_fp = None, tile_size = 1024, tiff_profile = None):
+    """
+    Adds a phase offset to an interferogram tile by tile and writes it to a geotiff.
+
+    Args:
+        phase_fp (str): filepath of the unwrapped phase raster
+        offset (float): phase offset to add [radians] (see calibrate_pairs)
+        out_fp (str): filepath to write to. Defaults to <phase_fp stem>.cal.tif.
+        tile_size (int): size in pixels of the tiles processed at a time. Default is 1024.
+        tiff_profile (str or dict): layout and compression of the output (see convert.tiff_profile)
+    Returns:
+        out_fp (str): filepath of the calibrated raster
+    """
+    if out_fp is None:
+        out_fp = join(os.path.dirname(phase_fp), basename(phase_fp).rsplit('.', 1)[0] + '.cal.tif')
+    with rio.open(phase_fp) as src:
+        profile = src.profile.copy()
+        profile.update(driver = 'GTiff', dtype = 'float32', count = 1, nodata = np.nan)
+        with TiffWriter(out_fp, profile, tiff_profile) as dst:
+            for window in _tile_windows(src.height, src.width, tile_size):
+                block = src.read(1, window = window, masked = True).astype(np.float32).filled(np.nan)
+                block += np.float32(offset)
+                dst.write(block, window = window)
+    return out_fp
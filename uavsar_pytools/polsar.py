@@ -20,12 +20,113 @@ from itertools import combinations
 from itertools import combinations_with_replacement
 import matplotlib.pyplot as plt
 from pathlib import Path
-from uavsar_pytools.convert.tiff_conversion import read_annotation, array_to_tiff
+from rasterio.windows import Window
+from rasterio.transform import Affine
+from uavsar_pytools.convert.tiff_conversion import read_annotation, array_to_tiff, grd_geotransform
+from uavsar_pytools.convert.binary_reader import open_binary, read_window
+from uavsar_pytools.convert.tiff_profile import TiffWriter
 
 log = logging.getLogger(__name__)
 logging.basicConfig()
 log.setLevel(logging.DEBUG)
 
+# Order of the crossproducts along the last axis of a polsar stack
+POLSAR_ORDER = ['HHHH', 'HHHV', 'HVHV', 'HVVV', 'HHVV', 'VVVV']
+COMPLEX_POLS = ['HHHV', 'HVVV', 'HHVV']
+# Approximate peak bytes per pixel of a decomposed strip (complex input stack,
+# T3, float64 eigenvalue terms and outputs). Used to size strips.
+DECOMP_BYTES_PER_PIXEL = 400
+# Approximate peak bytes per input pixel of multilooking a strip (complex128
+# summed-area table of the crossproducts and valid pixel count).
+MULTILOOK_BYTES_PER_PIXEL = 160
+MULTILOOK_MODES = ['decimate', 'sliding']
+
+def find_polsar_files(in_dir):
+    """
+    Finds the six crossproduct images of a UAVSAR polsar scene. GRD binaries 
+    are used unless the directory contains converted tiffs.
+
+    Arguments
+    ---------
+    in_dir : str
+        Input directory that contains UAVSAR GRD data and the associated .ann 
+        file or tiffs converted from them along with the scene csv.
+
+    Returns
+    -------
+    fps : dict
+        File path of each crossproduct keyed by polarization (e.g. 'HHHV').
+    desc : dict
+        Description of the scene from the annotation file (or csv for tiffs).
+    kind : str
+        'grd' or 'tiff'.
+    shape : tuple
+        Number of rows and columns of the scene.
+    """
+    req_pols = set(POLSAR_ORDER)
+    # Check for tiffs:
+    tiffs = glob(join(in_dir, '*.tiff'))
+    fps = {}
+
+    if len(tiffs) == 0:
+        log.info('No tiffs found. Searching for grd files.')
+        kind = 'grd'
+        # Read ann file
+        ann_fp = glob(join(in_dir, '*.ann'))[0]
+        desc = read_annotation(ann_fp)
+        shape = (desc['grd_pwr.set_rows']['value'], desc['grd_pwr.set_cols']['value'])
+        for f in glob(join(in_dir, '*.grd')):
+            fps[basename(f).split('_')[-3][4:]] = f
+    else:
+        kind = 'tiff'
+        desc = pd.read_csv(glob(join(in_dir, '*.csv'))[0], index_col = [0]).to_dict()
+        for f in tiffs:
+            fps[basename(f).split('_')[5][4:]] = f
+        with rio.open(tiffs[0]) as src:
+            shape = src.shape
+
+    missing_pols = req_pols - req_pols.intersection(fps.keys())
+    assert len(missing_pols) == 0, f'Missing required polarizations : {missing_pols}'
+
+    return fps, desc, kind, shape
+
+def read_polsar_rows(fps, kind, shape, start, stop, cols = None):
+    """
+    Reads a strip of rows from the six crossproduct images into a stack. GRD
+    binaries are memory mapped so only the requested rows are read from disk.
+
+    Arguments
+    ---------
+    fps, kind, shape :
+        Output of the find_polsar_files function.
+    start, stop : int
+        First and (exclusive) last row of the strip.
+    cols : slice (Optional)
+        Columns to read. Defaults to all columns.
+
+    Returns
+    -------
+    stack : np.array
+        Array of size [rows x columns x 6] with complex64 dtype.
+    """
+    nrows, ncols = shape
+    stop = min(stop, nrows)
+    cols = slice(None) if cols is None else cols
+    col_start, col_stop, _ = cols.indices(ncols)
+    stack = np.empty((stop - start, col_stop - col_start, 6), dtype = np.complex64)
+    for i, name in enumerate(POLSAR_ORDER):
+        if kind == 'grd':
+            dtype = np.complex64 if name in COMPLEX_POLS else np.float32
+            mm = open_binary(fps[name], shape, dtype)
+            arr = read_window(mm, rows = slice(start, stop), cols = cols, nodata = (0,))
+            del mm
+        else:
+            with rio.open(fps[name]) as src:
+                arr = src.read(1, window = Window(col_start, start, col_stop - col_start, stop - start))
+        stack[..., i] = arr
+
+    return stack
+
 def get_polsar_stack(in_dir, bounds = False):
     """
     Reads UAVSAR GRD files or tiffs from input directory.
@@ -45,47 +146,12 @@ def get_polsar_stack(in_dir, bounds = False):
     stack : np.array
         Array of size [rows x columns x 6] containing UAVSAR data.
     """
-    req_pols = set(['VVVV', 'HVHV', 'HVVV', 'HHHV', 'HHVV', 'HHHH'])
-    # Check for tiffs:
-    fps = glob(join(in_dir, '*.tiff'))
-    pol = {}
-
-    if len(fps) == 0:
-        log.info('No tiffs found. Searching for grd files.')
-        # Read ann file
-        ann_fp = glob(join(in_dir, '*.ann'))[0]
-        desc = read_annotation(ann_fp)
-        nrows = desc['grd_pwr.set_rows']['value']
-        ncols = desc['grd_pwr.set_cols']['value']
-        fps = glob(join(in_dir, '*.grd'))
-        # Read GRD files
-        for f in fps:
-            name = basename(f).split('_')[-3][4:]
-            # Complex variables
-            if name == 'HVVV' or name == 'HHHV' or name == 'HHVV':
-                arr = np.fromfile(f, dtype = np.complex64).reshape(nrows, ncols)
-            # Real variables
-            else:
-                arr = np.fromfile(f, dtype = np.float32).reshape(nrows, ncols)
-            
-            arr[arr == 0] = np.nan
-            if bounds:
-                xmin, xmax, ymin, ymax = bounds
-                arr = arr[xmin:xmax,ymin:ymax]
-            pol[name] = arr
+    fps, desc, kind, shape = find_polsar_files(in_dir)
+    if bounds:
+        xmin, xmax, ymin, ymax = bounds
+        stack = read_polsar_rows(fps, kind, shape, xmin, xmax, cols = slice(ymin, ymax))
     else:
-        
-        desc = pd.read_csv(glob(join(in_dir, '*.csv'))[0], index_col = [0]).to_dict()
-        for f in fps:
-            with rio.open(f) as src:
-                arr = src.read(1)
-            name = basename(f).split('_')[5][4:]
-            # Complex variables
-            pol[name] = arr
-
-    missing_pols = req_pols - req_pols.intersection(pol.keys())
-    assert len(missing_pols) == 0, f'Missing required polarizations : {missing_pols}'
-    stack = np.dstack([pol['HHHH'], pol['HHHV'], pol['HVHV'], pol['HVVV'], pol['HHVV'], pol['VVVV']])
+        stack = read_polsar_rows(fps, kind, shape, 0, shape[0])
         
     return stack, desc
 
@@ -140,6 +206,99 @@ def get_polsar_stack_carsar(in_dir, image_width):
     
     return stack
 
+def _looks(looks):
+    """
+    Number of looks along rows and columns from an int or a (rows, cols) pair.
+    """
+    ny, nx = (looks, looks) if np.isscalar(looks) else looks
+    if ny < 1 or nx < 1:
+        raise ValueError('Number of looks must be at least 1.')
+    return int(ny), int(nx)
+
+def _window_bounds(n, looks, mode = 'decimate'):
+    """
+    Start and (exclusive) stop indexes along an axis of the window averaged into each
+    output pixel. Decimated windows do not overlap and the last one may be partial.
+    Sliding windows are centered on each pixel and clipped at the edges.
+    """
+    if mode == 'decimate':
+        starts = np.arange(0, n, looks)
+        return starts, np.minimum(starts + looks, n)
+    elif mode == 'sliding':
+        starts = np.arange(n) - looks // 2
+        return np.clip(starts, 0, n), np.clip(starts + looks, 0, n)
+    raise ValueError(f'Multilook mode must be one of {MULTILOOK_MODES}.')
+
+def _box_mean(stack, row_bounds, col_bounds):
+    """
+    Averages the crossproducts of a [rows x cols x 6] stack over windows with a
+    summed-area table so the cost does not depend on the window size. Pixels with
+    a NaN crossproduct are left out of the averages and windows without any
+    valid pixel are NaN.
+    """
+    valid = ~np.any(np.isnan(stack), axis = -1)
+    sat = np.zeros((stack.shape[0] + 1, stack.shape[1] + 1, 7), dtype = np.complex128)
+    sat[1:, 1:, :6] = np.where(valid[..., None], stack, 0)
+    sat[1:, 1:, 6] = valid
+    np.cumsum(sat, axis = 0, out = sat)
+    np.cumsum(sat, axis = 1, out = sat)
+
+    r0, r1 = row_bounds[0][:, None], row_bounds[1][:, None]
+    c0, c1 = col_bounds[0][None, :], col_bounds[1][None, :]
+    sums = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean = sums[..., :6] / sums[..., 6:].real
+    return mean.astype(np.result_type(stack.dtype, np.complex64))
+
+def multilook(stack, looks, mode = 'decimate', channel_axis = -1, block_rows = None, max_memory = 2**28):
+    """
+    Multilooks (boxcar averages) the six crossproducts of a polsar stack before
+    the decomposition. Window sums come from summed-area tables so the cost is
+    independent of the window size, and the stack is processed in strips of
+    rows to bound the size of the tables.
+
+    Arguments
+    ---------
+    stack : np.array
+        Crossproduct stack from get_polsar_stack ([rows x cols x 6]) or
+        get_polsar_stack_carsar ([6 x rows x cols], use channel_axis = 0).
+    looks : int or tuple
+        Window size as looks along rows and columns, e.g. (4, 2). An int uses
+        the same number of looks along both.
+    mode : str (Default: 'decimate')
+        'decimate' averages non-overlapping windows so the output is smaller
+        by the number of looks (partial windows at the end of each axis are
+        kept). 'sliding' averages a window centered on every pixel and keeps
+        the shape of the stack.
+    channel_axis : int (Default: -1)
+        Axis of the stack holding the six crossproducts.
+    block_rows : int (Optional)
+        Number of input rows per strip. Overrides max_memory if provided.
+    max_memory : int (Default: 256 MiB)
+        Approximate peak memory in bytes used to size the strips.
+
+    Returns
+    -------
+    stack : np.array
+        Multilooked stack with the crossproducts along channel_axis. Pixels with
+        a NaN crossproduct are left out of the averages.
+    """
+    ny, nx = _looks(looks)
+    stack = np.moveaxis(np.asarray(stack), channel_axis, -1)
+    assert stack.shape[-1] == 6, 'Channel axis of stack must hold the 6 crossproducts.'
+    rows, cols = stack.shape[:2]
+    row_bounds, col_bounds = _window_bounds(rows, ny, mode), _window_bounds(cols, nx, mode)
+    if not block_rows:
+        block_rows = max(1, int(max_memory // (cols * MULTILOOK_BYTES_PER_PIXEL)))
+    out_block = max(1, block_rows // ny) if mode == 'decimate' else block_rows
+
+    out = np.empty((len(row_bounds[0]), len(col_bounds[0]), 6), dtype = np.result_type(stack.dtype, np.complex64))
+    for start in range(0, out.shape[0], out_block):
+        r0, r1 = row_bounds[0][start:start + out_block], row_bounds[1][start:start + out_block]
+        strip = stack[r0[0]:r1[-1]]
+        out[start:start + out_block] = _box_mean(strip, (r0 - r0[0], r1 - r0[0]), col_bounds)
+
+    return np.moveaxis(out, -1, channel_axis)
 
 def calc_C3(HHHH, HHHV, HVHV, HVVV, HHVV, VVVV):
     """
@@ -209,6 +368,43 @@ def C3_to_T3(C3):
     return T3
 
 
+def vectorized_calc_T3(stack):
+    """
+    Calculates the coherency matrix T3 for every pixel of a stack at once.
+    Combines calc_C3 and C3_to_T3 into a single array operation so no per-pixel
+    C3 matrix is ever built.
+
+    Arguments
+    ---------
+    stack : np.array
+        Array of size [... x 6] containing UAVSAR data in the order HHHH, HHHV,
+        HVHV, HVVV, HHVV, VVVV. Can use the output of the get_polsar_stack
+        function.
+
+    Returns
+    -------
+    T3 : np.array [... x 3 x 3]
+        T3 matrices with complex dtype (at least complex64).
+    """
+    stack = np.asarray(stack)
+    dtype = np.result_type(stack.dtype, np.complex64)
+    HHHH, HHHV, HVHV, HVVV, HHVV, VVVV = [stack[..., i] for i in range(6)]
+    T3 = np.empty(stack.shape[:-1] + (3, 3), dtype = dtype)
+    # Lower triangular components (C3_to_T3 expanded in terms of the stack)
+    T3[..., 0, 0] = 0.5*(HHHH + 2*HHVV.real + VVVV)
+    T3[..., 1, 0] = 0.5*(HHHH - VVVV) - 1j*HHVV.imag
+    T3[..., 2, 0] = HHHV + np.conjugate(HVVV)
+    T3[..., 1, 1] = 0.5*(HHHH - 2*HHVV.real + VVVV)
+    T3[..., 2, 1] = HHHV - np.conjugate(HVVV)
+    T3[..., 2, 2] = 2*HVHV
+    # Upper components are conjugates of lower components
+    T3[..., 0, 1] = np.conjugate(T3[..., 1, 0])
+    T3[..., 0, 2] = np.conjugate(T3[..., 2, 0])
+    T3[..., 1, 2] = np.conjugate(T3[..., 2, 1])
+
+    return T3
+
+
 def T3_to_alpha1(T3):
     """
     Calculates alpha1 decomposition product from the coherency matrix T3. Uses
@@ -388,7 +584,7 @@ def vectorized_T3_to_H(T3):
     values = np.linalg.eigvalsh(T3)  # Shape: [rows, cols, 3]
 
     # Normalize to get probabilities
-    values_sum = np.sum(eigvals, axis=-1, keepdims=True)
+    values_sum = np.sum(values, axis=-1, keepdims=True)
     weighted = values / values_sum
 
     # Mask to avoid log(0)
@@ -484,21 +680,68 @@ def decomp_components(stack, mean_alpha=True):
     else:
         return H, A, alpha1
 
+
+def vectorized_T3_eigenvalues(T3):
+    """
+    Closed form eigenvalues of a stack of Hermitian T3 matrices and of their
+    first minors (T3 with the first row/col deleted). Uses the trigonometric
+    solution of the characteristic cubic so no iterative eigensolver is needed.
+    Calculations are carried out in float64.
+
+    Arguments
+    ---------
+    T3 : np.array [... x 3 x 3]
+        T3 matrices (use output from vectorized_calc_T3 function)
+
+    Returns
+    -------
+    values : np.array [... x 3]
+        Eigenvalues of T3 in ascending order (t3, t2, t1).
+    minor_values : np.array [... x 2]
+        Eigenvalues of the first minor M1 in ascending order (m2, m1).
+    """
+    t11, t22, t33 = [T3[..., i, i].real.astype(np.float64) for i in range(3)]
+    t12 = T3[..., 0, 1].astype(np.complex128)
+    t13 = T3[..., 0, 2].astype(np.complex128)
+    t23 = T3[..., 1, 2].astype(np.complex128)
+    a12, a13, a23 = np.abs(t12)**2, np.abs(t13)**2, np.abs(t23)**2
+
+    # Eigenvalues of T3 from the shifted and scaled matrix B = (T3 - qI)/p
+    q = (t11 + t22 + t33) / 3
+    p = np.sqrt(((t11 - q)**2 + (t22 - q)**2 + (t33 - q)**2 + 2*(a12 + a13 + a23)) / 6)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        b11, b22, b33 = (t11 - q) / p, (t22 - q) / p, (t33 - q) / p
+        det_b = (b11*b22*b33 + 2*np.real(t12*t23*np.conjugate(t13)) / p**3
+                 - (b11*a23 + b22*a13 + b33*a12) / p**2)
+    phi = np.arccos(np.clip(np.nan_to_num(det_b / 2), -1, 1)) / 3
+    t1 = q + 2*p*np.cos(phi)
+    t3 = q + 2*p*np.cos(phi + 2*np.pi/3)
+    t2 = 3*q - t1 - t3
+    values = np.stack([t3, t2, t1], axis = -1)
+
+    # Eigenvalues of the 2x2 minor
+    mid = (t22 + t33) / 2
+    rad = np.sqrt(((t22 - t33) / 2)**2 + a23)
+    minor_values = np.stack([mid - rad, mid + rad], axis = -1)
+
+    return values, minor_values
+
 def vectorized_decomp_components(stack, mean_alpha=True):
     """
-    Function to calculate H-A-alpha (entropy-anisotropy-alpha) decomposition 
-    from a stack of UAVSAR data. This function operates over the depth axis of 
-    the stack and can be applied to an entire scene/array using 
-    np.apply_along_axis. Can also calculate mean alpha using boolean keyword.
+    Array version of decomp_components. Calculates H-A-alpha (entropy-
+    anisotropy-alpha) decomposition for every pixel of a stack at once. T3 is
+    built for the whole stack, its eigenvalues are solved in closed form and 
+    the alpha angles come from the eigenvector-eigenvalue identity described
+    by Nielsen 2022 [DOI: 10.1109/LGRS.2022.3169994]. Can also calculate mean 
+    alpha using boolean keyword.
 
-    Note if any cell location in the stack has one or more NaN elements it will
-    that cell location will be skipped entirely. This enables functionality
-    over entire UAVSAR scenes without having to mask NaN or clip rasters. 
+    Note any pixel with one or more NaN elements in the stack is masked to NaN
+    in all outputs, matching decomp_components.
 
     Arguments
     ---------
     stack : np.array
-        Array of size [rows x cols x 6] containing UAVSAR data. Can use the output of 
+        Array of size [... x 6] containing UAVSAR data. Can use the output of 
         the get_polsar_stack function. 
     mean_alpha : bool (Default: True)
         If True, calculates and returns mean alpha product in addition to H, A, 
@@ -506,42 +749,79 @@ def vectorized_decomp_components(stack, mean_alpha=True):
 
     Returns
     -------
-    H, A, alpha1 (opt. meanalpha) : float
-        Decomposition products calculated at a given pixel location.
-    """
-    if np.any(np.isnan(stack)) or len(stack) != 6:
+    H, A, alpha1 (opt. meanalpha) : np.array
+        Decomposition products with the real dtype matching the stack precision.
+        Shape matches the stack without its last axis.
+    """
+    stack = np.asarray(stack)
+    assert stack.shape[-1] == 6, 'Last axis of stack must hold the 6 crossproducts.'
+    out_dtype = np.finfo(np.result_type(stack.dtype, np.complex64)).dtype
+    invalid = np.any(np.isnan(stack), axis = -1)
+    values, minor_values = vectorized_T3_eigenvalues(vectorized_calc_T3(stack))
+    t3, t2, t1 = values[..., 0], values[..., 1], values[..., 2]
+    m2, m1 = minor_values[..., 0], minor_values[..., 1]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        # Entropy is only defined when all weighted eigenvalues are positive
+        weighted = values / np.sum(values, axis = -1, keepdims = True)
+        H = -np.sum(weighted * np.log(weighted), axis = -1) / np.log(3)
+        H[~np.all(weighted > 0, axis = -1)] = np.nan
+        A = (t2 - t3) / (t2 + t3)
+        # Anisotropy is undefined (0/0 in decomp_components) when the two minor
+        # eigenvalues vanish, which the closed form only resolves to round-off
+        A[~(t2 + t3 > np.finfo(values.dtype).eps * np.abs(t1))] = np.nan
+        # Eigenvector components from Nielsen 2022
+        e11 = np.sqrt(np.clip(((t1 - m1)*(t1 - m2))/((t1 - t2)*(t1 - t3)), 0, 1))
+        alpha_1 = np.arccos(e11)
+        res = [H, A, np.rad2deg(alpha_1)]
         if mean_alpha:
-            return np.repeat(np.nan, 4)
-        else:
-            return np.repeat(np.nan, 3)
-    # Matrices
-    C3 = calc_C3(*stack)
-    T3 = C3_to_T3(C3)
-    # Decomposition products
-    H = vectorized_T3_to_H(T3)
-    A = vectorized_T3_to_A(T3)
-    alpha1 = vectorized_T3_to_alpha1(T3)
-    
-    if mean_alpha:
-        meanalpha = vectorized_T3_to_mean_alpha(T3)
-        return H, A, alpha1, meanalpha
-    else:
-        return H, A, alpha1
-    
+            e21 = np.sqrt(np.clip(((t2 - m1)*(t2 - m2))/((t2 - t1)*(t2 - t3)), 0, 1))
+            e31 = np.sqrt(np.clip(((t3 - m1)*(t3 - m2))/((t3 - t1)*(t3 - t2)), 0, 1))
+            mean = weighted[..., 2]*alpha_1 + weighted[..., 1]*np.arccos(e21) + weighted[..., 0]*np.arccos(e31)
+            res.append(np.rad2deg(mean))
 
-def uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True):
+    res = [arr.astype(out_dtype) for arr in res]
+    for arr in res:
+        arr[invalid] = np.nan
+
+    return tuple(res)
+
+def _decomp_block(block, mean_alpha = True):
+    """
+    Runs vectorized_decomp_components on a block and stacks the products along
+    a new last axis.
+    """
+    return np.stack(vectorized_decomp_components(block, mean_alpha = mean_alpha), axis = -1)
+
+def _dask_decomp(stack, mean_alpha = True, block_rows = 128):
+    """
+    Decomposes a stack with dask, one task per strip of block_rows rows.
     """
-    Apply-along-axis version of decomp_products function. This function can be 
-    used to perform H-A-alpha decomposition on a full UAVSAR scene. 
+    import dask.array as da
+    n_products = 4 if mean_alpha else 3
+    dtype = np.finfo(np.result_type(stack.dtype, np.complex64)).dtype
+    darr = da.from_array(stack, chunks = (block_rows, -1, -1))
+    return da.map_blocks(_decomp_block, darr, mean_alpha = mean_alpha, dtype = dtype,
+                         chunks = darr.chunks[:2] + ((n_products,),)).compute()
+
+def vectorized_uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True, block_rows = 128):
+    """
+    Performs H-A-alpha decomposition on a full UAVSAR scene with the vectorized
+    decomposition engine. The scene is processed in strips of block_rows rows 
+    to bound the size of the intermediate T3 and eigenvector arrays.
 
     Arguments
     ---------
     stack : np.array
         Array of size [rows x columns x 6] containing UAVSAR data. Can use the output of 
         the get_polsar_stack function. 
+    parralel : bool (Default: False)
+        If True, strips are computed in parallel with dask.
     mean_alpha : bool (Default: True)
         If True, calculates and returns mean alpha product in addition to H, A, 
         and alpha.
+    block_rows : int (Default: 128)
+        Number of rows decomposed at once.
 
     Returns
     -------
@@ -549,31 +829,25 @@ def uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True):
         Decomposition products calculated for the input scene. Size of all
         output arrays will match rows/cols of the input stack.
     """
+    n_products = 4 if mean_alpha else 3
     if parralel:
-        import dask.array as da
         from dask.diagnostics import ProgressBar
-        ProgressBar().register()
-        res = da.apply_along_axis(decomp_components, axis = 2, arr = stack, mean_alpha=mean_alpha, dtype = stack.dtype).compute()
+        with ProgressBar():
+            res = _dask_decomp(stack, mean_alpha, block_rows)
     else:
-        res_shape = list(stack.shape[:2])
-        res_shape.append(4)
-        res = np.empty(res_shape)
-        iters = stack.shape[0]*stack.shape[1]
-        for i, j in tqdm(np.ndindex(stack.shape[:2]), total = iters):
-            res[i,j,:] = decomp_components(stack[i,j])
-    H = res[:,:,0]
-    A = res[:,:,1]
-    alpha1 = res[:,:,2]
-    if mean_alpha:
-        mean_alpha = res[:,:,3]
-        return H, A, alpha1, mean_alpha
-    else:
-        return H, A, alpha1
+        dtype = np.finfo(np.result_type(stack.dtype, np.complex64)).dtype
+        res = np.empty(stack.shape[:2] + (n_products,), dtype = dtype)
+        for start in tqdm(range(0, stack.shape[0], block_rows), unit = 'block'):
+            stop = start + block_rows
+            res[start:stop] = _decomp_block(stack[start:stop], mean_alpha = mean_alpha)
 
-def vectorized_uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True):
+    return tuple(res[:, :, i] for i in range(n_products))
+
+def uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True):
     """
-    Apply-along-axis version of decomp_products function. This function can be 
-    used to perform H-A-alpha decomposition on a full UAVSAR scene. 
+    Performs H-A-alpha decomposition on a full UAVSAR scene. Uses the vectorized
+    decomposition engine (see vectorized_uavsar_H_A_alpha); decomp_components 
+    remains available for single pixels.
 
     Arguments
     ---------
@@ -590,66 +864,85 @@ def vectorized_uavsar_H_A_alpha(stack, parralel = False, mean_alpha=True):
         Decomposition products calculated for the input scene. Size of all
         output arrays will match rows/cols of the input stack.
     """
-    if parralel:
-        import dask.array as da
-        from dask.diagnostics import ProgressBar
-        ProgressBar().register()
-        res = da.apply_along_axis(vectorize_decomp_components, axis = 2, arr = stack, mean_alpha=mean_alpha, 
-        dtype = stack.dtype).compute()
-    else:
-        res_shape = list(stack.shape[:2])
-        res_shape.append(4)
-        res = np.empty(res_shape)
-        iters = stack.shape[0]*stack.shape[1]
-        for i, j in tqdm(np.ndindex(stack.shape[:2]), total = iters):
-            res[i,j,:] = vectorized_decomp_components(stack[i,j])
-    H = res[:,:,0]
-    A = res[:,:,1]
-    alpha1 = res[:,:,2]
-    if mean_alpha:
-        mean_alpha = res[:,:,3]
-        return H, A, alpha1, mean_alpha
-    else:
-        return H, A, alpha1
+    return vectorized_uavsar_H_A_alpha(stack, parralel = parralel, mean_alpha = mean_alpha)
 
-def H_A_alpha_decomp(in_dir, out_dir, parralel = False):
-    """
-    in_dir must have all polarizations of []
-    out_dir - must exist
-    only works for UAVSAR
-    """
-    log.info('Collecting polsar stack')
-    stack, desc = get_polsar_stack(in_dir)
-    desc = read_annotation(glob(join(in_dir, '*.ann'))[0])
-    log.info(f'Starting H, A, Alpha Calculations. Parralelized = {parralel}')
-    H, A, alpha1, mean_alpha = uavsar_H_A_alpha(stack, parralel = parralel)
-    d = {}
-    d['entropy'] = H
-    d['anisotropy'] = A
-    d['alpha1'] = alpha1
-    d['mean_alpha'] = mean_alpha
-    os.makedirs(out_dir, exist_ok = True)
-    for name, arr in d.items():
-        out_fp = join(out_dir, name)
-        array_to_tiff(arr, out_fp, desc = desc, type = 'grd_pwr')
-
-def vectorized_H_A_alpha_decomp(in_dir, out_dir, parralel = False):
-    """
-    in_dir must have all polarizations of []
-    out_dir - must exist
-    only works for UAVSAR
-    """
-    log.info('Collecting polsar stack')
-    stack, desc = get_polsar_stack(in_dir)
-    # desc = read_annotation(glob(join(in_dir, '*.ann'))[0])
-    log.info(f'Starting H, A, Alpha Calculations. Parralelized = {parralel}')
-    H, A, alpha1, mean_alpha = vectorized_uavsar_H_A_alpha(stack, parralel = parralel)
-    d = {}
-    d['entropy'] = H
-    d['anisotropy'] = A
-    d['alpha1'] = alpha1
-    d['mean_alpha'] = mean_alpha
+def H_A_alpha_decomp(in_dir, out_dir, parralel = False, block_rows = None, max_memory = 2**30, tiff_profile = None,
+                     looks = None, multilook_mode = 'decimate'):
+    """
+    Calculates the H-A-alpha decomposition of a UAVSAR polsar scene and saves 
+    entropy, anisotropy, alpha1 and mean_alpha geotiffs in out_dir. The scene 
+    is streamed in strips of rows that are read from the .grd binaries (or 
+    tiffs), decomposed and written straight into the output geotiffs so peak 
+    memory is set by the strip size instead of the scene size.
+
+    Arguments
+    ---------
+    in_dir : str
+        Input directory with all six crossproducts and the associated .ann 
+        file (see get_polsar_stack). Only works for UAVSAR.
+    out_dir : str
+        Directory to save the decomposition products in. Created if missing.
+    parralel : bool (Default: False)
+        If True, each strip is decomposed in parallel with dask.
+    block_rows : int (Optional)
+        Number of rows per strip. Overrides max_memory if provided.
+    max_memory : int (Default: 1 GiB)
+        Approximate peak memory in bytes used to size the strips.
+    tiff_profile : str or dict (Optional)
+        Layout and compression of the output geotiffs, e.g. 'tiled' or 'cog'
+        (see convert.tiff_profile.resolve_profile).
+    looks : int or tuple (Optional)
+        Looks along rows and columns to average the crossproducts over before
+        the decomposition (see multilook). Defaults to no multilooking.
+    multilook_mode : str (Default: 'decimate')
+        'decimate' writes outputs smaller by the number of looks with the pixel
+        size scaled to match, 'sliding' keeps the size of the scene.
+    """
+    fps, desc, kind, (nrows, ncols) = find_polsar_files(in_dir)
+    if not block_rows:
+        bytes_per_pixel = DECOMP_BYTES_PER_PIXEL + (MULTILOOK_BYTES_PER_PIXEL if looks else 0)
+        block_rows = max(1, int(max_memory // (ncols * bytes_per_pixel)))
+    log.info(f'Starting H, A, Alpha Calculations. Parralelized = {parralel}, strip rows = {block_rows}')
+
+    t, crs = grd_geotransform(desc, 'grd_pwr')
+    out_rows, out_cols, out_block = nrows, ncols, block_rows
+    if looks:
+        ny, nx = _looks(looks)
+        row_bounds, col_bounds = _window_bounds(nrows, ny, multilook_mode), _window_bounds(ncols, nx, multilook_mode)
+        out_rows, out_cols = len(row_bounds[0]), len(col_bounds[0])
+        if multilook_mode == 'decimate':
+            t = t * Affine.scale(nx, ny)
+            out_block = max(1, block_rows // ny)
+    names = ['entropy', 'anisotropy', 'alpha1', 'mean_alpha']
     os.makedirs(out_dir, exist_ok = True)
-    for name, arr in d.items():
-        out_fp = join(out_dir, name)
-        array_to_tiff(arr, out_fp, desc = desc, type = 'grd_pwr')
+    profile = dict(driver = 'GTiff', height = out_rows, width = out_cols, count = 1, dtype = 'float32', crs = crs, transform = t)
+    dsts = []
+    try:
+        for name in names:
+            dsts.append(TiffWriter(join(out_dir, name), profile, tiff_profile))
+        for start in tqdm(range(0, out_rows, out_block), unit = 'strip', desc = 'Decomposing'):
+            if looks:
+                # Read the input rows under this strip of windows and average them
+                r0, r1 = row_bounds[0][start:start + out_block], row_bounds[1][start:start + out_block]
+                strip = read_polsar_rows(fps, kind, (nrows, ncols), r0[0], r1[-1])
+                strip = _box_mean(strip, (r0 - r0[0], r1 - r0[0]), col_bounds)
+            else:
+                strip = read_polsar_rows(fps, kind, (nrows, ncols), start, start + block_rows)
+            if parralel:
+                res = _dask_decomp(strip, block_rows = max(1, strip.shape[0] // (os.cpu_count() or 1)))
+            else:
+                res = _decomp_block(strip)
+            window = Window(0, start, out_cols, strip.shape[0])
+            for i, dst in enumerate(dsts):
+                dst.write(res[..., i].astype(np.float32), window = window)
+    finally:
+        for dst in dsts:
+            dst.close()
+
+def vectorized_H_A_alpha_decomp(in_dir, out_dir, parralel = False, block_rows = None, max_memory = 2**30, tiff_profile = None,
+                                looks = None, multilook_mode = 'decimate'):
+    """
+    Alias of H_A_alpha_decomp, which now uses the vectorized engine.
+    """
+    H_A_alpha_decomp(in_dir, out_dir, parralel = parralel, block_rows = block_rows, max_memory = max_memory,
+                     tiff_profile = tiff_profile, looks = looks, multilook_mode = multilook_mode)
@@ -1,8 +1,192 @@
+import os
+from os.path import join, basename
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import rasterio as rio
+from uavsar_pytools.convert.tiff_profile import TiffWriter
+from uavsar_pytools.incidence_angle import _tile_windows
+
+# Density of water [kg m-3] used to convert depth and density to SWE
+WATER_DENSITY = 1000
+
+# Number of pixels processed at a time by the fused kernels. Small enough that the
+# scratch buffers stay in cache, large enough to amortize the per ufunc overhead.
+_BLOCK = 2**16
+
+def permittivity_from_density(density, method = 'guneriussen2001'):
+    """
+    Calculates snow permittivity from snow density.
+
+    Parameters
+    ----------
+    density : NumPy array or float
+        Snow density [kg m-3].
+    method : 'guneriussen2001' or 'webb2021'
+        See references Guneriussen et al. 2001 [DOI: 10.1109/36.957273] and
+        Webb et al. 2021 [10.3390/rs13224617]
+
+    Returns
+    -------
+    perm : NumPy array or float, snow permittivity
+    """
+    if method == 'guneriussen2001':
+        # Need to convert to [g cm-3] as in original paper
+        return 1 + 1.6 * (density/1000) + 1.8 * (density/1000)**3
+    elif method == 'webb2021':
+        # Good to use [kg m-3]
+        return 1 + 0.0014 * density + 2e-7 * density**2
+    raise ValueError("Please choose a density calulation method from 'guneriussen2001' or 'webb2021'.")
+
+def _row_blocks(shape):
+    """
+    Slices of about _BLOCK pixels along the first axis of an array.
+    """
+    step = max(1, _BLOCK // int(np.prod(shape[1:], dtype = np.int64) or 1))
+    for start in range(0, shape[0], step):
+        yield slice(start, start + step)
+
+def _nanmean(x):
+    """
+    np.nanmean without a full size copy of the array.
+    """
+    x = np.asarray(x)
+    if x.ndim == 0:
+        return float(x)
+    total, count = 0.0, 0
+    for rows in _row_blocks(x.shape):
+        block = x[rows]
+        total += np.nansum(block, dtype = np.float64)
+        count += block.size - np.count_nonzero(np.isnan(block))
+    return total / count if count else np.nan
+
+def _check_inputs(data, inc_angle, permittivity, density):
+    """
+    Validates the inputs of depth_from_phase and phase_from_depth.
+    """
+    # Check for either permittivity or density
+    if permittivity is None and density is None:
+        raise ValueError('Please provide either permittivity or density data.')
+    # Check to make sure all rasters are the same size
+    for i in [inc_angle, permittivity, density]:
+        if type(i) == np.ndarray:
+            if i.shape != data.shape:
+                raise ValueError('All raster datasets must be the same shape.')
+    # Check to make sure permittivity has no values of 1 or 1.0
+    # This is not likely for real data but messes with the calculation
+    if type(permittivity) == np.ndarray:
+        if any((permittivity[rows] == 1).any() for rows in _row_blocks(permittivity.shape)):
+            raise ValueError('Permittivity array cannot contain values equal to 1.')
+    elif permittivity is not None and permittivity == 1:
+        raise ValueError('Permittivity cannot equal 1.')
+    # Check to make sure angles are in radians and densities are reasonable
+    if _nanmean(inc_angle) > 2*np.pi:
+        raise ValueError('Incidence angle must be in radians.')
+    if density is not None:
+        if _nanmean(density) < 1:
+            raise ValueError('Densities must be in kg/m3.')
+
+def _prepare_inputs(data, inc_angle, permittivity, density, method, validate):
+    if validate:
+        _check_inputs(data, inc_angle, permittivity, density)
+    elif permittivity is None and density is None:
+        raise ValueError('Please provide either permittivity or density data.')
+    if permittivity is None:
+        print(f'No permittivity data provided -- calculating permittivity from snow density using method {method}.')
+
+def _rows(x, shape, rows):
+    """
+    Rows of an input broadcast to the output shape. Scalars are returned as is.
+    """
+    if np.ndim(x) == 0:
+        return x
+    return np.broadcast_to(x, shape)[rows]
+
+def _geometry_block(inc, perm, out, tmp):
+    """
+    Writes cos(inc) - sqrt(perm - sin(inc)^2) to out using tmp as the only scratch buffer.
+    """
+    np.sin(inc, out = tmp)
+    np.square(tmp, out = tmp)
+    np.subtract(perm, tmp, out = tmp)
+    np.sqrt(tmp, out = tmp)
+    np.cos(inc, out = out)
+    np.subtract(out, tmp, out = out)
+
+def _fused(data, scale, divide, inc_angle = None, permittivity = None, density = None,
+           method = 'guneriussen2001', geometry = None, out = None):
+    """
+    Computes data * scale / geometry (or data * scale * geometry) as float32 in blocks of
+    rows so the only full size array allocated is the output. The geometry term is
+    computed block by block unless it is given precomputed.
+    """
+    data = np.asarray(data)
+    inputs = [data] + ([geometry] if geometry is not None else [inc_angle, permittivity, density])
+    if out is not None:
+        inputs.append(out)
+    shape = np.broadcast_shapes(*[np.shape(x) for x in inputs])
+    scalar = shape == ()
+    if scalar:
+        shape = (1,)
+        out = out.reshape(shape) if out is not None else None
+    if out is None:
+        out = np.empty(shape, dtype = np.float32)
+    elif out.shape != shape:
+        raise ValueError(f'Output array must have shape {shape}.')
+    if geometry is None and permittivity is None and np.ndim(density) == 0:
+        # Constant density only needs one permittivity
+        permittivity = permittivity_from_density(density, method)
+
+    blocks = list(_row_blocks(shape))
+    tmp = np.empty_like(out[blocks[0]]) if blocks else None
+    for rows in blocks:
+        o = out[rows]
+        if geometry is None:
+            g = tmp[:len(o)]
+            perm = _rows(permittivity, shape, rows) if permittivity is not None \
+                else permittivity_from_density(_rows(density, shape, rows), method)
+            # Output block doubles as the second scratch buffer
+            _geometry_block(_rows(inc_angle, shape, rows), perm, g, o)
+        else:
+            g = _rows(geometry, shape, rows)
+        if divide:
+            np.divide(_rows(data, shape, rows), g, out = o)
+        else:
+            np.multiply(_rows(data, shape, rows), g, out = o)
+        np.multiply(o, np.float32(scale), out = o)
+    return out[0] if scalar else out
+
+def geometry_term(inc_angle, permittivity = None, density = None,
+                  method = 'guneriussen2001', out = None):
+    """
+    Calculates the geometric term cos(inc) - sqrt(perm - sin(inc)^2) shared by
+    depth_from_phase and phase_from_depth. It depends only on incidence angle and
+    permittivity, so it can be computed once for a stack and passed to every date
+    with the geometry argument.
+
+    Parameters
+    ----------
+    inc_angle : NumPy array or float
+        Incidence angle [radians].
+    permittivity : NumPy array or float
+        Permittivity data. If a value is provided here, density is ignored.
+    density : NumPy array or float
+        Snow density [kg m-3], used if permittivity is not provided.
+    method : 'guneriussen2001' or 'webb2021'
+        Method to calculate permittivity from density (see permittivity_from_density).
+    out : NumPy array
+        Optional float32 array to write the result to.
+
+    Returns
+    -------
+    geometry : NumPy array, float32 geometric term
+    """
+    if permittivity is None and density is None:
+        raise ValueError('Please provide either permittivity or density data.')
+    return _fused(1, 1, False, inc_angle, permittivity, density, method, out = out)
 
 def depth_from_phase(delta_phase, inc_angle, permittivity = None,
                      density = None, method = 'guneriussen2001', 
-                     wavelength = 0.238403545):
+                     wavelength = 0.238403545, geometry = None, validate = True, out = None):
     """
     Calculates change in snow depth from SAR phase change. Requires either 
     permittivity data or density data and selection of the method to estimate 
@@ -31,57 +215,28 @@ def depth_from_phase(delta_phase, inc_angle, permittivity = None,
         2001 [DOI: 10.1109/36.957273] and Webb et al. 2021 [10.3390/rs13224617]
     wavelength : float
         Radar wavelength [m]. Default value of 0.238403545 m is for UAVSAR L-band.
+    geometry : NumPy array
+        Precomputed result of geometry_term. If given, incidence angle, permittivity
+        and density are ignored.
+    validate : bool
+        Check the inputs before the calculation. The checks scan every array, so
+        disable them for inputs that are already known to be valid. Default is True.
+    out : NumPy array
+        Optional float32 array to write the result to.
 
     Returns
     -------
-    delta_z : NumPy array, change in snow depth [m]
+    delta_z : NumPy array, float32 change in snow depth [m]
     """
-    # Check for either permittivity or density
-    if permittivity == None and density == None:
-        raise ValueError('Please provide either permittivity or density data.')
-    # Check to make sure all rasters are the same size
-    for i in [inc_angle, permittivity, density]:
-        if type(i) == np.ndarray:
-            if i.shape != delta_phase.shape:
-                raise ValueError('All raster datasets must be the same shape.')
-    # Check to make sure permittivity has no values of 1 or 1.0
-    # This is not likely for real data but messes with the calculation
-    if type(permittivity) == np.ndarray:
-        if 1 in permittivity or 1.0 in permittivity:
-            raise ValueError('Permittivity array cannot contain values equal to 1.')
-    elif permittivity == 1:
-        raise ValueError('Permittivity cannot equal 1.')
-    # Check to make sure angles are in radians and densities are reasonable
-    if np.nanmean(inc_angle) > 2*np.pi:
-        raise ValueError('Incidence angle must be in radians.')
-
-    if density:
-        if np.nanmean(density) < 1:
-            raise ValueError('Densities must be in kg/m3.')
-    # Calculate permittivity with density if perm. is not directly provided
-    if not permittivity:
-        print(f'No permittivity data provided -- calculating permittivity from snow density using method {method}.')
-
-        if method == 'guneriussen2001':
-            # Need to convert to [g cm-3] as in original paper
-            perm = 1 + 1.6 * (density/1000) + 1.8 * (density/1000)**3
-        elif method == 'webb2021':
-            # Good to use [kg m-3]
-            perm = 1 + 0.0014 * density + 2e-7 * density**2
-        else:
-            raise ValueError("Please choose a density calulation method from 'guneriussen2001' or 'webb2021'.")
-
-    else:
-        perm = permittivity
+    if geometry is None:
+        _prepare_inputs(delta_phase, inc_angle, permittivity, density, method, validate)
 
     # Calculate snow depth change
-    delta_z = (-delta_phase * wavelength) / (4 * np.pi * (np.cos(inc_angle) - np.sqrt(perm - np.sin(inc_angle)**2)))
-
-    return delta_z
+    return _fused(delta_phase, -wavelength / (4 * np.pi), True, inc_angle, permittivity, density, method, geometry, out)
   
 def phase_from_depth(delta_sd, inc_angle, permittivity = None,
                      density = None, method = 'guneriussen2001', 
-                     wavelength = 0.238403545):
+                     wavelength = 0.238403545, geometry = None, validate = True, out = None):
     """
     Calculates SAR phase change from a snow depth change. Requires either 
     permittivity data or density data and selection of the method to estimate 
@@ -110,53 +265,24 @@ def phase_from_depth(delta_sd, inc_angle, permittivity = None,
         2001 [DOI: 10.1109/36.957273] and Webb et al. 2021 [10.3390/rs13224617]
     wavelength : float
         Radar wavelength [m]. Default value of 0.238403545 m is for UAVSAR L-band.
+    geometry : NumPy array
+        Precomputed result of geometry_term. If given, incidence angle, permittivity
+        and density are ignored.
+    validate : bool
+        Check the inputs before the calculation. The checks scan every array, so
+        disable them for inputs that are already known to be valid. Default is True.
+    out : NumPy array
+        Optional float32 array to write the result to.
 
     Returns
     -------
-    delta_z : NumPy array, change in snow depth [m]
+    delta_phase : NumPy array, float32 phase change [radians]
     """
-    # Check for either permittivity or density
-    if permittivity == None and density == None:
-        raise ValueError('Please provide either permittivity or density data.')
-    # Check to make sure all rasters are the same size
-    for i in [inc_angle, permittivity, density]:
-        if type(i) == np.ndarray:
-            if i.shape != delta_sd.shape:
-                raise ValueError('All raster datasets must be the same shape.')
-    # Check to make sure permittivity has no values of 1 or 1.0
-    # This is not likely for real data but messes with the calculation
-    if type(permittivity) == np.ndarray:
-        if 1 in permittivity or 1.0 in permittivity:
-            raise ValueError('Permittivity array cannot contain values equal to 1.')
-    elif permittivity == 1:
-        raise ValueError('Permittivity cannot equal 1.')
-    # Check to make sure angles are in radians and densities are reasonable
-    if np.nanmean(inc_angle) > 2*np.pi:
-        raise ValueError('Incidence angle must be in radians.')
-    if density:
-        if np.nanmean(density) < 1:
-            raise ValueError('Densities must be in kg/m3.')
-
-    # Calculate permittivity with density if perm. is not directly provided
-    if not permittivity:
-        print(f'No permittivity data provided -- calculating permittivity from snow density using method {method}.')
+    if geometry is None:
+        _prepare_inputs(delta_sd, inc_angle, permittivity, density, method, validate)
 
-        if method == 'guneriussen2001':
-            # Need to convert to [g cm-3] as in original paper
-            perm = 1 + 1.6 * (density/1000) + 1.8 * (density/1000)**3
-        elif method == 'webb2021':
-            # Good to use [kg m-3]
-            perm = 1 + 0.0014 * density + 2e-7 * density**2
-        else:
-            raise ValueError("Please choose a density calulation method from 'guneriussen2001' or 'webb2021'.")
-
-    else:
-        perm = permittivity
-
-    # Calculate snow depth change
-    delta_phase = - delta_sd * (4 * np.pi * (np.cos(inc_angle) - np.sqrt(perm - np.sin(inc_angle)**2))) / wavelength
-
-    return delta_phase
+    # Calculate phase change
+    return _fused(delta_sd, -4 * np.pi / wavelength, False, inc_angle, permittivity, density, method, geometry, out)
 
 def swe_from_phase_oveisgharan(phase, incidence_angle, wavelength = 0.0555):
   """
@@ -218,3 +344,165 @@ def swe_from_phase_leinss(phase, incidence_angle, alpha = 1, wavelength = 0.2384
     k = 2 * np.pi / wavelength
     inc_term = 1.59 + incidence_angle**(5/2)
     return phase / (k * alpha * inc_term)
+
+def _read_tile(value, window, i = None):
+    """
+    Reads a window of a raster input. Lists hold one input per date, strings are raster
+    paths and anything else (e.g. a float) is returned as is.
+    """
+    if isinstance(value, (list, tuple)):
+        value = value[i]
+    if isinstance(value, str):
+        with rio.open(value) as src:
+            return src.read(1, window = window, masked = True).astype(np.float32).filled(np.nan)
+    return value
+
+def _invert_window(window, phase_fps, inc_angle, density, permittivity, method, wavelength, inc_degrees, offsets):
+    """
+    Inverts every date of a stack over a window. Permittivity and incidence angle are
+    only read and computed once unless they are given per date.
+
+    Returns
+    -------
+    results : list of (delta_z, cumulative_z, swe) arrays for each date (swe is None without density)
+    """
+    per_date = lambda v: isinstance(v, (list, tuple))
+    inc = perm = rho = geometry = None
+    results = []
+    cum_z = cum_swe = 0
+    for i, fp in enumerate(phase_fps):
+        if inc is None or per_date(inc_angle):
+            inc = _read_tile(inc_angle, window, i)
+            if inc_degrees:
+                inc = np.deg2rad(inc)
+            geometry = None
+        if rho is None or per_date(density):
+            rho = _read_tile(density, window, i) if density is not None else None
+        if perm is None or per_date(permittivity) or (permittivity is None and per_date(density)):
+            if permittivity is not None:
+                perm = _read_tile(permittivity, window, i)
+            else:
+                perm = permittivity_from_density(rho, method)
+            geometry = None
+        phase = _read_tile(fp, window)
+        if offsets is not None:
+            phase += np.float32(offsets[i])
+        if geometry is None:
+            # Reused for every date until the incidence angle or permittivity changes
+            geometry = geometry_term(inc, perm, out = np.empty(phase.shape, dtype = np.float32))
+        delta_z = depth_from_phase(phase, None, wavelength = wavelength, geometry = geometry, validate = False)
+        # No data on any date carries through the cumulative sums
+        cum_z = cum_z + delta_z
+        swe = None
+        if rho is not None:
+            cum_swe = cum_swe + delta_z * rho / WATER_DENSITY
+            swe = np.broadcast_to(cum_swe, phase.shape).astype(np.float32)
+        results.append((delta_z, cum_z, swe))
+    return results
+
+def invert_stack(phase_fps, inc_angle, out_dir, density = None, permittivity = None,
+                 method = 'guneriussen2001', wavelength = 0.238403545, inc_degrees = False,
+                 tile_size = 512, workers = 1, tiff_profile = None, offsets = None):
+    """
+    Inverts a time ordered stack of unwrapped phase rasters to snow depth change,
+    cumulative snow depth change and cumulative SWE. The stack is processed tile by
+    tile so rasters larger than memory can be inverted, and permittivity and the
+    geometry term are computed once per tile and reused across dates.
+
+    Parameters
+    ----------
+    phase_fps : list of str
+        Filepaths of the unwrapped phase rasters [radians] in time order. All rasters
+        must share the grid of the first one.
+    inc_angle : str, float or list
+        Incidence angle raster filepath, constant incidence angle or a list with one
+        of either per date.
+    out_dir : str
+        Directory to save the results in. Created if missing.
+    density : str, float or list
+        Snow density [kg m-3] as a raster filepath, a constant or a list with one of
+        either per date. Required for SWE and for permittivity if it is not given.
+    permittivity : str, float or list
+        Snow permittivity in the same forms. Overrides the permittivity from density.
+    method : 'guneriussen2001' or 'webb2021'
+        Method to calculate permittivity from density (see permittivity_from_density).
+    wavelength : float
+        Radar wavelength [m]. Default value of 0.238403545 m is for UAVSAR L-band.
+    inc_degrees : bool
+        True if incidence angles are in degrees (e.g. from calc_inc_angle_tiff).
+        Default is radians.
+    tile_size : int
+        Size in pixels of the square tiles processed at a time. Default is 512.
+    workers : int
+        Number of processes inverting tiles in parallel. Default is 1.
+    tiff_profile : str or dict
+        Layout and compression of the outputs (see convert.tiff_profile).
+    offsets : list of float
+        Phase offsets [radians] added to each phase raster before the inversion, e.g.
+        the offset column of phase_calibration.calibrate_pairs.
+
+    Returns
+    -------
+    out_fps : dict
+        Lists of output filepaths for each date under 'delta_z', 'cumulative_z' and
+        'swe' (empty without density). NaN on any date carries through the cumulative
+        results of later dates.
+    """
+    if permittivity is None and density is None:
+        raise ValueError('Please provide either permittivity or density data.')
+    if not phase_fps:
+        raise ValueError('Please provide at least one phase raster.')
+    if offsets is not None:
+        offsets = [float(offset) for offset in offsets]
+    for value in [inc_angle, density, permittivity, offsets]:
+        if isinstance(value, (list, tuple)) and len(value) != len(phase_fps):
+            raise ValueError('Inputs given per date must have one value for each phase raster.')
+
+    with rio.open(phase_fps[0]) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+    rasters = [fp for value in [phase_fps, inc_angle, density, permittivity]
+               for fp in (value if isinstance(value, (list, tuple)) else [value]) if isinstance(fp, str)]
+    for fp in rasters:
+        with rio.open(fp) as src:
+            if (src.height, src.width) != (height, width):
+                raise ValueError('All raster datasets must be the same shape.')
+    profile.update(driver = 'GTiff', dtype = 'float32', count = 1, nodata = np.nan)
+
+    os.makedirs(out_dir, exist_ok = True)
+    names = ['delta_z', 'cumulative_z'] + (['swe'] if density is not None else [])
+    out_fps = {name: [join(out_dir, f'{basename(fp).rsplit(".", 1)[0]}.{name}.tif') for fp in phase_fps]
+               for name in names}
+    if density is None:
+        out_fps['swe'] = []
+
+    args = (phase_fps, inc_angle, density, permittivity, method, wavelength, inc_degrees, offsets)
+    windows = list(_tile_windows(height, width, tile_size))
+    writers = []
+    try:
+        for name in names:
+            writers.append([TiffWriter(fp, profile, tiff_profile) for fp in out_fps[name]])
+
+        def write(window, results):
+            for i, result in enumerate(results):
+                for j, writer in enumerate(writers):
+                    writer[i].write(result[j], window = window)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                # Keep a bounded number of tiles in flight so memory use stays flat
+                pending = {}
+                for i, window in enumerate(windows):
+                    pending[i] = executor.submit(_invert_window, window, *args)
+                    if len(pending) >= 2 * workers:
+                        j = min(pending)
+                        write(windows[j], pending.pop(j).result())
+                for j in sorted(pending):
+                    write(windows[j], pending[j].result())
+        else:
+            for window in windows:
+                write(window, _invert_window(window, *args))
+    finally:
+        for writer in [w for ws in writers for w in ws]:
+            writer.close()
+    return out_fps
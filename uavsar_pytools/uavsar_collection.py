@@ -3,12 +3,16 @@ from os.path import basename, join, expanduser
 from glob import glob
 import shutil
 import logging
-import asf_search as asf
 import pandas as pd
 from random import choice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from uavsar_pytools.uavsar_scene import UavsarScene
 from uavsar_pytools.uavsar_image import UavsarImage
+from uavsar_pytools.catalog import UavsarCatalog
+from uavsar_pytools.zarr_store import UavsarZarr
+from uavsar_pytools.download.search import cached_search, match_results, DEFAULT_TTL
+from uavsar_pytools.convert.file_control import read_manifest, append_manifest
 
 log = logging.getLogger(__name__)
 logging.basicConfig()
@@ -26,9 +30,29 @@ class UavsarCollection():
         clean (bool): Do you want to erase binary files after completion [Default = False]
         debug (str): level of logging (not yet implemented)
         pols (list): Do you want only certain polarizations? [Default = all available]
+        products (list): Do you want only certain products (e.g. ['unw', 'cor'])? Only those files are
+            fetched from each remote zip. [Default = all available]
+        stream (bool): convert images straight from each zip without extracting the binaries [Default = False]
         dates (list): List of 1: start date and 2: end date to constrain collection results.
         low_ram (bool): decimates by a factor of 100 the arrays to conserve memory. [Default = True]
         inc (bool): download incidence angle as well? [Default = False]
+        download_workers (int): number of zip files to download concurrently [Default = 1]
+        convert_workers (int): number of downloaded scenes to unzip and convert concurrently [Default = 1]
+        workers (int): number of processes each scene uses to convert its binary images [Default = 1]
+        manifest (bool or str): record completed pair names so interrupted runs resume where they
+            stopped. True uses <work_dir>/uavsar_manifest.txt, a string is used as the manifest path
+            and False disables it. [Default = True]
+        catalog (bool or str): index converted scenes in a SQLite catalog (see UavsarCatalog). True uses
+            <work_dir>/uavsar_catalog.db and a string is used as the catalog path. [Default = None]
+        search_cache (bool or str): cache ASF search results on disk. True uses <work_dir>/asf_cache,
+            a string is used as the cache directory and False disables it. [Default = True]
+        cache_ttl (float): seconds before cached searches are repeated. None never expires. [Default = 1 day]
+        offline (bool): only use cached searches and never contact ASF [Default = False]
+        tiff_profile (str or dict): layout and compression of the geotiffs, e.g. 'tiled' or 'cog'
+            (see convert.tiff_profile.resolve_profile) [Default = untiled and uncompressed]
+        zarr_store (bool, str or UavsarZarr): append every converted scene to a zarr time series store
+            (see UavsarZarr). True uses <work_dir>/uavsar.zarr and a string is used as the store path.
+            [Default = None]
 
     Methods:
         collection_to_tiffs(): Main method. Finds all Uavsar Images in the collection and downloads, converts them to GeoTiffs.
@@ -42,7 +66,9 @@ class UavsarCollection():
     """
 
     def __init__(self, collection ,work_dir = '~', overwrite = False, clean = True, \
-    debug = False, pols = None, dates = None, low_ram = True, inc = False, img_type = 'INTERFEROMETRY_GRD'):
+    debug = False, pols = None, dates = None, low_ram = True, inc = False, img_type = 'INTERFEROMETRY_GRD', \
+    download_workers = 1, convert_workers = 1, workers = 1, manifest = True, products = None, stream = False, catalog = None, \
+    search_cache = True, cache_ttl = DEFAULT_TTL, offline = False, tiff_profile = None, zarr_store = None):
         self.collection = collection
         self.work_dir = expanduser(work_dir)
         self.overwrite = overwrite
@@ -52,6 +78,39 @@ class UavsarCollection():
         self.low_ram = low_ram
         self.inc = inc
         self.img_type = img_type
+        self.download_workers = download_workers
+        self.convert_workers = convert_workers
+        self.workers = workers
+        self.products = products
+        self.stream = stream
+        self.tiff_profile = tiff_profile
+        if zarr_store is True:
+            self.zarr_store = UavsarZarr(join(self.work_dir, 'uavsar.zarr'))
+        elif isinstance(zarr_store, str):
+            self.zarr_store = UavsarZarr(expanduser(zarr_store))
+        else:
+            self.zarr_store = zarr_store or None
+        if manifest is True:
+            self.manifest_fp = join(self.work_dir, 'uavsar_manifest.txt')
+        elif manifest:
+            self.manifest_fp = expanduser(manifest)
+        else:
+            self.manifest_fp = None
+        if catalog is True:
+            self.catalog = UavsarCatalog(join(self.work_dir, 'uavsar_catalog.db'))
+        elif catalog:
+            self.catalog = UavsarCatalog(expanduser(catalog))
+        else:
+            self.catalog = None
+        if search_cache is True:
+            self.cache_dir = join(self.work_dir, 'asf_cache')
+        elif search_cache:
+            self.cache_dir = expanduser(search_cache)
+        else:
+            self.cache_dir = None
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.inc_results = {}
         if pols:
             pols = [pol.upper() for pol in pols]
             if set(pols).issubset(['VV','VH','HV','HH']):
@@ -64,45 +123,113 @@ class UavsarCollection():
             self.start_date = pd.to_datetime(dates[0])
             self.end_date = pd.to_datetime(dates[1])
 
+    def _search(self, processing_level):
+        params = dict(platform = 'UAVSAR', processingLevel = [processing_level], campaign = self.collection)
+        if self.dates:
+            params.update(start = self.start_date, end = self.end_date)
+        return cached_search(cache_dir = self.cache_dir, ttl = self.cache_ttl, offline = self.offline, **params)
+
     def find_urls(self):
         # search for data
-        if self.dates:
-            self.results = asf.search(platform = 'UAVSAR',
-                        processingLevel = ([self.img_type]),
-                        campaign = self.collection,
-                        start = self.start_date,
-                        end = self.end_date)
-        else:
-            self.results = asf.search(platform = 'UAVSAR',
-                        processingLevel = ([self.img_type]),
-                        campaign = self.collection)
+        self.results = self._search(self.img_type)
         log.info(f'Found {len(self.results)} image pairs')
 
+    def find_inc_urls(self, results = None):
+        """
+        Finds the incidence angle image of each result with a single search of the collection.
+        Matches are stored in .inc_results keyed by the url of each result.
+        """
+        if results is None:
+            results = self.results
+        matches = match_results(results, self._search('INC'))
+        self.inc_results.update({r.properties['url']: m for r, m in zip(results, matches)})
+
+    def _download_scene(self, result):
+        """
+        Download stage of the pipeline. Returns the scene with its zip downloaded.
+        """
+        url = result.properties['url']
+        log.info(f'Starting on: {url}')
+        scene = UavsarScene(url = url, work_dir= self.work_dir, pols = self.pols, clean = self.clean, \
+            low_ram=self.low_ram, workers = self.workers, md5 = result.properties.get('md5sum'), \
+            products = self.products, stream = self.stream, catalog = self.catalog, \
+            tiff_profile = self.tiff_profile, zarr_store = self.zarr_store)
+        scene.download()
+        return scene
+
+    def _convert_scene(self, scene, result):
+        """
+        Conversion stage of the pipeline. Unzips and converts a downloaded scene,
+        fetches the incidence angle if requested and records the scene as completed.
+        """
+        prop = result.properties
+        scene.zip_to_tiffs()
+        if 'INTERFEROMETRY' in self.img_type:
+            d1 = choice(list(scene.images.values()))['description']['start time of acquisition for pass 1']['value']
+            d2 = choice(list(scene.images.values()))['description']['start time of acquisition for pass 2']['value']
+            log.info(f'Completed {d1} to {d2}')
+        elif self.img_type == 'PROJECTED':
+            d = choice(list(scene.images.values()))['description']['date of acquisition']['value']
+            log.info(f'Completed {d}')
+        if self.inc:
+            inc_res = self.inc_results.get(prop['url'])
+            if inc_res is None:
+                raise ValueError(f'No incidence angle image found for {prop["url"]}')
+            url_dir = join(self.work_dir, scene.pair_name)
+            inc_img = UavsarImage(inc_res.properties['url'], join(self.work_dir, url_dir), clean = True)
+            inc_img.url_to_tiff()
+        if self.manifest_fp:
+            append_manifest(self.manifest_fp, scene.pair_name)
+
     def results_to_tiffs(self):
-        for result in self.results:
-            prop = result.properties
-            url = prop['url']
-            log.info(f'Starting on: {url}')
-            scene = UavsarScene(url = url, work_dir= self.work_dir, pols = self.pols, clean = self.clean, low_ram=self.low_ram)
-            scene.url_to_tiffs()
-            if 'INTERFEROMETRY' in self.img_type:
-                d1 = choice(list(scene.images.values()))['description']['start time of acquisition for pass 1']['value']
-                d2 = choice(list(scene.images.values()))['description']['start time of acquisition for pass 2']['value']
-                log.info(f'Completed {d1} to {d2}')
-            elif self.img_type == 'PROJECTED':
-                d = choice(list(scene.images.values()))['description']['date of acquisition']['value']
-                log.info(f'Completed {d}')
-            if self.inc:
-                inc_res = asf.search(platform = 'UAVSAR',
-                        processingLevel = (['INC']),
-                        campaign = self.collection,
-                        # frame= int(prop['frameNumber']),
-                        relativeOrbit= int(prop['pathNumber']),
-                        start= prop['startTime'],
-                        end = prop['stopTime'])[0]
-                url_dir = join(self.work_dir, basename(url).split('.')[0])
-                inc_img = UavsarImage(inc_res.properties['url'], join(self.work_dir, url_dir), clean = True)
-                inc_img.url_to_tiff()                
+        """
+        Downloads and converts all search results. Downloads run concurrently on
+        download_workers threads and each finished download is handed to a separate
+        pool of convert_workers threads for unzipping and conversion, so downloads
+        and conversions overlap. New downloads only start as scenes finish converting,
+        bounding the zips held on disk. Pair names of completed scenes are appended to the
+        manifest and skipped on the next run.
+        """
+        done = read_manifest(self.manifest_fp) if self.manifest_fp else set()
+        results = [r for r in self.results if basename(r.properties['url']).split('.')[0] not in done]
+        if len(results) < len(self.results):
+            log.info(f'Skipping {len(self.results) - len(results)} image pairs already in {self.manifest_fp}')
+
+        if self.inc and results:
+            self.find_inc_urls(results)
+
+        failed = []
+        # Scenes are downloaded only as conversion slots free up, so at most
+        # download_workers + convert_workers zips are downloading or waiting to be
+        # converted at a time instead of the whole collection piling up on disk.
+        queued = iter(results)
+        running = {}
+        with ThreadPoolExecutor(max_workers = self.download_workers) as download_pool, \
+            ThreadPoolExecutor(max_workers = self.convert_workers) as convert_pool:
+            def download_next():
+                result = next(queued, None)
+                if result is not None:
+                    running[download_pool.submit(self._download_scene, result)] = ('Download', result)
+            for _ in range(self.download_workers + self.convert_workers):
+                download_next()
+            while running:
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    stage, result = running.pop(future)
+                    try:
+                        scene = future.result()
+                    except Exception:
+                        log.exception(f'{stage} failed for {result.properties["url"]}')
+                        failed.append(result.properties['url'])
+                        download_next()
+                        continue
+                    if stage == 'Download':
+                        running[convert_pool.submit(self._convert_scene, scene, result)] = ('Conversion', result)
+                    else:
+                        download_next()
+
+        if failed:
+            log.warning(f'{len(failed)} image pairs failed and will be retried on the next run: {failed}')
 
     def collection_to_tiffs(self):
         self.find_urls()
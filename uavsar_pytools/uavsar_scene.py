@@ -6,11 +6,15 @@ import pandas as pd
 import logging
 import shutil
 from random import choice
+from concurrent.futures import ProcessPoolExecutor
 
 from uavsar_pytools.download.download import download_zip
+from uavsar_pytools.download.remote_zip import download_zip_members
 from uavsar_pytools.convert.file_control import unzip
-from uavsar_pytools.convert.tiff_conversion import grd_tiff_convert
+from uavsar_pytools.convert.tiff_conversion import grd_tiff_convert, zip_tiff_convert, pair_annotations
 from uavsar_pytools.uavsar_image import UavsarImage
+from uavsar_pytools.catalog import UavsarCatalog
+from uavsar_pytools.zarr_store import UavsarZarr
 
 log = logging.getLogger(__name__)
 logging.basicConfig()
@@ -26,7 +30,19 @@ class UavsarScene():
         overwrite (bool): Do you want to overwrite pre-existing files [Default = False]
         clean (bool): Do you want to erase binary files after completion [Default = False]
         pols (list): Do you want only certain polarizations? [Default = all available]
+        products (list): Do you want only certain products (e.g. ['unw', 'cor'])? If provided only the
+            matching files are fetched from the remote zip with range requests. [Default = all available]
         debug (str): level of logging (not yet implemented)
+        workers (int): number of processes used to convert binary images in parallel [Default = 1]
+        md5 (str): expected md5 checksum of the zip file, e.g. from an ASF search result [Default = None]
+        stream (bool): convert images straight from the zip file without extracting the binaries
+            to disk [Default = False]
+        catalog (str or UavsarCatalog): catalog to index the scene in after conversion. A string is
+            used as the path to the catalog database. [Default = None]
+        tiff_profile (str or dict): layout and compression of the geotiffs, e.g. 'tiled' or 'cog'
+            (see convert.tiff_profile.resolve_profile) [Default = untiled and uncompressed]
+        zarr_store (str or UavsarZarr): zarr store to append the converted images to. A string is
+            used as the path to the store. [Default = None]
 
     Attributes:
         zipped_fp (str): filepath to downloaded zip directory. Created automatically after downloading.
@@ -36,13 +52,24 @@ class UavsarScene():
         desc (dict): description of image from annotation file.
     """
 
-    def __init__(self, url, work_dir, clean = True, debug = False, pols = None, low_ram = False):
+    def __init__(self, url, work_dir, clean = True, debug = False, pols = None, low_ram = False, workers = 1, md5 = None, products = None, stream = False, catalog = None, tiff_profile = None, zarr_store = None):
         self.url = url
         self.pair_name = basename(url).split('.')[0]
         self.work_dir = os.path.expanduser(work_dir)
         self.clean = clean
         self.debug = debug
         self.low_ram = low_ram
+        self.workers = workers
+        self.md5 = md5
+        self.products = products
+        self.stream = stream
+        if isinstance(catalog, str):
+            catalog = UavsarCatalog(catalog)
+        self.catalog = catalog
+        self.tiff_profile = tiff_profile
+        if isinstance(zarr_store, str):
+            zarr_store = UavsarZarr(zarr_store)
+        self.zarr_store = zarr_store
         self.zipped_fp = None
         self.ann_fp = None
         self.binary_fps = []
@@ -71,7 +98,14 @@ class UavsarScene():
             os.makedirs(out_dir)
 
         if self.url.split('.')[-1] == 'zip':
-            self.zipped_fp = download_zip(self.url, out_dir)
+            if self.products:
+                try:
+                    self.binary_fps = download_zip_members(self.url, os.path.join(out_dir, 'bin_imgs/'), \
+                        pols = self.pols, products = self.products)
+                    return
+                except ValueError as e:
+                    log.warning(f'{e}. Downloading full zip instead.')
+            self.zipped_fp = download_zip(self.url, out_dir, md5 = self.md5)
         else:
             log.warning('UavsarScene for zip files. Using UavsarImage for single images.')
 
@@ -93,64 +127,110 @@ class UavsarScene():
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        self.binary_fps = unzip(in_dir, out_dir, pols = self.pols)
+        self.binary_fps = unzip(in_dir, out_dir, pols = self.pols, products = self.products)
 
-    def binary_to_tiffs(self, binary_dir = None, ann_fp = None):
+    def binary_to_tiffs(self, binary_dir = None, ann_fp = None, workers = None):
         """
         Convert a set of binary images to WGS84 geotiffs.
         Args:
             sub_dir (str): sub-directory in working directory to put tiffs
             binary_dir (str): directory containing binary files. Autogenerated from unzipping.
+            workers (int): number of processes to convert images in parallel [Default = self.workers].
+                Arrays are sent back from the workers unless low_ram is set.
         """
-        pols = ['VV','VH','HV','HH']
         if not binary_dir:
             if self.binary_fps:
                 binary_dir = dirname(self.binary_fps[0])
             if not self.binary_fps:
-                Exception('No binary files or directory known')
+                raise Exception('No binary files or directory known')
         else:
-            self.binary_fps = os.listdir(binary_dir)
+            self.binary_fps = [join(binary_dir, f) for f in os.listdir(binary_dir)]
+
+        if not workers:
+            workers = self.workers
 
         out_dir = os.path.join(self.work_dir, self.pair_name)
 
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        if not ann_fp:
-            ann_fps = [a for a in self.binary_fps if '.ann' in a]
-            ann_dic = {}
-            for pol in pols:
-                ann_pol = [fp for fp in ann_fps if pol in fp]
-                if ann_pol:
-                    ann_dic[pol] = ann_pol[0]
+        ann_fps = [a for a in self.binary_fps if '.ann' in a]
+        binary_img_fps = [f for f in self.binary_fps if '.ann' not in f]
+        # Pair each binary with its annotation file
+        jobs = pair_annotations(binary_img_fps, ann_fps, ann_fp = ann_fp)
 
-            if not ann_fps:
-                log.warning('No annotation file found for binary files.')
+        kwargs = dict(overwrite = True, debug = self.debug, return_array = not self.low_ram, tiff_profile = self.tiff_profile)
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers = min(workers, len(jobs))) as executor:
+                futures = [executor.submit(grd_tiff_convert, f, out_dir, ann_fp = f_ann, **kwargs) for f, f_ann in jobs]
+                results = [future.result() for future in futures]
+        else:
+            results = [grd_tiff_convert(f, out_dir, ann_fp = f_ann, **kwargs) for f, f_ann in jobs]
 
-        binary_img_fps = [f for f in self.binary_fps if '.ann' not in f]
+        self._store_results(results, out_dir)
+        self._clean()
+
+    def stream_to_tiffs(self, zip_fp = None):
+        """
+        Convert the binary images of the downloaded zip file to WGS84 geotiffs without
+        unzipping them. Each image is decompressed and written in blocks of rows so only
+        the zip and the geotiffs need disk space.
+        Args:
+            zip_fp (str): path to the zip file. Autogenerated from downloading.
+        """
+        if not zip_fp:
+            zip_fp = self.zipped_fp
+        if not zip_fp:
+            raise Exception('No known zip file for this scene. Please provide.')
 
-        for f in binary_img_fps:
-            if len(ann_dic) > 0:
-                f_pol = [pol for pol in pols if pol in basename(f)][0]
-                ann_fp = ann_dic[f_pol]
-            if not ann_fp:
-                ann_fp = ann_fps[0]
-            desc, array, type, out_fp = grd_tiff_convert(f, out_dir, ann_fp = ann_fp, overwrite = True, debug=self.debug)
-            if self.low_ram:
+        out_dir = os.path.join(self.work_dir, self.pair_name)
+        ann_dir = os.path.join(self.tmp_dir, 'bin_imgs/') if self.tmp_dir else out_dir
+        results = zip_tiff_convert(zip_fp, out_dir, ann_dir = ann_dir, pols = self.pols, \
+            products = self.products, debug = self.debug, tiff_profile = self.tiff_profile)
+        self._store_results(results, out_dir)
+        self._clean()
+
+    def _store_results(self, results, out_dir):
+        # Results are collected in input order so the images dict is deterministic
+        for desc, array, type, out_fp in results:
+            if self.low_ram or array is None:
                 self.images[type] = {'description': desc, 'out_fp':out_fp, 'type':type}
             else:
                 self.images[type] = {'description': desc, 'array':  array, 'out_fp':out_fp, 'type':type}
         self.out_dir = out_dir
 
-        if self.clean:
-            shutil.rmtree(dirname(self.tmp_dir))
+    def _clean(self):
+        if self.clean and self.tmp_dir:
+            # Only remove this scene's files so concurrent scenes sharing tmp/ are untouched
+            shutil.rmtree(self.tmp_dir, ignore_errors = True)
+            try:
+                os.rmdir(dirname(self.tmp_dir))
+            except OSError:
+                pass
+
+    def zip_to_tiffs(self):
+        """
+        Unzip the downloaded zip file (if needed), convert its binary images to WGS84 geotiffs
+        and save the scene description as <pair_name>.csv. The scene is indexed in the catalog and
+        appended to the zarr store if they are set.
+        """
+        # Remote member downloads are already extracted
+        if self.stream and self.zipped_fp:
+            self.stream_to_tiffs()
+        else:
+            if self.zipped_fp or not self.binary_fps:
+                self.unzip()
+            self.binary_to_tiffs()
+        df = pd.DataFrame(choice(list(self.images.values()))['description'].to_dict())
+        df.to_csv(join(self.out_dir, self.pair_name + '.csv'))
+        if self.catalog:
+            self.catalog.add_scene(self)
+        if self.zarr_store:
+            self.zarr_store.append_scene(self)
 
     def url_to_tiffs(self):
         self.download()
-        self.unzip()
-        self.binary_to_tiffs()
-        df = pd.DataFrame(choice(list(self.images.values()))['description'])
-        df.to_csv(join(self.out_dir, self.pair_name + '.csv'))
+        self.zip_to_tiffs()
 
 
     def show(self, i):
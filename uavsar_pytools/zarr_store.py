@@ -0,0 +1,309 @@
+"""
+Zarr output for time series of UAVSAR scenes. Converted scenes are appended to a single
+chunked, compressed store laid out as data(time, band, y, x) on a common grid so a
+season of images opens as one xarray Dataset.
+"""
+
+import os
+import json
+import math
+import time
+from contextlib import contextmanager
+from os.path import exists, expanduser
+import numpy as np
+import pandas as pd
+import dask.array as da
+import xarray as xr
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+import logging
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from uavsar_pytools.catalog import scene_times
+
+log = logging.getLogger(__name__)
+logging.basicConfig()
+
+# Time encoding of the store so new time steps can be written without xarray
+TIME_UNITS = 'seconds since 1970-01-01'
+# Default number of time steps per chunk so a pixel's time series of a season is one read
+TIME_CHUNKS = 16
+
+@contextmanager
+def _store_lock(lock_fp, timeout = 600, poll = 0.1):
+    """
+    Exclusive lock shared by threads and processes appending to the same store. The lock
+    file is created atomically and a lock older than timeout seconds is treated as stale.
+    """
+    while True:
+        try:
+            fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_fp).st_mtime > timeout:
+                    log.warning(f'Removing stale lock {lock_fp}')
+                    os.remove(lock_fp)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_fp)
+
+def _json_safe(desc):
+    """
+    Annotation description as JSON serializable attributes (times become strings).
+    """
+    if desc is None:
+        return {}
+    if hasattr(desc, 'to_dict'):
+        desc = desc.to_dict()
+    return json.loads(json.dumps(dict(desc), default = str))
+
+def scene_bands(images):
+    """
+    Band names and geotiff paths of the real valued images of a converted scene.
+
+    Args:
+        images (dict): UavsarScene.images
+    Returns:
+        bands (dict): band name (e.g. 'cor', 'HHHH' or 'slope_east') -> geotiff path
+    """
+    bands = {}
+    for type, image in images.items():
+        fps = image['out_fp']
+        if isinstance(fps, list):
+            for fp, direction in zip(fps, ['east', 'north']):
+                bands[f'{type}_{direction}'] = fp
+        elif fps:
+            bands[type] = fps
+    return bands
+
+class UavsarZarr():
+    """
+    Zarr store of UAVSAR scenes on a common WGS84 grid with dimensions (time, band, y, x).
+    Scenes are appended incrementally and appends from several threads or processes are
+    safe: a lock file guards growing the time axis and the attributes, and writers sharing
+    a time chunk take turns through a lock file of that chunk. Time steps are stored in
+    the order they are appended and open() sorts them by time. Complex images (e.g.
+    interferograms) are skipped.
+
+    Args:
+        store_fp (str): path of the zarr store. Created by the first append.
+        bounds (tuple): (west, south, east, north) of the grid. [Default = grid of the first scene]
+        res (float): pixel spacing of the grid in degrees when bounds are given [Default = None]
+        chunks (int): y and x chunk size [Default = 512]
+        time_chunks (int): time steps per chunk. A pixel's time series is read in one chunk
+            per time_chunks scenes. Appends to the same time chunk write one at a time.
+            [Default = 16]
+        resampling (Resampling): resampling of scenes that are not on the grid [Default = nearest]
+        lock_timeout (float): seconds before a lock is considered stale [Default = 600]
+
+    Methods:
+        append_scene(scene): append a converted UavsarScene
+        append(...): append a scene from its geotiffs
+        open(): open the store as a lazy xarray Dataset
+    """
+
+    def __init__(self, store_fp, bounds = None, res = None, chunks = 512, time_chunks = TIME_CHUNKS,
+                 resampling = Resampling.nearest, lock_timeout = 600):
+        if zarr is None:
+            raise ImportError('UavsarZarr requires zarr. Install it with `pip install uavsar_pytools[zarr]`.')
+        if bounds is not None and not res:
+            raise ValueError('Provide the grid resolution with its bounds.')
+        self.store_fp = expanduser(store_fp)
+        self.lock_fp = self.store_fp.rstrip('/') + '.lock'
+        self.bounds = bounds
+        self.res = res
+        self.chunks = chunks
+        self.time_chunks = time_chunks
+        self.resampling = resampling
+        self.lock_timeout = lock_timeout
+
+    def _lock(self, index = None):
+        """
+        Lock of the store, or of the time chunk holding index if given.
+        """
+        lock_fp = self.lock_fp if index is None else f'{self.lock_fp}.{index // self.time_chunks}'
+        return _store_lock(lock_fp, timeout = self.lock_timeout)
+
+    def _grid(self, fp):
+        """
+        Grid of the store from its bounds or the first image as (crs, transform, height, width).
+        """
+        if self.bounds is not None:
+            west, south, east, north = self.bounds
+            transform = from_origin(west, north, self.res, self.res)
+            return CRS.from_epsg(4326), transform, math.ceil((north - south) / self.res), math.ceil((east - west) / self.res)
+        with rasterio.open(fp) as src:
+            return src.crs or CRS.from_epsg(4326), src.transform, src.height, src.width
+
+    def _create(self, grid, bands, t):
+        """
+        Writes the metadata and coordinates of a new store with one time step.
+        """
+        crs, transform, height, width = grid
+        ys = transform.f + transform.e * (np.arange(height) + 0.5)
+        xs = transform.c + transform.a * (np.arange(width) + 0.5)
+        data = da.full((1, len(bands), height, width), np.nan, dtype = np.float32,
+                       chunks = (1, 1, self.chunks, self.chunks))
+        ds = xr.Dataset({'data': (('time', 'band', 'y', 'x'), data)},
+                        coords = {'time': [t], 'band': np.array(list(bands), dtype = object), 'y': ys, 'x': xs})
+        ds.attrs.update(crs = crs.to_wkt(), transform = list(transform)[:6], scenes = {})
+        encoding = {'data': {'chunks': (self.time_chunks, 1, self.chunks, self.chunks)},
+                    'time': {'units': TIME_UNITS, 'calendar': 'proleptic_gregorian', 'dtype': 'int64'}}
+        # Only metadata and coordinates are written. Data chunks are filled per scene. Metadata
+        # is not consolidated since appends resize the arrays.
+        ds.to_zarr(self.store_fp, mode = 'w-', encoding = encoding, compute = False, consolidated = False)
+
+    def _reserve(self, pair_name, bands, t, desc):
+        """
+        Finds or adds the time step of a scene. Must be called with the lock held.
+
+        Returns:
+            index (int): time index of the scene (None if it is already complete)
+        """
+        if not exists(self.store_fp):
+            self._create(self._grid(next(iter(bands.values()))), bands, t)
+        group = zarr.open_group(self.store_fp, mode = 'r+')
+        store_bands = list(group['band'][:])
+        new_bands = [name for name in bands if name not in store_bands]
+        if new_bands:
+            # Grow the band axis. Earlier time steps read NaN (the fill value) for new bands.
+            size = len(store_bands) + len(new_bands)
+            group['data'].resize(group['data'].shape[:1] + (size,) + group['data'].shape[2:])
+            group['band'].resize((size,))
+            group['band'][len(store_bands):] = np.array(new_bands, dtype = group['band'].dtype)
+            log.info(f'Added bands {new_bands} to {self.store_fp}.')
+        scenes = dict(group.attrs.get('scenes', {}))
+        if pair_name in scenes:
+            if scenes[pair_name]['complete']:
+                log.info(f'{pair_name} is already in {self.store_fp}. Skipping.')
+                return None
+            # Resume an append that was interrupted
+            return scenes[pair_name]['index']
+        if scenes:
+            index = group['data'].shape[0]
+            group['data'].resize((index + 1,) + group['data'].shape[1:])
+            group['time'].resize((index + 1,))
+            group['time'][index] = int(pd.Timestamp(t).value // 10**9)
+        else:
+            index = 0
+        scenes[pair_name] = {'index': index, 'time': str(t), 'complete': False,
+                             'bands': list(bands), 'annotation': _json_safe(desc)}
+        group.attrs['scenes'] = scenes
+        return index
+
+    def _write(self, index, bands):
+        """
+        Warps each band onto the grid and writes it to its time step in strips of chunk rows.
+        """
+        group = zarr.open_group(self.store_fp, mode = 'r+')
+        array = group['data']
+        store_bands = list(group['band'][:])
+        crs, transform = CRS.from_wkt(group.attrs['crs']), Affine(*group.attrs['transform'])
+        height, width = array.shape[2:]
+        for name, fp in bands.items():
+            b = store_bands.index(name)
+            with rasterio.open(fp) as src:
+                scale, offset = src.scales[0], src.offsets[0]
+                nodata = src.nodata if src.nodata is not None else np.nan
+                with WarpedVRT(src, crs = crs, transform = transform, width = width, height = height,
+                               resampling = self.resampling, src_nodata = nodata, nodata = nodata) as vrt:
+                    for row in range(0, height, self.chunks):
+                        window = Window(0, row, width, min(self.chunks, height - row))
+                        block = vrt.read(1, window = window, masked = True).astype(np.float32)
+                        block = block * scale + offset
+                        array[index, b, row:row + window.height, :] = block.filled(np.nan)
+
+    def append(self, pair_name, bands, desc = None, t = None):
+        """
+        Appends a scene from its geotiffs. Scenes already in the store are skipped.
+
+        Args:
+            pair_name (str): name of the scene
+            bands (dict): band name -> geotiff path. Bands not yet in the store are added
+                and are NaN at earlier time steps.
+            desc (dict): annotation description stored in the scene attributes [Default = None]
+            t (datetime): acquisition time [Default = start time from desc]
+        Returns:
+            index (int): time index of the scene (None if it was already in the store)
+        """
+        bands = {name: fp for name, fp in bands.items() if not self._is_complex(fp)}
+        if not bands:
+            log.warning(f'No real valued images to append for {pair_name}.')
+            return None
+        if t is None:
+            t = scene_times(desc)[0] if desc is not None else None
+            if t is None:
+                raise ValueError(f'No acquisition time found for {pair_name}. Provide t.')
+        t = pd.Timestamp(t)
+        if t.tzinfo is not None:
+            t = t.tz_convert('UTC').tz_localize(None)
+
+        with self._lock():
+            index = self._reserve(pair_name, bands, t, desc)
+        if index is None:
+            return None
+        if self.time_chunks == 1:
+            # Each time step has its own chunks so writers never touch the same chunk
+            self._write(index, bands)
+        else:
+            # Chunks are rewritten whole, so appends to the same time chunk take turns. The
+            # store is opened under the lock so it sees every time step reserved before.
+            with self._lock(index):
+                self._write(index, bands)
+        with self._lock():
+            group = zarr.open_group(self.store_fp, mode = 'r+')
+            scenes = dict(group.attrs['scenes'])
+            scenes[pair_name] = dict(scenes[pair_name], complete = True)
+            group.attrs['scenes'] = scenes
+        return index
+
+    @staticmethod
+    def _is_complex(fp):
+        with rasterio.open(fp) as src:
+            if np.dtype(src.dtypes[0]).kind == 'c':
+                log.info(f'Skipping complex image {fp}')
+                return True
+        return False
+
+    def append_scene(self, scene):
+        """
+        Appends a converted UavsarScene.
+
+        Args:
+            scene (UavsarScene): scene after zip_to_tiffs or binary_to_tiffs
+        Returns:
+            index (int): time index of the scene (None if it was already in the store)
+        """
+        desc = next(iter(scene.images.values()))['description'] if scene.images else None
+        return self.append(scene.pair_name, scene_bands(scene.images), desc = desc)
+
+    def open(self, chunks = None):
+        """
+        Opens the store as a lazy xarray Dataset sorted by time. Scene annotations are in
+        ds.attrs['scenes'], where 'index' is the position of the scene in the store (in
+        order of appending) rather than in the sorted Dataset.
+
+        Args:
+            chunks (dict): dask chunks [Default = chunks of the store]
+        """
+        ds = xr.open_zarr(self.store_fp, chunks = chunks if chunks is not None else {}, consolidated = False)
+        # Parallel appends add time steps in the order they finish
+        if not ds.indexes['time'].is_monotonic_increasing:
+            ds = ds.sortby('time')
+        return ds.rio.write_crs(CRS.from_wkt(ds.attrs['crs']))